@@ -0,0 +1,475 @@
+"""
+Picture quality analytics, detects blank, frozen and fuzzy video.
+
+Each stream is decoded by ffmpeg to small downscaled grayscale rawvideo
+frames which are read from the pipe straight into a preallocated numpy
+array. Frames are scored with vectorized operations:
+
+    blank   variance of the luma is low (flat picture)
+    frozen  mean absolute difference to the previous frame is low
+    fuzzy   variance of the Laplacian is low (no edges)
+
+Every condition goes through a Hysteresis so it has to hold for a few
+frames before it is raised or cleared. Scores and conditions are
+published on StreamAnalyticsTopic for every frame, a condition being
+raised is also published on StreamFaultTopic.
+
+The scoring works on (N, H, W) arrays so the same code is used for a
+single stream (StreamAnalyzer) and for BatchAnalyzer which gathers the
+latest frame of every stream each tick and scores them in one pass, far
+fewer numpy calls when there are many streams. Streams are analyzed by
+the daemon's BatchAnalyzers, one per frame size, from the analytics
+output of their input's ffmpeg (filterGraph.AnalyticsOutput), see
+service() and onStreamCreate().
+
+'python analytics.py' compares per stream and batched throughput.
+"""
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+import numpy
+import config
+import signals
+import filterGraph
+import placement
+
+FRAME_WIDTH = 160
+FRAME_HEIGHT = 90
+FRAME_RATE = 4
+
+# (raise below, clear above)
+BLANK_THRESHOLDS = (20.0, 40.0)
+FROZEN_THRESHOLDS = (0.5, 1.5)
+FUZZY_THRESHOLDS = (30.0, 60.0)
+HOLD_FRAMES = 3
+
+_conditions = (
+    ('blank', 'luma_var', 'Blank', 'Picture is blank'),
+    ('frozen', 'diff', 'Frozen', 'Picture is frozen'),
+    ('fuzzy', 'blur', 'Fuzzy', 'Picture is out of focus'),
+)
+
+
+class Hysteresis:
+    """ A condition that is raised after hold consecutive values below
+        on and cleared after hold consecutive values above off.
+    """
+    def __init__(self, on, off, hold=HOLD_FRAMES):
+        self.on = on
+        self.off = off
+        self.hold = hold
+        self.active = False
+        self.count = 0
+
+    def update(self, value):
+        """ Returns True if the condition changed.
+        """
+        if self.active:
+            crossing = value > self.off
+        else:
+            crossing = value < self.on
+        self.count = self.count + 1 if crossing else 0
+        if self.count >= self.hold:
+            self.active = not self.active
+            self.count = 0
+            return True
+        return False
+
+
+def detectors(thresholds=None):
+    thresholds = thresholds or {}
+    return {
+        'blank': Hysteresis(*thresholds.get('blank', BLANK_THRESHOLDS)),
+        'frozen': Hysteresis(*thresholds.get('frozen', FROZEN_THRESHOLDS)),
+        'fuzzy': Hysteresis(*thresholds.get('fuzzy', FUZZY_THRESHOLDS)),
+    }
+
+
+class Scorer:
+    """ Scores (N, H, W) uint8 frames against the previous frames, the
+        intermediate arrays are allocated once.
+    """
+    def __init__(self, shape):
+        n, h, w = shape
+        self.diff = numpy.empty(shape, numpy.int16)
+        self.lap = numpy.empty((n, h - 2, w - 2), numpy.int16)
+
+    def score(self, frames, prev):
+        n = frames.shape[0]
+        flat = frames.reshape(n, -1)
+        luma_mean = flat.mean(axis=1, dtype=numpy.float32)
+        luma_var = flat.var(axis=1, dtype=numpy.float32)
+
+        diff = self.diff[:n]
+        numpy.subtract(frames, prev, out=diff, dtype=numpy.int16)
+        numpy.abs(diff, out=diff)
+        mean_diff = diff.reshape(n, -1).mean(axis=1, dtype=numpy.float32)
+
+        # 4 neighbour laplacian
+        lap = self.lap[:n]
+        numpy.multiply(frames[:, 1:-1, 1:-1], -4, out=lap, dtype=numpy.int16)
+        lap += frames[:, :-2, 1:-1]
+        lap += frames[:, 2:, 1:-1]
+        lap += frames[:, 1:-1, :-2]
+        lap += frames[:, 1:-1, 2:]
+        blur = lap.reshape(n, -1).var(axis=1, dtype=numpy.float32)
+
+        return {
+            'luma_mean': luma_mean,
+            'luma_var': luma_var,
+            'diff': mean_diff,
+            'blur': blur
+        }
+
+
+def report(sid, dets, scores):
+    """ Run one stream's scores through its detectors and publish the
+        result, scores holds plain floats.
+    """
+    result = dict(scores)
+    for name, metric, error, desc in _conditions:
+        if dets[name].update(scores[metric]) and dets[name].active:
+            signals.publish(config.StreamFaultTopic(sid), {
+                'error': error,
+                'desc': desc
+            })
+        result[name] = dets[name].active
+    signals.publish(config.StreamAnalyticsTopic(sid), result)
+    return result
+
+
+class FrameSource:
+    """ Feeds the <streamId>/input chunks to an ffmpeg that outputs
+        small grayscale frames, frames are read into one of three rotating
+        numpy buffers (being written, latest and previous). ffmpeg's
+        stdout is read on a thread of its own so a full output pipe never
+        blocks the writes of the input chunks.
+
+        With graph=True the frames come from the input's own ffmpeg
+        (filterGraph.AnalyticsOutput) and no decoder is started here.
+    """
+    def __init__(self, streamId, width=FRAME_WIDTH, height=FRAME_HEIGHT,
+            rate=FRAME_RATE, onFrame=None, graph=False):
+        self.sid = streamId
+        self.graph = graph
+        self.width = width
+        self.height = height
+        self.onFrame = onFrame
+        self.frames = numpy.zeros((3, height, width), numpy.uint8)
+        self.views = [memoryview(f).cast('B') for f in self.frames]
+        self.writing = 0
+        self.latest = None
+        self.prev = None
+        self.filled = 0
+        self.seq = 0
+        self.lock = threading.Lock()
+
+        self.vin_r, self.vin_w = os.pipe()
+        cmdfmt = "%s -loglevel -8 -i pipe:%d -vf fps=%s,scale=%d:%d " +\
+            "-f rawvideo -pix_fmt gray pipe:1"
+        self.cmd = cmdfmt % (config.FFMPEG, self.vin_r, rate, width, height)
+        self.si_topic = config.StreamInputTopic(self.sid)
+        self.an_topic = config.StreamOutputTopic(self.sid, filterGraph.OUTPUT_ANALYTICS)
+        self.stop_topic = config.StreamStopTopic(self.sid)
+        self.proc = None
+        self.reader = None
+        self.subscribed = False
+
+    def __del__(self):
+        try:
+            os.close(self.vin_r)
+            os.close(self.vin_w)
+        except:
+            pass
+
+    def feed(self, data):
+        if self.proc is None or self.proc.poll() is not None:
+            logging.error("analytics: ffmpeg crash sid=%s" % self.sid)
+            return
+        os.write(self.vin_w, data)
+
+    def _read_frames(self, stdout):
+        # runs until ffmpeg exits and closes its end of the pipe
+        size = len(self.views[0])
+        while True:
+            try:
+                n = os.readv(stdout.fileno(),
+                    [self.views[self.writing][self.filled:]])
+            except (OSError, ValueError):
+                return
+            if n == 0:
+                return
+            self.filled += n
+            if self.filled == size:
+                self._frame_done()
+
+    def _frame_done(self):
+        self.filled = 0
+        with self.lock:
+            self.prev, self.latest = self.latest, self.writing
+            self.writing = ({0, 1, 2} - {self.latest, self.prev}).pop()
+            self.seq += 1
+        if self.onFrame:
+            self.onFrame(self)
+
+    def store(self, data):
+        """ Copy rawvideo bytes published by the input's graph into the
+            frame buffers.
+        """
+        size = len(self.views[0])
+        data = memoryview(data)
+        while len(data) > 0:
+            n = min(size - self.filled, len(data))
+            self.views[self.writing][self.filled:self.filled + n] = data[:n]
+            data = data[n:]
+            self.filled += n
+            if self.filled == size:
+                self._frame_done()
+
+    def pair(self):
+        """ (latest, previous) frames, previous is None until two frames
+            have been decoded.
+        """
+        with self.lock:
+            if self.prev is None:
+                return self.frames[self.latest] if self.latest is not None \
+                    else None, None
+            return self.frames[self.latest], self.frames[self.prev]
+
+    def copy_pair(self, out, outPrev):
+        """ Copy the latest two frames into out and outPrev, returns False
+            if there are not two frames yet.
+        """
+        with self.lock:
+            if self.prev is None:
+                return False
+            out[...] = self.frames[self.latest]
+            outPrev[...] = self.frames[self.prev]
+            return True
+
+    def start(self):
+        if self.graph:
+            if not self.subscribed:
+                signals.subscribe(self.an_topic, self.store)
+                signals.subscribe(self.stop_topic, self.stop)
+                self.subscribed = True
+            return
+
+        if not self.subscribed:
+            signals.subscribe_async(self.si_topic, self.feed, maxsize=16)
+            signals.subscribe(self.stop_topic, self.stop)
+            self.subscribed = True
+
+        logging.info(self.cmd)
+        self.proc = subprocess.Popen(shlex.split(self.cmd), shell=False,
+            pass_fds=(self.vin_r,), stdout=subprocess.PIPE)
+        placement.service().place(self.proc.pid, self.sid, placement.STAGE_ANALYTICS)
+        self.reader = threading.Thread(target=self._read_frames,
+            args=(self.proc.stdout,), name="analytics-%s" % self.sid)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def stop(self):
+        if self.subscribed:
+            signals.unsubscribe(self.si_topic, self.feed)
+            signals.unsubscribe(self.an_topic, self.store)
+            signals.unsubscribe(self.stop_topic, self.stop)
+            self.subscribed = False
+        if self.proc:
+            logging.info("stopping analytics for sid=%s" % self.sid)
+            if self.proc.poll() is None:
+                self.proc.kill()
+                self.proc.wait()
+            self.reader.join(1)
+            self.reader = None
+            self.proc.stdout.close()
+            self.proc = None
+
+
+class StreamAnalyzer:
+    """ Scores each frame of one stream as soon as it is decoded.
+    """
+    def __init__(self, streamId, width=FRAME_WIDTH, height=FRAME_HEIGHT,
+            rate=FRAME_RATE, thresholds=None, graph=False):
+        self.sid = streamId
+        self.source = FrameSource(streamId, width, height, rate,
+            self._on_frame, graph)
+        self.scorer = Scorer((1, height, width))
+        self.detectors = detectors(thresholds)
+
+    def _on_frame(self, source):
+        frame, prev = source.pair()
+        if prev is None:
+            return
+        scores = self.scorer.score(frame[None], prev[None])
+        report(self.sid, self.detectors,
+            dict((k, float(v[0])) for k, v in scores.items()))
+
+    def start(self):
+        self.source.start()
+
+    def stop(self):
+        self.source.stop()
+
+
+class BatchAnalyzer(threading.Thread):
+    """ Every 1/tickRate seconds copies the latest frame pair of each
+        stream with a new frame into preallocated (batchSize, H, W)
+        arrays, scores them in one pass and scatters the results to each
+        stream's analytics and fault topics.
+    """
+    def __init__(self, batchSize=16, tickRate=FRAME_RATE, width=FRAME_WIDTH,
+            height=FRAME_HEIGHT, thresholds=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.batchSize = batchSize
+        self.tickRate = tickRate
+        self.width = width
+        self.height = height
+        self.thresholds = thresholds
+        self.frames = numpy.zeros((batchSize, height, width), numpy.uint8)
+        self.prev = numpy.zeros((batchSize, height, width), numpy.uint8)
+        self.scorer = Scorer((batchSize, height, width))
+        # sid -> [FrameSource, detectors, seq of the last scored frame]
+        self.sources = {}
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def add(self, streamId, graph=False, rate=None):
+        """ Score streamId's frames, ticks at least at rate. """
+        self.tickRate = max(self.tickRate, rate or self.tickRate)
+        source = FrameSource(streamId, self.width, self.height, self.tickRate,
+            graph=graph)
+        with self.lock:
+            self.sources[streamId] = [source, detectors(self.thresholds), 0]
+        source.start()
+        return source
+
+    def remove(self, streamId):
+        with self.lock:
+            entry = self.sources.pop(streamId, None)
+        if entry:
+            entry[0].stop()
+
+    def _score(self, batch):
+        n = len(batch)
+        scores = self.scorer.score(self.frames[:n], self.prev[:n])
+        for i, (sid, dets) in enumerate(batch):
+            report(sid, dets, dict((k, float(v[i])) for k, v in scores.items()))
+
+    def tick(self):
+        with self.lock:
+            entries = list(self.sources.items())
+        batch = []
+        for sid, entry in entries:
+            source, dets, seq = entry
+            if not source.subscribed:
+                # stopped on its stream's stop topic
+                with self.lock:
+                    if self.sources.get(sid) is entry:
+                        del self.sources[sid]
+                continue
+            if source.seq == seq:
+                continue
+            n = len(batch)
+            if source.copy_pair(self.frames[n], self.prev[n]):
+                entry[2] = source.seq
+                batch.append((sid, dets))
+            if len(batch) == self.batchSize:
+                self._score(batch)
+                batch = []
+        if batch:
+            self._score(batch)
+
+    def run(self):
+        next_tick = time.time()
+        while not self.done.is_set():
+            try:
+                self.tick()
+            except:
+                logging.exception("analytics batch failed")
+            next_tick += 1.0 / self.tickRate
+            self.done.wait(max(next_tick - time.time(), 0))
+
+    def stop(self):
+        self.done.set()
+        for sid in list(self.sources):
+            self.remove(sid)
+
+
+# (width, height) -> BatchAnalyzer
+_batches = {}
+_batch_lock = threading.Lock()
+
+def service(width=FRAME_WIDTH, height=FRAME_HEIGHT):
+    """ The BatchAnalyzer scoring the streams with width x height frames,
+        started on first use.
+    """
+    with _batch_lock:
+        batch = _batches.get((width, height))
+        if batch is None:
+            batch = _batches[(width, height)] = BatchAnalyzer(
+                width=width, height=height)
+            batch.start()
+        return batch
+
+
+def onStreamCreate(stream):
+    # the input's ffmpeg produces the frames, see Stream.outputs()
+    a = stream.analytics
+    if a.enabled:
+        return service(a.width, a.height).add(stream.sid, graph=True, rate=a.rate)
+
+
+def benchmark(counts=(4, 16, 64), ticks=200):
+    """ Frames analyzed per second with a StreamAnalyzer per stream versus
+        one BatchAnalyzer for all streams. Synthetic frames are published
+        on the analytics output topics as an input's ffmpeg would, so the
+        copy into the frame buffers, scoring, detectors and publishing of
+        the results are all measured. No ffmpeg involved.
+    """
+    shape = (FRAME_HEIGHT, FRAME_WIDTH)
+    for count in counts:
+        sids = ["bench%d-%d" % (count, i) for i in range(count)]
+        topics = [config.StreamOutputTopic(sid, filterGraph.OUTPUT_ANALYTICS)
+            for sid in sids]
+        frames = [numpy.random.randint(0, 255, shape).astype(numpy.uint8).tobytes()
+            for i in range(count * 2)]
+
+        analyzers = [StreamAnalyzer(sid, graph=True) for sid in sids]
+        for a in analyzers:
+            a.start()
+        start = time.time()
+        for t in range(ticks):
+            for i, topic in enumerate(topics):
+                signals.publish(topic, frames[i * 2 + t % 2])
+        per_stream = count * ticks / (time.time() - start)
+        for a in analyzers:
+            a.stop()
+
+        batch = BatchAnalyzer(batchSize=min(count, 64))
+        for sid in sids:
+            batch.add(sid, graph=True)
+        start = time.time()
+        for t in range(ticks):
+            for i, topic in enumerate(topics):
+                signals.publish(topic, frames[i * 2 + t % 2])
+            batch.tick()
+        batched = count * ticks / (time.time() - start)
+        batch.stop()
+
+        print("streams=%d per-stream=%.0f frames/s batched=%.0f frames/s (x%.1f)" % (
+            count, per_stream, batched, batched / per_stream))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format="%(asctime)s %(message)s")
+    benchmark()
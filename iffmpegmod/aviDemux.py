@@ -0,0 +1,347 @@
+"""
+Splits the AVI byte stream ffmpeg writes to a pipe into frames without
+copying the payloads.
+
+Demuxer.feed() takes the chunks as they are read (ring buffer views of
+any size) and returns what completed in them:
+
+    Header    the RIFF header up to the movi data, a new one follows
+              every ffmpeg restart
+    Frame     one data chunk of a stream, its payload as a list of views
+              of the chunks it arrived in
+
+Only chunk headers, the stream header and the first PEEK bytes of each
+video frame are copied. Keyframes are recognised from the start of the
+payload for the codecs in KEYFRAME_CODECS, any other video codec counts
+every frame as a keyframe.
+
+Frames hold a ring buffer reference on each part: signals retains a
+queued Frame like a chunk, a subscriber keeping one past its callback
+calls retain()/release(). With InputStream conf 'frames' the relay is
+published frame by frame on config.StreamFrameTopic(streamId), see
+subscribe() for keyframes only and decimated subscriptions.
+"""
+import struct
+import config
+import ringBuffer
+import signals
+
+# payload bytes examined to classify a frame
+PEEK = 512
+# give up on a stream whose header is larger than this
+MAX_HEADER = 1 << 20
+
+_CHUNK = struct.Struct("<4sI")
+
+
+def _annexb_types(data, shift, mask):
+    """ NAL unit types following each 00 00 01 start code in data """
+    i = data.find(b"\0\0\1")
+    while i >= 0 and i + 3 < len(data):
+        yield (data[i + 3] >> shift) & mask
+        i = data.find(b"\0\0\1", i + 3)
+
+def _h264_key(data):
+    # IDR slice or a sequence parameter set in front of one
+    return any(t in (5, 7) for t in _annexb_types(data, 0, 0x1f))
+
+def _hevc_key(data):
+    # IRAP slices or a video parameter set
+    return any(16 <= t <= 21 or t == 32 for t in _annexb_types(data, 1, 0x3f))
+
+def _mpeg4_key(data):
+    # VOP start code, coding type 0 is an I-VOP
+    i = data.find(b"\0\0\1\xb6")
+    return i >= 0 and i + 4 < len(data) and data[i + 4] >> 6 == 0
+
+KEYFRAME_CODECS = {}
+for _fourcc in (b"H264", b"h264", b"X264", b"x264", b"AVC1", b"avc1"):
+    KEYFRAME_CODECS[_fourcc] = _h264_key
+for _fourcc in (b"HEVC", b"hevc", b"H265", b"h265", b"HVC1", b"hvc1"):
+    KEYFRAME_CODECS[_fourcc] = _hevc_key
+for _fourcc in (b"FMP4", b"fmp4", b"XVID", b"xvid", b"DIVX", b"divx",
+        b"DX50", b"MP4V", b"mp4v"):
+    KEYFRAME_CODECS[_fourcc] = _mpeg4_key
+
+def is_keyframe(codec, data):
+    test = KEYFRAME_CODECS.get(codec)
+    return True if test is None else test(bytes(data))
+
+
+def _chunks(data, pos, end):
+    """ (fourcc, data offset, size) of the RIFF chunks in data[pos:end] """
+    while pos + 8 <= end:
+        fourcc, size = _CHUNK.unpack_from(data, pos)
+        yield fourcc, pos + 8, size
+        pos += 8 + size + (size & 1)
+
+def parse_header(data):
+    """ ({stream number: fccType}, video codec fourcc) of an AVI header """
+    streams = {}
+    codec = None
+    for fourcc, pos, size in _chunks(data, 12, len(data)):
+        if fourcc != b"LIST" or data[pos:pos + 4] != b"hdrl":
+            continue
+        for fourcc, pos, size in _chunks(data, pos + 4, pos + size):
+            if fourcc != b"LIST" or data[pos:pos + 4] != b"strl":
+                continue
+            strh = strf = None
+            for fourcc, p, n in _chunks(data, pos + 4, pos + size):
+                if fourcc == b"strh":
+                    strh = data[p:p + n]
+                elif fourcc == b"strf":
+                    strf = data[p:p + n]
+            kind = bytes(strh[:4]) if strh else b""
+            if kind == b"vids" and codec is None:
+                codec = bytes(strf[16:20] if strf and len(strf) >= 20 else strh[4:8])
+            streams[len(streams)] = kind
+    return streams, codec
+
+
+class Header:
+    def __init__(self, offset, data, streams, codec):
+        self.offset = offset
+        self.data = data
+        self.size = len(data)
+        self.streams = streams
+        self.codec = codec
+
+
+class Frame:
+    """ stream      stream number in the AVI header
+        video       True for a video stream
+        keyframe    video frame a decoder can start at
+        seq         frame number since the Demuxer started
+        offset      stream offset of the chunk header
+        size        payload bytes
+        parts       payload as views, empty unless the Demuxer keeps parts
+    """
+    __slots__ = ('stream', 'video', 'keyframe', 'seq', 'offset', 'size', 'parts')
+
+    def __init__(self, stream, video, seq, offset, size):
+        self.stream = stream
+        self.video = video
+        self.keyframe = False
+        self.seq = seq
+        self.offset = offset
+        self.size = size
+        self.parts = []
+
+    @property
+    def nbytes(self):
+        return self.size
+
+    @property
+    def chunk_size(self):
+        """ bytes of the chunk in the stream, header and padding included """
+        return 8 + self.size + (self.size & 1)
+
+    def chunk_header(self):
+        """ the 8 byte chunk header written in front of the payload """
+        return _CHUNK.pack(b"%02d%s" % (self.stream, b"dc" if self.video else b"wb"),
+            self.size)
+
+    def retain(self):
+        for part in self.parts:
+            ringBuffer.retain(part)
+
+    def release(self):
+        for part in self.parts:
+            ringBuffer.release(part)
+
+    def tobytes(self):
+        return b"".join(self.parts)
+
+    def detach(self):
+        """ Copy the payload out of the ring buffer and release its slots,
+            for frames held longer than a callback.
+        """
+        data = self.tobytes()
+        self.release()
+        self.parts = [memoryview(data)]
+
+
+class Demuxer:
+    def __init__(self, parts=True):
+        self.keep_parts = parts
+        # stream offset of the next byte
+        self.pos = 0
+        self.buf = bytearray()
+        self.in_header = True
+        self.header_start = 0
+        self.header = None
+        self.streams = {}
+        self.codec = None
+        self.failed = False
+        self.seq = 0
+        # payload bytes left in the current chunk and its padding
+        self.skip = 0
+        self.pad = 0
+        # frame being received, the bytes peeked at to classify it
+        self.frame = None
+        self.peek = None
+
+    def reset(self):
+        """ Start over with a new stream at the current offset, the parts
+            of an incomplete frame are released.
+        """
+        if self.frame is not None:
+            self.frame.release()
+        self.buf = bytearray()
+        self.in_header = True
+        self.header_start = self.pos
+        self.failed = False
+        self.skip = self.pad = 0
+        self.frame = self.peek = None
+
+    def holding(self):
+        """ Stream offset of the first byte of a header or frame not
+            returned yet, None if there is none.
+        """
+        if self.failed:
+            return None
+        if self.in_header:
+            return self.header_start
+        if self.frame is not None:
+            return self.frame.offset
+        if self.buf:
+            return self.pos - len(self.buf)
+        return None
+
+    def feed(self, data):
+        """ Headers and Frames completed by data, a Frame holds a ring
+            buffer reference on each part which the caller releases.
+        """
+        done = []
+        data = memoryview(data)
+        i = 0
+        while i < len(data) and not self.failed:
+            if self.in_header:
+                i += self._feed_header(data[i:], done)
+            elif self.skip:
+                i += self._feed_payload(data[i:], done)
+            else:
+                i += self._feed_chunk(data[i:], done)
+        return done
+
+    def _feed_payload(self, data, done):
+        n = min(self.skip, len(data))
+        frame = self.frame
+        if frame is not None:
+            payload = min(n, self.skip - self.pad)
+            if payload > 0:
+                part = data[:payload]
+                if self.keep_parts:
+                    ringBuffer.retain(part)
+                    frame.parts.append(part)
+                if self.peek is not None and len(self.peek) < PEEK:
+                    self.peek += part[:PEEK - len(self.peek)]
+        self.pos += n
+        self.skip -= n
+        if frame is not None and self.skip <= self.pad:
+            if self.peek is not None:
+                frame.keyframe = is_keyframe(self.codec, self.peek)
+            self.frame = self.peek = None
+            done.append(frame)
+        return n
+
+    def _feed_header(self, data, done):
+        take = len(data)
+        self.buf += data
+        if len(self.buf) >= 12 and self.buf[8:12] == b"AVIX":
+            # OpenDML continuation of the same stream, its movi list
+            # holds more frames
+            rest = len(self.buf) - 12
+            self.pos = self.header_start + 12
+            self.buf = bytearray()
+            self.in_header = False
+            return take - rest
+        if len(self.buf) >= 12 and (self.buf[:4] != b"RIFF" or self.buf[8:12] != b"AVI "):
+            self.failed = True
+            return take
+        for fourcc, pos, size in _chunks(self.buf, 12, len(self.buf)):
+            if fourcc == b"LIST" and self.buf[pos:pos + 4] == b"movi":
+                end = pos + 4
+                self.header = bytes(self.buf[:end])
+                self.streams, self.codec = parse_header(self.header)
+                done.append(Header(self.header_start, self.header,
+                    self.streams, self.codec))
+                rest = len(self.buf) - end
+                self.pos = self.header_start + end
+                self.buf = bytearray()
+                self.in_header = False
+                return take - rest
+        if len(self.buf) > MAX_HEADER:
+            self.failed = True
+        return take
+
+    def _feed_chunk(self, data, done):
+        need = 8 - len(self.buf)
+        self.buf += data[:need]
+        n = min(need, len(data))
+        self.pos += n
+        if len(self.buf) < 8:
+            return n
+        fourcc, size = _CHUNK.unpack(self.buf)
+        start = self.pos - 8
+        self.buf = bytearray()
+        if fourcc == b"RIFF":
+            # AVIX extension or, after an ffmpeg restart, a new stream
+            self.buf += _CHUNK.pack(fourcc, size)
+            self.in_header = True
+            self.header_start = start
+            self.pos = start
+            return n
+        if fourcc == b"LIST":
+            # descend into movi sub lists, the list type follows
+            self.skip = 4
+            self.pad = 0
+            return n
+        self.pad = size & 1
+        self.skip = size + self.pad
+        if fourcc[:2].isdigit() and fourcc[2:] in (b"dc", b"db", b"wb"):
+            stream = int(fourcc[:2])
+            video = self.streams.get(stream) == b"vids"
+            self.frame = Frame(stream, video, self.seq, start, size)
+            self.seq += 1
+            self.peek = bytearray() if video else None
+            if size == 0:
+                done.append(self.frame)
+                self.frame = self.peek = None
+        return n
+
+
+def keyframes_only(frame):
+    return frame.keyframe
+
+
+class Decimator:
+    """ Passes every keyframes-th video keyframe, the cheapest way to thin
+        out compressed video since only keyframes decode on their own.
+    """
+    def __init__(self, keyframes):
+        self.keyframes = keyframes
+        self.count = 0
+
+    def __call__(self, frame):
+        if not frame.keyframe:
+            return False
+        self.count += 1
+        return (self.count - 1) % self.keyframes == 0
+
+
+def subscribe(streamId, callback, keyframesOnly=False, keyframes=None,
+        maxsize=signals.DEFAULT_QUEUE_SIZE):
+    """ Subscribe callback to the frames of streamId on its own queue. A
+        slow subscriber drops non keyframes first, keyframesOnly or
+        keyframes (every keyframes-th keyframe) thin the frames on the
+        publisher's thread before they are queued. Returns the
+        AsyncSubscriber.
+    """
+    accept = None
+    if keyframes:
+        accept = Decimator(keyframes)
+    elif keyframesOnly:
+        accept = keyframes_only
+    return signals.subscribe_async(config.StreamFrameTopic(streamId), callback,
+        maxsize, signals.OVERFLOW_KEYFRAME_ONLY, accept)
@@ -0,0 +1,169 @@
+"""
+What the local ffmpeg can do: version, encoders, decoders, filters and
+hwaccels.
+
+Probing takes five runs of ffmpeg so it is done once per binary, the
+result is saved in CAPABILITIES_FILE keyed by the binary's real path,
+size and mtime. A daemon starting with the same ffmpeg reads the file
+and stats the binary, nothing is run. Installing another ffmpeg changes
+the key and the next get() probes it.
+
+    caps = capabilities.get()
+    if caps.has_encoder("h264_vaapi"): ...
+    caps.hwaccels       # hwaccel methods compiled in
+
+Command builders ask here instead of assuming a particular build, see
+inputStream (conf 'hwaccel'), imageGenerator and transcode.
+
+-hwaccels lists the methods the build supports, not the hardware of
+the host: a cuda build on a machine without an nvidia gpu has cuda.
+Whether a device can be opened is left to ffmpeg's -hwaccel auto.
+"""
+import json
+import logging
+import os
+import re
+import subprocess
+import threading
+import config
+
+CAPABILITIES_FILE = config.DATA_DIR + "capabilities.json"
+PROBE_TIMEOUT = 30
+
+_VERSION_RE = re.compile(r"version (\S+)")
+
+
+class Capabilities:
+    def __init__(self, path, key, version=None, encoders=(), decoders=(),
+            filters=(), hwaccels=()):
+        self.path = path
+        self.key = key
+        self.version = version
+        self.encoders = set(encoders)
+        self.decoders = set(decoders)
+        self.filters = set(filters)
+        self.hwaccels = set(hwaccels)
+
+    def has_encoder(self, name):
+        return name in self.encoders
+
+    def has_decoder(self, name):
+        return name in self.decoders
+
+    def has_filter(self, name):
+        return name in self.filters
+
+    def todict(self):
+        return {
+            'path': self.path,
+            'key': self.key,
+            'version': self.version,
+            'encoders': sorted(self.encoders),
+            'decoders': sorted(self.decoders),
+            'filters': sorted(self.filters),
+            'hwaccels': sorted(self.hwaccels)
+        }
+
+
+def binary_key(path):
+    """ real path, size and mtime of the binary, None if it is missing """
+    try:
+        real = os.path.realpath(path)
+        st = os.stat(real)
+    except OSError:
+        return None
+    return "%s:%d:%d" % (real, st.st_size, st.st_mtime_ns)
+
+def _run(path, *args):
+    try:
+        return subprocess.run([path, "-hide_banner"] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            timeout=PROBE_TIMEOUT).stdout.decode(errors='replace')
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logging.warning("capabilities: %s %s failed: %s" % (path, args[0], str(e)))
+        return ""
+
+def _codecs(text):
+    """ names in -encoders/-decoders output, ' V....D libx264  ...' """
+    names = []
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) > 1 and len(fields[0]) == 6 and fields[0][0] in "VAS" \
+                and fields[1] != "=":
+            names.append(fields[1])
+    return names
+
+def _filters(text):
+    """ names in -filters output, ' T.C scale  V->V  ...' """
+    names = []
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) > 2 and "->" in fields[2]:
+            names.append(fields[1])
+    return names
+
+def probe(path):
+    """ Run ffmpeg at path for its capabilities, not cached. """
+    version = _VERSION_RE.search(_run(path, "-version"))
+    hwaccels = _run(path, "-hwaccels").splitlines()
+    return Capabilities(path, binary_key(path),
+        version.group(1) if version else None,
+        _codecs(_run(path, "-encoders")),
+        _codecs(_run(path, "-decoders")),
+        _filters(_run(path, "-filters")),
+        [l.strip() for l in hwaccels[1:] if l.strip()]
+            if hwaccels and hwaccels[0].startswith("Hardware") else [])
+
+
+_cache = {}
+_lock = threading.Lock()
+
+def _load():
+    try:
+        entries = config.load(CAPABILITIES_FILE) or {}
+    except ValueError:
+        logging.warning("ignoring corrupt %s" % CAPABILITIES_FILE)
+        entries = {}
+    return entries
+
+def _save(entries):
+    tmp = CAPABILITIES_FILE + ".tmp"
+    try:
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(entries, indent=1, sort_keys=True))
+        os.rename(tmp, CAPABILITIES_FILE)
+    except OSError as e:
+        logging.warning("unable to save capabilities: %s" % str(e))
+
+def get(path=None):
+    """ Capabilities of the ffmpeg at path, config.FFMPEG by default,
+        probed only if it is not in the registry yet.
+    """
+    path = path or config.FFMPEG
+    key = binary_key(path)
+    with _lock:
+        caps = _cache.get(path)
+        if caps is not None and caps.key == key:
+            return caps
+        entries = _load()
+        entry = entries.get(key) if key else None
+        if entry:
+            caps = Capabilities(path, key, entry.get('version'),
+                entry.get('encoders', ()), entry.get('decoders', ()),
+                entry.get('filters', ()), entry.get('hwaccels', ()))
+        else:
+            logging.info("capabilities: probing %s" % path)
+            caps = probe(path)
+            if key:
+                # binaries replaced since are dropped
+                entries = dict((k, v) for k, v in entries.items()
+                    if k.rsplit(':', 2)[0] != key.rsplit(':', 2)[0])
+                entries[key] = caps.todict()
+                _save(entries)
+        _cache[path] = caps
+        return caps
+
+
+if __name__ == '__main__':
+    import sys
+    print(json.dumps(get(sys.argv[1] if len(sys.argv) > 1 else None).todict(), indent=1))
@@ -0,0 +1,639 @@
+#!/usr/bin/env python
+"""
+Places streams on the nodes of a cluster over MQTT.
+
+Every node runs a NodeAgent which publishes a load report every
+reportInterval seconds and starts or stops the streams it is told to:
+
+    <MQTT_NODE_TOPIC>/<node>/load       {node, time, cpu, cores, streams,
+                                         bandwidth, capabilities}
+    <MQTT_NODE_TOPIC>/<node>/assign     Stream.spec() to start
+    <MQTT_NODE_TOPIC>/<node>/unassign   {sid} to stop
+    <MQTT_NODE_TOPIC>/<node>/started    {sid} once a stream runs
+    MQTT_SERVICE_DOWN_TOPIC             {id}, the node's last will
+
+One Coordinator assigns the streams submitted to it (place(), or a spec
+on <MQTT_CLUSTER_TOPIC>/create, {sid} on .../remove) to the capable
+node, one whose capabilities include everything in the stream's
+requires, with the lowest projected cpu load. Streams assigned since a
+node's last report count against it at the node's measured cost per
+stream, so a burst of requests does not all land on the node that was
+idle in the last report.
+
+Streams are moved
+
+1. off a node that is down, its last will arrived or no report came
+   for nodeTimeout seconds, to the remaining nodes (failover).
+2. one at a time off a node whose cpu was above hotLoad for hotReports
+   reports in a row, if another node can take it without going hot,
+   then not again for cooldown seconds.
+
+A stream that fits nowhere waits and is placed when capacity appears.
+Reports also reconcile: a node running a stream assigned elsewhere is
+told to stop it, one missing a stream assigned to it is told again.
+
+simulate() runs node processes with simulated streams against a local
+mosquitto and measures placement and failover times.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import config
+import placement
+import signals
+
+NODE_TIMEOUT_REPORTS = 3
+HOT_LOAD = 0.9
+HOT_REPORTS = 3
+COOLDOWN = 60
+
+
+def node_topic(nodeId, name):
+    return "%s/%s/%s" % (config.MQTT_NODE_TOPIC, nodeId, name)
+
+def cluster_topic(name):
+    return "%s/%s" % (config.MQTT_CLUSTER_TOPIC, name)
+
+def _encode(obj):
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+def _decode(payload):
+    return json.loads(payload)
+
+def _chain_on_connect(client, callback):
+    """ Also call callback when client connects, paho has one on_connect
+        which the mqtt bridge may use already.
+    """
+    previous = client.on_connect
+    def on_connect(*args):
+        if previous:
+            previous(*args)
+        callback()
+    client.on_connect = on_connect
+
+
+class NodeAgent:
+    def __init__(self, client, nodeId, start, stop, capabilities=None,
+            reportInterval=config.CLUSTER_REPORT_INTERVAL, load=None):
+        """ start(spec) runs a stream described by Stream.spec(), stop(sid)
+            stops it. load() returns the cpu load as a fraction of the
+            node's usable cores, placement's measurement by default.
+        """
+        self.client = client
+        self.nodeId = nodeId
+        self.start_stream = start
+        self.stop_stream = stop
+        self.capabilities = list(capabilities or ["cpu"])
+        self.reportInterval = reportInterval
+        self.load = load or (lambda: placement.service().report()['load'])
+        self.streams = set()
+        self.last_bytes = None
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.thread = None
+
+        _chain_on_connect(client, self._subscribe)
+        previous = client.on_message
+        def on_message(c, userdata, msg):
+            if not self._on_message(msg) and previous:
+                previous(c, userdata, msg)
+        client.on_message = on_message
+
+    def _subscribe(self):
+        for name in ("assign", "unassign"):
+            self.client.subscribe(node_topic(self.nodeId, name), 1)
+        self.report()
+
+    def _on_message(self, msg):
+        if msg.topic == node_topic(self.nodeId, "assign"):
+            spec = _decode(msg.payload)
+            with self.lock:
+                if spec['sid'] in self.streams:
+                    return True
+                self.streams.add(spec['sid'])
+            try:
+                self.start_stream(spec)
+            except:
+                logging.exception("cluster: starting %s failed" % spec['sid'])
+                with self.lock:
+                    self.streams.discard(spec['sid'])
+                return True
+            self.client.publish(node_topic(self.nodeId, "started"),
+                _encode({'sid': spec['sid'], 'time': time.time()}), 1)
+        elif msg.topic == node_topic(self.nodeId, "unassign"):
+            sid = _decode(msg.payload)['sid']
+            with self.lock:
+                if sid not in self.streams:
+                    return True
+                self.streams.discard(sid)
+            self.stop_stream(sid)
+        else:
+            return False
+        return True
+
+    def bandwidth(self):
+        """ Relay bytes per second published on this node since the last
+            call.
+        """
+        now = time.time()
+        total = sum(c[1] for t, c in signals.topic_stats().items()
+            if t.endswith("-input-chunk"))
+        last, self.last_bytes = self.last_bytes, (now, total)
+        if last is None or now <= last[0]:
+            return 0.0
+        return (total - last[1]) / (now - last[0])
+
+    def report(self):
+        with self.lock:
+            streams = sorted(self.streams)
+        self.client.publish(node_topic(self.nodeId, "load"), _encode({
+            'node': self.nodeId,
+            'time': time.time(),
+            'cpu': self.load(),
+            'cores': len(os.sched_getaffinity(0)),
+            'streams': streams,
+            'bandwidth': self.bandwidth(),
+            'capabilities': self.capabilities
+        }), 0)
+
+    def _run(self):
+        while not self.done.wait(self.reportInterval):
+            try:
+                self.report()
+            except:
+                logging.exception("cluster: load report failed")
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="cluster-agent")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Leave the cluster, the coordinator moves the streams away. """
+        self.done.set()
+        self.client.publish(config.MQTT_SERVICE_DOWN_TOPIC,
+            _encode({'id': self.nodeId}), 1)
+
+
+class _Node:
+    def __init__(self, nodeId):
+        self.id = nodeId
+        self.report = None
+        self.seen = 0
+        self.alive = False
+        self.hot = 0
+        self.cooldown = 0
+        # sids assigned after the last report
+        self.pending = set()
+
+    def cost(self):
+        """ cpu fraction one more stream is expected to add """
+        streams = len(self.report['streams'])
+        if streams and self.report['cpu']:
+            return self.report['cpu'] / streams
+        return placement.DEFAULT_STREAM_COST / max(self.report.get('cores', 1), 1)
+
+    def projected(self):
+        return self.report['cpu'] + self.cost() * len(self.pending)
+
+
+class Coordinator:
+    def __init__(self, client, reportInterval=config.CLUSTER_REPORT_INTERVAL,
+            budget=placement.CPU_BUDGET, hotLoad=HOT_LOAD, hotReports=HOT_REPORTS,
+            cooldown=COOLDOWN):
+        self.client = client
+        self.reportInterval = reportInterval
+        self.nodeTimeout = reportInterval * NODE_TIMEOUT_REPORTS
+        self.budget = budget
+        self.hotLoad = hotLoad
+        self.hotReports = hotReports
+        self.cooldown = cooldown
+        # node id -> _Node
+        self.nodes = {}
+        # sid -> {'spec', 'node', 'time'}
+        self.assignments = {}
+        # sid -> spec waiting for capacity
+        self.unplaced = {}
+        # sid -> time a failover or move started, until the stream runs
+        self.moving = {}
+        # measurements: (sid, node, seconds)
+        self.placements = []
+        self.failovers = []
+        self.moves = []
+        self.submitted = {}
+        self.lock = threading.RLock()
+        self.done = threading.Event()
+        self.thread = None
+
+        _chain_on_connect(client, self._subscribe)
+        client.on_message = self._on_message
+
+    def _subscribe(self):
+        for topic in (node_topic("+", "load"), node_topic("+", "started"),
+                config.MQTT_SERVICE_DOWN_TOPIC, cluster_topic("create"),
+                cluster_topic("remove")):
+            self.client.subscribe(topic, 1)
+
+    def _on_message(self, client, userdata, msg):
+        try:
+            message = _decode(msg.payload)
+            levels = msg.topic.split('/')
+            if msg.topic == config.MQTT_SERVICE_DOWN_TOPIC:
+                self.node_down(message['id'])
+            elif msg.topic == cluster_topic("create"):
+                self.place(message)
+            elif msg.topic == cluster_topic("remove"):
+                self.remove(message['sid'])
+            elif levels[-1] == "load":
+                self.node_report(message)
+            elif levels[-1] == "started":
+                self.started(levels[-2], message['sid'])
+        except:
+            logging.exception("cluster: bad message on %s" % msg.topic)
+
+    def _send(self, nodeId, name, message):
+        self.client.publish(node_topic(nodeId, name), _encode(message), 1)
+
+    def _choose(self, spec, exclude=None, limit=None):
+        limit = self.budget if limit is None else limit
+        requires = set(spec.get('requires') or [])
+        best = None
+        for node in self.nodes.values():
+            if not node.alive or node.id == exclude or \
+                    not requires <= set(node.report.get('capabilities', [])):
+                continue
+            projected = node.projected() + node.cost()
+            if projected > limit:
+                continue
+            key = (projected, len(node.report['streams']) + len(node.pending))
+            if best is None or key < best[0]:
+                best = (key, node)
+        return best[1] if best else None
+
+    def _assign(self, spec, node):
+        sid = spec['sid']
+        self.assignments[sid] = {'spec': spec, 'node': node.id, 'time': time.time()}
+        node.pending.add(sid)
+        self._send(node.id, "assign", spec)
+        logging.info("cluster: %s -> %s" % (sid, node.id))
+
+    def place(self, spec):
+        """ Assign a stream, spec is Stream.spec(). Returns the node id,
+            None if it has to wait for capacity.
+        """
+        with self.lock:
+            sid = spec['sid']
+            self.submitted.setdefault(sid, time.time())
+            if sid in self.assignments:
+                return self.assignments[sid]['node']
+            node = self._choose(spec)
+            if node is None:
+                logging.warning("cluster: no capacity for %s, waiting" % sid)
+                self.unplaced[sid] = spec
+                return None
+            self.unplaced.pop(sid, None)
+            self._assign(spec, node)
+            return node.id
+
+    def remove(self, sid):
+        with self.lock:
+            self.unplaced.pop(sid, None)
+            entry = self.assignments.pop(sid, None)
+            if entry:
+                self._send(entry['node'], "unassign", {'sid': sid})
+
+    def started(self, nodeId, sid):
+        with self.lock:
+            entry = self.assignments.get(sid)
+            if entry is None or entry['node'] != nodeId:
+                return
+            now = time.time()
+            if sid in self.submitted:
+                self.placements.append((sid, nodeId, now - self.submitted.pop(sid)))
+            if sid in self.moving:
+                kind, since = self.moving.pop(sid)
+                (self.failovers if kind == "failover" else self.moves).append(
+                    (sid, nodeId, now - since))
+
+    def node_report(self, report):
+        with self.lock:
+            node = self.nodes.get(report['node'])
+            if node is None:
+                node = self.nodes[report['node']] = _Node(report['node'])
+                logging.info("cluster: node %s joined" % node.id)
+            elif not node.alive:
+                logging.info("cluster: node %s is back" % node.id)
+            node.report = report
+            node.seen = time.time()
+            node.alive = True
+            running = set(report['streams'])
+            node.pending -= running
+            for sid in running:
+                entry = self.assignments.get(sid)
+                if entry is None or entry['node'] != node.id:
+                    # placed elsewhere while this node was gone
+                    self._send(node.id, "unassign", {'sid': sid})
+            for sid, entry in self.assignments.items():
+                if entry['node'] == node.id and sid not in running and \
+                        sid not in node.pending and \
+                        node.seen - entry['time'] > 2 * self.reportInterval:
+                    # the node restarted or lost the assignment
+                    entry['time'] = node.seen
+                    node.pending.add(sid)
+                    self._send(node.id, "assign", entry['spec'])
+            node.hot = node.hot + 1 if report['cpu'] > self.hotLoad else 0
+            self._place_waiting()
+
+    def node_down(self, nodeId):
+        with self.lock:
+            node = self.nodes.get(nodeId)
+            if node is None or not node.alive:
+                return
+            logging.warning("cluster: node %s is down" % nodeId)
+            node.alive = False
+            node.pending = set()
+            now = time.time()
+            for sid, entry in list(self.assignments.items()):
+                if entry['node'] == nodeId:
+                    del self.assignments[sid]
+                    self.moving[sid] = ("failover", now)
+                    self.unplaced[sid] = entry['spec']
+            self._place_waiting()
+
+    def _place_waiting(self):
+        for sid, spec in list(self.unplaced.items()):
+            node = self._choose(spec)
+            if node is None:
+                continue
+            del self.unplaced[sid]
+            self._assign(spec, node)
+
+    def _rebalance(self, now):
+        for node in list(self.nodes.values()):
+            if not node.alive or node.hot < self.hotReports or now < node.cooldown:
+                continue
+            sids = sorted((e['time'], sid) for sid, e in self.assignments.items()
+                if e['node'] == node.id)
+            for t, sid in reversed(sids):
+                spec = self.assignments[sid]['spec']
+                target = self._choose(spec, exclude=node.id, limit=self.hotLoad)
+                if target is None:
+                    continue
+                logging.warning("cluster: node %s is hot, moving %s to %s" % (
+                    node.id, sid, target.id))
+                self._send(node.id, "unassign", {'sid': sid})
+                self.moving[sid] = ("move", now)
+                self._assign(spec, target)
+                break
+            node.hot = 0
+            node.cooldown = now + self.cooldown
+
+    def sweep(self):
+        now = time.time()
+        with self.lock:
+            for node in list(self.nodes.values()):
+                if node.alive and now - node.seen > self.nodeTimeout:
+                    logging.warning("cluster: no report from %s for %ds" % (
+                        node.id, now - node.seen))
+                    self.node_down(node.id)
+            self._rebalance(now)
+            self._place_waiting()
+
+    def report(self):
+        """ {nodes: {id: {alive, cpu, streams}}, unplaced, assignments} """
+        with self.lock:
+            return {
+                'nodes': dict((n.id, {'alive': n.alive, 'cpu': n.report['cpu'],
+                    'streams': sorted(sid for sid, e in self.assignments.items()
+                        if e['node'] == n.id)}) for n in self.nodes.values()),
+                'unplaced': sorted(self.unplaced),
+                'assignments': len(self.assignments)
+            }
+
+    def _run(self):
+        while not self.done.wait(self.reportInterval / 2.0):
+            try:
+                self.sweep()
+            except:
+                logging.exception("cluster: coordinator sweep failed")
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="cluster-coordinator")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.done.set()
+
+
+class LocalStreams:
+    """ start/stop callbacks for a NodeAgent running streams on a
+        streamManager.StreamManager.
+    """
+    def __init__(self, manager):
+        self.manager = manager
+        # sid -> (stream.Stream, [objects with stop()])
+        self.running = {}
+
+    def start(self, spec):
+        import stream
+        import tour
+        import videoWall
+        s = stream.Stream.fromSpec(spec)
+        s.setup()
+        if s.inputs.mode == "videoWall":
+            runners = [self.manager.add(s.wallConf(), videoWall.VideoWallStream)]
+            s.inputStreams = runners
+        elif s.inputs.mode == "tour":
+            t = tour.Tour(s.sid, s.inputs.src, manager=self.manager,
+                outputs=s.outputs())
+            t.start()
+            runners = [t]
+            # attached outputs go to the ffmpeg making the tour's outputs
+            s.inputStreams = [t.stage] if t.stage else []
+        else:
+            runners = [self.manager.add(s.inputConf(src)) for src in s.inputs.src]
+            s.inputStreams = runners
+        self.running[s.sid] = (s, runners)
+
+    def stop(self, sid):
+        s, runners = self.running.pop(sid, (None, []))
+        for runner in runners:
+            runner.stop()
+        if s is not None:
+            s.teardown()
+
+
+class SimulatedStreams:
+    """ start/stop callbacks and load for a NodeAgent in simulate(), each
+        stream costs cost of the node's cpu.
+    """
+    def __init__(self, cost=0.1, base=0.05):
+        self.cost = cost
+        self.base = base
+        self.streams = set()
+
+    def start(self, spec):
+        self.streams.add(spec['sid'])
+
+    def stop(self, sid):
+        self.streams.discard(sid)
+
+    def load(self):
+        return self.base + self.cost * len(self.streams)
+
+
+def _mqtt_client(nodeId, host, port, keepalive, will=True):
+    import paho.mqtt.client as mqtt
+    client = mqtt.Client(client_id=nodeId)
+    if will:
+        client.will_set(config.MQTT_SERVICE_DOWN_TOPIC,
+            payload=json.dumps({"id": nodeId}), qos=1)
+    client.connect_async(host, port, keepalive)
+    return client
+
+def run_node(nodeId, host=config.MQTT_BROKER_IP, port=config.MQTT_BROKER_PORT,
+        reportInterval=1, keepalive=2, cost=0.1):
+    """ A simulated node process for simulate(). """
+    sim = SimulatedStreams(cost)
+    client = _mqtt_client(nodeId, host, port, keepalive)
+    agent = NodeAgent(client, nodeId, sim.start, sim.stop,
+        reportInterval=reportInterval, load=sim.load)
+    client.loop_start()
+    agent.start()
+    while True:
+        time.sleep(60)
+
+def simulate(nodes=4, streams=16, host="127.0.0.1", port=18830,
+        reportInterval=1, keepalive=2, cost=0.1):
+    """ Run nodes simulated node processes and a coordinator against a
+        mosquitto on port (started if mosquitto is installed), place
+        streams, kill a node and report placement and failover times.
+    """
+    import shutil
+    import signal
+    import socket
+    import subprocess
+    import sys
+
+    procs = []
+    if shutil.which("mosquitto"):
+        procs.append(subprocess.Popen(["mosquitto", "-p", str(port)],
+            stderr=subprocess.DEVNULL))
+        for i in range(50):
+            try:
+                socket.create_connection((host, port), 0.2).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+    nodeIds = ["sim%d" % i for i in range(nodes)]
+    for nodeId in nodeIds:
+        procs.append(subprocess.Popen([sys.executable,
+            os.path.abspath(__file__), "node", nodeId, host, str(port),
+            str(reportInterval), str(keepalive), str(cost)]))
+
+    client = _mqtt_client("coordinator", host, port, keepalive, will=False)
+    coordinator = Coordinator(client, reportInterval, cooldown=5)
+    client.loop_start()
+    coordinator.start()
+    try:
+        deadline = time.time() + 30
+        while len(coordinator.nodes) < nodes and time.time() < deadline:
+            time.sleep(0.1)
+        print("nodes up: %d" % len(coordinator.nodes))
+
+        for i in range(streams):
+            coordinator.place({'sid': "simcam%d" % i, 'src': [{'url': 'testsrc'}]})
+        deadline = time.time() + 30
+        while len(coordinator.placements) < streams and time.time() < deadline:
+            time.sleep(0.05)
+        times = sorted(t for sid, node, t in coordinator.placements)
+        print("placed %d/%d, placement time p50 %.3fs max %.3fs" % (len(times),
+            streams, times[len(times) // 2] if times else 0, times[-1] if times else 0))
+        print(coordinator.report()['nodes'])
+
+        victim = procs[-nodes]
+        victims = [sid for sid, e in coordinator.assignments.items()
+            if e['node'] == nodeIds[0]]
+        killed = time.time()
+        victim.send_signal(signal.SIGKILL)
+        deadline = time.time() + 60
+        while len(coordinator.failovers) < len(victims) and time.time() < deadline:
+            time.sleep(0.05)
+        detected = [t for sid, node, t in coordinator.failovers]
+        print("killed %s with %d streams, all running again after %.3fs "
+            "(keepalive %ds), failover after detection max %.3fs" % (
+            nodeIds[0], len(victims), time.time() - killed, keepalive,
+            max(detected) if detected else 0))
+        print(coordinator.report()['nodes'])
+    finally:
+        coordinator.stop()
+        client.loop_stop()
+        for p in procs:
+            p.kill()
+            p.wait()
+
+
+def unittest():
+    """ Placement, hot node rebalancing and failover against the in
+        process FakeBroker.
+    """
+    import sys
+    import mqttBridge
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format="%(asctime)s %(message)s")
+
+    broker = mqttBridge.FakeBroker()
+    cclient = mqttBridge.FakeClient(broker)
+    coordinator = Coordinator(cclient, reportInterval=1, cooldown=0, hotReports=1)
+    cclient.connect()
+    agents = {}
+    for nodeId, caps in (("a", ["cpu"]), ("b", ["cpu", "h264_vaapi"]), ("c", ["cpu"])):
+        sim = SimulatedStreams(cost=0.1)
+        client = mqttBridge.FakeClient(broker)
+        client.will_set(config.MQTT_SERVICE_DOWN_TOPIC, _encode({'id': nodeId}), 1)
+        agents[nodeId] = (NodeAgent(client, nodeId, sim.start, sim.stop, caps,
+            load=sim.load), sim, client)
+        client.connect()
+
+    for i in range(6):
+        coordinator.place({'sid': "cam%d" % i})
+    coordinator.place({'sid': "hw", 'requires': ["h264_vaapi"]})
+    for agent, sim, client in agents.values():
+        agent.report()
+    counts = dict((n, len(sim.streams)) for n, (a, sim, c) in agents.items())
+    assert sum(counts.values()) == 7 and max(counts.values()) - min(counts.values()) <= 1, counts
+    assert "hw" in agents["b"][1].streams
+    assert len(coordinator.placements) == 7
+
+    # a node running hot sheds a stream to the others
+    agents["a"][1].base = 0.9
+    agents["a"][0].report()
+    coordinator.sweep()
+    assert len(agents["a"][1].streams) == counts["a"] - 1, agents["a"][1].streams
+    assert len(coordinator.moves) == 1
+
+    # failover, b dies and its streams restart elsewhere, hw fits nowhere
+    broker.kill(agents["b"][2])
+    assert "hw" in coordinator.unplaced
+    assert sum(len(agents[n][1].streams) for n in "ac") == 6
+    assert len(coordinator.failovers) == len(agents["b"][1].streams) - 1
+    logging.info("cluster ok: %s" % str(coordinator.report()))
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "node":
+        logging.basicConfig(level=logging.WARNING)
+        run_node(sys.argv[2], sys.argv[3], int(sys.argv[4]), float(sys.argv[5]),
+            int(sys.argv[6]), float(sys.argv[7]))
+    elif len(sys.argv) > 1 and sys.argv[1] == "simulate":
+        logging.basicConfig(level=logging.WARNING)
+        simulate(*[int(a) for a in sys.argv[2:4]])
+    else:
+        unittest()
@@ -1,6 +1,7 @@
 import json
 import os 
 import logging
+import shutil
 
 DATA_DIR = "/opt/iffmpeg/"
 RAMDISK_DIR = DATA_DIR+"ramdisk" 
@@ -10,6 +11,17 @@ ASSETS_DIR = DATA_DIR+"assets"
 MQTT_BROKER_IP="localhost"
 MQTT_BROKER_PORT=1883
 MQTT_SERVICE_DOWN_TOPIC="worldview/node/down"
+MQTT_NODE_TOPIC="worldview/node"
+# seconds between batched stats messages, see mqttBridge.py
+MQTT_STATS_INTERVAL=10
+# json|msgpack|struct
+MQTT_ENCODING="json"
+# messages kept while the broker is unreachable
+MQTT_OFFLINE_QUEUE=1000
+# stream placement requests, see cluster.py
+MQTT_CLUSTER_TOPIC="worldview/cluster"
+# seconds between node load reports
+CLUSTER_REPORT_INTERVAL=5
 
 def StreamInputTopic(streamId): 
     return streamId+"-input-chunk"
@@ -21,12 +33,30 @@ def StreamStopTopic(streamId):
     return streamId+"-stop"
 def StreamFaultTopic(streamId):
     return streamId+"-fault"
+def StreamAnalyticsTopic(streamId):
+    return streamId+"-analytics"
+def StreamOutputTopic(streamId, name):
+    return streamId+"-output-"+name
+def StreamFrameTopic(streamId):
+    return streamId+"-frame"
 
 STREAM_CREATE_TOPIC="create"
 
 CurrentPath = os.path.dirname(os.path.realpath(__file__))
-FFMPEG = os.popen("which ffmpeg").read()[:-1]
-FFPROBE = os.popen("which ffprobe").read()[:-1]
+# FFMPEG and FFPROBE are looked up on PATH when first used, see
+# __getattr__, assign them to use other binaries
+_BINARIES = {'FFMPEG': "ffmpeg", 'FFPROBE': "ffprobe"}
+
+# count and time every signals handler, see metrics.py
+SIGNALS_METRICS=True
+METRICS_PORT=9108
+# low latency HLS from memory, see hlsServer.py. Served on loopback,
+# set HLS_HOST to "0.0.0.0" to serve players on other hosts
+HLS_HOST="127.0.0.1"
+HLS_PORT=8090
+
+# stamp video chunks and record pipe to subscriber delays, see latency.py
+LATENCY_TRACING=True
 
 STREAM_STATE_IDLE="idle"
 STREAM_STATE_STARTING="starting"
@@ -36,6 +66,13 @@ STREAM_STATE_PLAYING="playing"
 
 
 
+def __getattr__(name):
+    if name in _BINARIES:
+        path = shutil.which(_BINARIES[name]) or _BINARIES[name]
+        globals()[name] = path
+        return path
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
 def load(filename):
     if os.access(filename,os.F_OK):
         return json.loads(open(filename).read())
@@ -0,0 +1,125 @@
+"""
+Compiles the outputs of a stream into a single ffmpeg invocation so an
+input is decoded once no matter how many stages use it.
+
+    [0:v] --> split --+--> relay      (avi on the input stream pipe)
+                      +--> fps=1/3 --> snapshot   (mjpeg image2pipe)
+                      +--> fps,scale,gray --> analytics (rawvideo)
+                      +--> fps,scale --> transcode  (desturl, see transcode.py)
+                      +--> fps,scale --> hls        (fmp4, see hlsServer.py)
+                                          (one encode with transcode when
+                                           both are set, tee muxer)
+    [0:v] -- copy --------> record     (no decode)
+
+Each Output describes the filters of its branch, the encoder/muxer
+arguments and where it goes. Outputs without a target are written to a
+pipe which InputStream reads and publishes on
+config.StreamOutputTopic(streamId, name), the relay keeps publishing on
+config.StreamInputTopic(streamId).
+"""
+import shlex
+
+OUTPUT_RELAY = "relay"
+OUTPUT_SNAPSHOT = "snapshot"
+OUTPUT_ANALYTICS = "analytics"
+OUTPUT_RECORD = "record"
+OUTPUT_TRANSCODE = "transcode"
+OUTPUT_HLS = "hls"
+
+
+class Output:
+    # stream copy the input instead of taking a branch of the decode
+    copy = False
+    # also map the input's audio
+    audio = False
+    # cores the branch's encoder keeps busy besides the decode, None for
+    # as many as there are, see placement
+    cores = 0
+
+    def __init__(self, name, filters=None, args="", target=None):
+        self.name = name
+        self.filters = filters
+        self.args = args
+        self.target = target
+
+    def pipes(self):
+        """ names of the pipes the output is written to, see compile() """
+        return [self.name] if self.target is None else []
+
+    def target_arg(self, fds):
+        """ ffmpeg's output argument, fds as for compile() """
+        return self.target or "pipe:%d" % fds[self.name]
+
+class RelayOutput(Output):
+    audio = True
+
+    def __init__(self):
+        Output.__init__(self, OUTPUT_RELAY, None, "-psnr -f avi")
+
+class SnapshotOutput(Output):
+    def __init__(self, interval=3):
+        Output.__init__(self, OUTPUT_SNAPSHOT, "fps=1/%d" % interval,
+            "-f image2pipe -c:v mjpeg")
+
+class AnalyticsOutput(Output):
+    def __init__(self, width=160, height=90, rate=4):
+        Output.__init__(self, OUTPUT_ANALYTICS,
+            "fps=%s,scale=%d:%d,format=gray" % (rate, width, height),
+            "-f rawvideo -pix_fmt gray")
+
+class RecordOutput(Output):
+    copy = True
+    audio = True
+
+    def __init__(self, target=None):
+        Output.__init__(self, OUTPUT_RECORD, None, "-f avi", target)
+
+
+def cores(outputs):
+    """ Cores an ffmpeg producing outputs keeps busy, one for the decode
+        plus those of the encoders, None if an encoder takes all cores.
+    """
+    extra = [o.cores for o in outputs]
+    if None in extra:
+        return None
+    return 1 + sum(extra)
+
+
+def compile(outputs, fds, source="[0:v]", graph=None):
+    """ The output half of the ffmpeg command line for outputs, fds maps
+        the name of each of their pipes() to its write end. graph is a list of filter chains producing the source label
+        for outputs of a composite (see videoWall), a composite has no
+        audio and is encoded even for copy outputs.
+    """
+    decoded = [o for o in outputs if not o.copy or graph]
+    labels = {}
+    chains = list(graph or [])
+    args = []
+
+    if len(decoded) > 1 or (decoded and decoded[0].filters):
+        if len(decoded) > 1:
+            chains.append("%ssplit=%d%s" % (source, len(decoded),
+                "".join("[s%d]" % i for i in range(len(decoded)))))
+            sources = ["[s%d]" % i for i in range(len(decoded))]
+        else:
+            sources = [source]
+        for i, o in enumerate(decoded):
+            if o.filters:
+                chains.append("%s%s[v%d]" % (sources[i], o.filters, i))
+                labels[o.name] = "[v%d]" % i
+            else:
+                labels[o.name] = sources[i]
+    if chains:
+        args += ["-filter_complex", ";".join(chains)]
+
+    for o in outputs:
+        if o.copy and not graph:
+            args += ["-map", "0:v", "-c:v", "copy"]
+        else:
+            args += ["-map", labels.get(o.name, source if graph else "0:v")]
+        if o.audio and not graph:
+            args += ["-map", "0:a?"]
+        args += shlex.split(o.args)
+        args.append(o.target_arg(fds))
+
+    return " ".join(shlex.quote(a) for a in args)
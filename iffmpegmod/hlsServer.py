@@ -0,0 +1,549 @@
+#!/usr/bin/env python
+"""
+Low latency HLS served from memory.
+
+A stream with hls set gets an extra branch in its ffmpeg (output())
+encoding with the node's transcode profile to fragmented MP4 on a pipe,
+a fragment at least every partDuration seconds and a keyframe every
+segmentDuration seconds. A stream that also has a desturl encodes once,
+its transcode branch writes the desturl and the HLS pipe with the tee
+muxer. The fragments are published on
+config.StreamOutputTopic(sid, filterGraph.OUTPUT_HLS) and turned into
+LL-HLS here:
+
+    init.mp4        ftyp + moov
+    seg<N>.<P>.m4s  partial segment, one moof + mdat
+    seg<N>.m4s      segment, its parts back to back, starting at a
+                    keyframe
+    index.m3u8      playlist with EXT-X-PART, a preload hint for the
+                    next part and blocking reloads
+
+Parts and segments are only kept in memory, the latest maxSegments
+segments and no more than maxBytes. A playlist request with _HLS_msn
+(and _HLS_part) waits until that part exists, a request for the hinted
+part waits until ffmpeg produced it, so players pick up a part as soon
+as it is complete instead of polling a directory nginx serves.
+
+    http://<node>:HLS_PORT/<sid>/index.m3u8
+
+The HTTP server is a minimal asyncio HTTP/1.1 server on its own thread,
+GET only. It listens on config.HLS_HOST, loopback unless configured
+otherwise, for a reverse proxy in front of it.
+"""
+import asyncio
+import logging
+import math
+import struct
+import threading
+import urllib.parse
+import config
+import filterGraph
+import signals
+import transcode
+
+PART_DURATION = 0.5
+SEGMENT_DURATION = 2.0
+MAX_SEGMENTS = 6
+MAX_BYTES = 32 << 20
+
+# trun/tfhd sample flag, set for frames that are not sync samples
+_NON_SYNC = 0x10000
+
+_BOX = struct.Struct(">I4s")
+
+
+def output(partDuration=PART_DURATION, segmentDuration=SEGMENT_DURATION, tuned=None,
+        desturl=None):
+    """ The transcode output feeding the HLS server, video only. With
+        desturl it is the transcode output to desturl, the HLS fragments
+        are a second output of its encode.
+    """
+    keyframes = "-force_key_frames expr:gte(t,n_forced*%g)" % segmentDuration
+    movflags = "+frag_keyframe+empty_moov+default_base_moof"
+    fragment = partDuration * 1000000
+    if desturl:
+        # a failing HLS pipe must not stop the push to desturl
+        return transcode.output(desturl, tuned, tee=(filterGraph.OUTPUT_HLS, keyframes,
+            "f=mp4:select=v:onfail=ignore:movflags=%s:frag_duration=%d" % (
+            movflags, fragment)))
+    o = transcode.output(None, tuned,
+        fmt="-an %s -f mp4 -movflags %s -frag_duration %d" % (
+            keyframes, movflags, fragment),
+        name=filterGraph.OUTPUT_HLS)
+    o.audio = False
+    return o
+
+
+def _boxes(data, pos, end):
+    """ (type, payload start, box end) of the boxes in data[pos:end] """
+    while pos + 8 <= end:
+        size, kind = _BOX.unpack_from(data, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            return
+        yield kind, pos + header, pos + size
+        pos += size
+
+def _child(data, pos, end, kind):
+    for k, p, e in _boxes(data, pos, end):
+        if k == kind:
+            return p, e
+    return None
+
+
+class Fmp4Parser:
+    """ Splits a fragmented MP4 byte stream into the init segment and
+        fragments, with the duration of each fragment and whether it
+        starts with a keyframe, taken from the video track.
+    """
+    def __init__(self):
+        self.buf = bytearray()
+        self.init = None
+        self.pending_init = bytearray()
+        self.moof = None
+        # video track id, timescale and trex default duration and flags
+        self.track = None
+        self.timescale = 90000
+        self.defaults = (0, 0)
+
+    def feed(self, data):
+        """ ('init', bytes) and ('part', bytes, seconds, independent)
+            items completed by data.
+        """
+        self.buf += data
+        done = []
+        pos = 0
+        for kind, start, end in _boxes(self.buf, 0, len(self.buf)):
+            if end > len(self.buf):
+                break
+            box = bytes(self.buf[pos:end])
+            pos = end
+            if kind == b"moov":
+                self._parse_moov(box)
+                self.init = bytes(self.pending_init) + box
+                self.pending_init = bytearray()
+                done.append(('init', self.init))
+            elif kind == b"ftyp":
+                # a new init segment follows, ffmpeg restarted
+                self.pending_init = bytearray(box)
+                self.moof = None
+            elif kind == b"moof":
+                self.moof = box
+            elif kind == b"mdat" and self.moof is not None:
+                duration, independent = self._parse_moof(self.moof)
+                done.append(('part', self.moof + box, duration, independent))
+                self.moof = None
+        del self.buf[:pos]
+        return done
+
+    def _parse_moov(self, moov):
+        trex = {}
+        for kind, p, e in _boxes(moov, 8, len(moov)):
+            if kind == b"trak":
+                tkhd = _child(moov, p, e, b"tkhd")
+                mdia = _child(moov, p, e, b"mdia")
+                if not tkhd or not mdia:
+                    continue
+                hdlr = _child(moov, mdia[0], mdia[1], b"hdlr")
+                if not hdlr or moov[hdlr[0] + 8:hdlr[0] + 12] != b"vide":
+                    continue
+                version = moov[tkhd[0]]
+                self.track = struct.unpack_from(">I", moov,
+                    tkhd[0] + (20 if version == 1 else 12))[0]
+                mdhd = _child(moov, mdia[0], mdia[1], b"mdhd")
+                version = moov[mdhd[0]]
+                self.timescale = struct.unpack_from(">I", moov,
+                    mdhd[0] + (20 if version == 1 else 12))[0]
+            elif kind == b"mvex":
+                for k, q, f in _boxes(moov, p, e):
+                    if k == b"trex":
+                        track, index, duration, size, flags = \
+                            struct.unpack_from(">IIIII", moov, q + 4)
+                        trex[track] = (duration, flags)
+        self.defaults = trex.get(self.track, (0, 0))
+
+    def _parse_moof(self, moof):
+        """ (seconds, independent) of the video track in moof """
+        duration = 0
+        independent = True
+        for kind, p, e in _boxes(moof, 8, len(moof)):
+            if kind != b"traf":
+                continue
+            tfhd = _child(moof, p, e, b"tfhd")
+            flags = struct.unpack_from(">I", moof, tfhd[0])[0] & 0xffffff
+            track = struct.unpack_from(">I", moof, tfhd[0] + 4)[0]
+            if self.track is not None and track != self.track:
+                continue
+            default_duration, default_flags = self.defaults
+            q = tfhd[0] + 8
+            if flags & 0x1:
+                q += 8
+            if flags & 0x2:
+                q += 4
+            if flags & 0x8:
+                default_duration = struct.unpack_from(">I", moof, q)[0]
+                q += 4
+            if flags & 0x10:
+                q += 4
+            if flags & 0x20:
+                default_flags = struct.unpack_from(">I", moof, q)[0]
+            first = True
+            for k, r, f in _boxes(moof, p, e):
+                if k != b"trun":
+                    continue
+                tflags = struct.unpack_from(">I", moof, r)[0] & 0xffffff
+                count = struct.unpack_from(">I", moof, r + 4)[0]
+                q = r + 8
+                if tflags & 0x1:
+                    q += 4
+                first_flags = None
+                if tflags & 0x4:
+                    first_flags = struct.unpack_from(">I", moof, q)[0]
+                    q += 4
+                for i in range(count):
+                    sample_duration = default_duration
+                    sample_flags = default_flags
+                    if tflags & 0x100:
+                        sample_duration = struct.unpack_from(">I", moof, q)[0]
+                        q += 4
+                    if tflags & 0x200:
+                        q += 4
+                    if tflags & 0x400:
+                        sample_flags = struct.unpack_from(">I", moof, q)[0]
+                        q += 4
+                    if tflags & 0x800:
+                        q += 4
+                    if first:
+                        if i == 0 and first_flags is not None:
+                            sample_flags = first_flags
+                        independent = not sample_flags & _NON_SYNC
+                        first = False
+                    duration += sample_duration
+        return duration / float(self.timescale), independent
+
+
+class _Segment:
+    def __init__(self, msn):
+        self.msn = msn
+        # [(bytes, seconds, independent)]
+        self.parts = []
+        self.duration = 0.0
+        self.complete = False
+        self.size = 0
+
+
+class HlsStream:
+    """ The segments of one stream, fed on the publishing thread and
+        served from the server's event loop.
+    """
+    def __init__(self, sid, partDuration=PART_DURATION,
+            segmentDuration=SEGMENT_DURATION, maxSegments=MAX_SEGMENTS,
+            maxBytes=MAX_BYTES):
+        self.sid = sid
+        self.partDuration = partDuration
+        self.segmentDuration = segmentDuration
+        self.maxSegments = maxSegments
+        self.maxBytes = maxBytes
+        self.parser = Fmp4Parser()
+        self.init = None
+        self.segments = []
+        self.next_msn = 0
+        self.size = 0
+        self.target = int(math.ceil(segmentDuration))
+        self.part_target = partDuration
+        self.lock = threading.Lock()
+        # set by the server, woken on every new part
+        self.loop = None
+        self.event = None
+        self.on_stop = None
+
+    def feed(self, chunk):
+        with self.lock:
+            items = self.parser.feed(chunk)
+            for item in items:
+                if item[0] == 'init':
+                    if self.init is not None and item[1] != self.init:
+                        # new encoder parameters, start a new segment
+                        self._close()
+                    self.init = item[1]
+                else:
+                    self._add(*item[1:])
+        if items and self.loop:
+            self.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        event, self.event = self.event, asyncio.Event()
+        event.set()
+
+    def _close(self):
+        if self.segments and not self.segments[-1].complete:
+            seg = self.segments[-1]
+            seg.complete = True
+            self.target = max(self.target, int(math.ceil(seg.duration)))
+
+    def _add(self, data, duration, independent):
+        seg = self.segments[-1] if self.segments else None
+        if seg is None or seg.complete or \
+                (independent and seg.duration >= self.segmentDuration * 0.95):
+            self._close()
+            seg = _Segment(self.next_msn)
+            self.next_msn += 1
+            self.segments.append(seg)
+        if not seg.parts and not independent and len(self.segments) == 1:
+            # wait for a keyframe to start the first segment
+            self.segments.pop()
+            self.next_msn -= 1
+            return
+        seg.parts.append((data, duration, independent))
+        seg.duration += duration
+        seg.size += len(data)
+        self.size += len(data)
+        self.part_target = max(self.part_target, duration)
+        while len(self.segments) > 1 and (len(self.segments) > self.maxSegments + 1 or
+                self.size > self.maxBytes):
+            self.size -= self.segments.pop(0).size
+
+    def has(self, msn, part=None):
+        """ Whether the playlist has part of segment msn, or the whole
+            segment if part is None.
+        """
+        with self.lock:
+            if not self.segments:
+                return False
+            last = self.segments[-1]
+            if msn < last.msn:
+                return True
+            if msn > last.msn:
+                return False
+            if part is None:
+                return last.complete
+            return part < len(last.parts)
+
+    def next_part(self):
+        """ (msn, part) of the part ffmpeg is producing """
+        with self.lock:
+            if not self.segments:
+                return (self.next_msn, 0)
+            last = self.segments[-1]
+            if last.complete:
+                return (last.msn + 1, 0)
+            return (last.msn, len(last.parts))
+
+    def find(self, msn, part=None):
+        """ bytes of a part or the list of part bytes of a segment """
+        with self.lock:
+            for seg in self.segments:
+                if seg.msn != msn:
+                    continue
+                if part is None:
+                    return [p[0] for p in seg.parts] if seg.complete else None
+                return seg.parts[part][0] if part < len(seg.parts) else None
+        return None
+
+    def playlist(self):
+        with self.lock:
+            part_target = self.part_target
+            lines = [
+                "#EXTM3U",
+                "#EXT-X-VERSION:9",
+                "#EXT-X-TARGETDURATION:%d" % self.target,
+                "#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK=%.3f" % (
+                    3 * part_target),
+                "#EXT-X-PART-INF:PART-TARGET=%.3f" % part_target,
+                "#EXT-X-MEDIA-SEQUENCE:%d" % (self.segments[0].msn if self.segments else 0),
+                '#EXT-X-MAP:URI="init.mp4"',
+            ]
+            hint = (self.next_msn, 0)
+            for seg in self.segments:
+                for i, (data, duration, independent) in enumerate(seg.parts):
+                    lines.append('#EXT-X-PART:DURATION=%.5f,URI="seg%d.%d.m4s"%s' % (
+                        duration, seg.msn, i, ",INDEPENDENT=YES" if independent else ""))
+                if seg.complete:
+                    lines.append("#EXTINF:%.5f," % seg.duration)
+                    lines.append("seg%d.m4s" % seg.msn)
+                else:
+                    hint = (seg.msn, len(seg.parts))
+            lines.append('#EXT-X-PRELOAD-HINT:TYPE=PART,URI="seg%d.%d.m4s"' % hint)
+            return ("\n".join(lines) + "\n").encode()
+
+
+class HlsServer(threading.Thread):
+    def __init__(self, port=config.HLS_PORT, host=config.HLS_HOST):
+        threading.Thread.__init__(self, name="hls-server")
+        self.daemon = True
+        self.port = port
+        self.host = host
+        self.streams = {}
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.server = None
+
+    def add(self, sid, **opts):
+        """ Serve the HLS output of stream sid, opts go to HlsStream. """
+        stream = HlsStream(sid, **opts)
+        def attach():
+            stream.event = asyncio.Event()
+            stream.loop = self.loop
+        self.loop.call_soon_threadsafe(attach)
+        self.streams[sid] = stream
+        stream.on_stop = lambda: self.remove(sid)
+        signals.subscribe(config.StreamOutputTopic(sid, filterGraph.OUTPUT_HLS),
+            stream.feed)
+        signals.subscribe(config.StreamStopTopic(sid), stream.on_stop)
+        return stream
+
+    def remove(self, sid):
+        stream = self.streams.pop(sid, None)
+        if stream:
+            signals.unsubscribe(config.StreamOutputTopic(sid, filterGraph.OUTPUT_HLS),
+                stream.feed)
+            signals.unsubscribe(config.StreamStopTopic(sid), stream.on_stop)
+
+    async def _wait(self, stream, ready, timeout):
+        """ Wait until ready() or timeout seconds, returns ready(). """
+        deadline = self.loop.time() + timeout
+        while not ready():
+            remaining = deadline - self.loop.time()
+            if remaining <= 0 or stream.event is None:
+                return False
+            try:
+                await asyncio.wait_for(stream.event.wait(), remaining)
+            except asyncio.TimeoutError:
+                return ready()
+        return True
+
+    async def _get(self, path, query):
+        """ (status, content type, [bytes], cache control) for a GET """
+        parts = path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] not in self.streams:
+            return 404, "text/plain", [b"not found\n"], "no-cache"
+        stream = self.streams[parts[0]]
+        name = parts[1]
+
+        if name == "index.m3u8":
+            if '_HLS_msn' in query:
+                try:
+                    msn = int(query['_HLS_msn'][0])
+                    part = int(query['_HLS_part'][0]) if '_HLS_part' in query else None
+                except ValueError:
+                    return 400, "text/plain", [b"bad request\n"], "no-cache"
+                if msn > stream.next_part()[0] + 2:
+                    return 400, "text/plain", [b"msn too far ahead\n"], "no-cache"
+                if not await self._wait(stream, lambda: stream.has(msn, part),
+                        3 * stream.target):
+                    return 503, "text/plain", [b"timed out\n"], "no-cache"
+            return 200, "application/vnd.apple.mpegurl", [stream.playlist()], "no-cache"
+
+        if name == "init.mp4":
+            if not await self._wait(stream, lambda: stream.init is not None,
+                    3 * stream.target):
+                return 404, "text/plain", [b"not found\n"], "no-cache"
+            return 200, "video/mp4", [stream.init], "max-age=60"
+
+        if name.startswith("seg") and name.endswith(".m4s"):
+            try:
+                numbers = [int(n) for n in name[3:-4].split('.')]
+            except ValueError:
+                return 404, "text/plain", [b"not found\n"], "no-cache"
+            msn = numbers[0]
+            part = numbers[1] if len(numbers) > 1 else None
+            data = stream.find(msn, part)
+            if data is None and part is not None and (msn, part) == stream.next_part():
+                # the preload hint, answer once ffmpeg delivers it
+                await self._wait(stream, lambda: stream.has(msn, part),
+                    3 * stream.part_target)
+                data = stream.find(msn, part)
+            if data is None:
+                return 404, "text/plain", [b"not found\n"], "no-cache"
+            return 200, "video/mp4", data if isinstance(data, list) else [data], \
+                "max-age=60"
+
+        return 404, "text/plain", [b"not found\n"], "no-cache"
+
+    async def _client(self, reader, writer):
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    k, _, v = line.decode('latin-1').partition(':')
+                    headers[k.strip().lower()] = v.strip()
+                fields = request.decode('latin-1').split()
+                if len(fields) != 3:
+                    break
+                method, target, version = fields
+                url = urllib.parse.urlsplit(target)
+                if method not in ("GET", "HEAD"):
+                    status, ctype, body, cache = 405, "text/plain", [b"GET only\n"], "no-cache"
+                else:
+                    status, ctype, body, cache = await self._get(url.path,
+                        urllib.parse.parse_qs(url.query))
+                keep = version == "HTTP/1.1" and headers.get('connection') != "close"
+                head = ("HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n"
+                    "Cache-Control: %s\r\nAccess-Control-Allow-Origin: *\r\n"
+                    "Connection: %s\r\n\r\n" % (status, _REASONS.get(status, ""), ctype,
+                    sum(len(b) for b in body), cache, "keep-alive" if keep else "close"))
+                writer.write(head.encode())
+                if method == "GET":
+                    writer.writelines(body)
+                await writer.drain()
+                if not keep:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except:
+            logging.exception("hls server request failed")
+        finally:
+            writer.close()
+
+    async def _serve(self):
+        self.server = await asyncio.start_server(self._client, self.host, self.port)
+        self.ready.set()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._serve())
+        except asyncio.CancelledError:
+            pass
+        except:
+            logging.exception("hls server failed")
+            self.ready.set()
+
+    def stop(self):
+        if self.server:
+            self.loop.call_soon_threadsafe(self.server.close)
+
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found",
+    405: "Method Not Allowed", 503: "Service Unavailable"}
+
+_server = None
+_server_lock = threading.Lock()
+
+def service():
+    """ The node's HLS server, started on first use. """
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = HlsServer()
+            _server.start()
+            _server.ready.wait(5)
+        return _server
+
+
+def onStreamCreate(stream):
+    if stream.hls:
+        return service().add(stream.sid)
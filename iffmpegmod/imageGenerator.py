@@ -5,30 +5,112 @@ import shlex
 import time
 import logging
 import atexit
+import threading
 import signals
 import readline
+import filterGraph
+import latency
+import placement
+import capabilities
+
+SNAPSHOT_MODE_FILE = "file"
+SNAPSHOT_MODE_PIPE = "pipe"
+SNAPSHOT_MODE_GRAPH = "graph"
+
+
+class JpegFramer:
+    """ Splits a byte stream of concatenated JPEG images, such as the
+        output of '-f image2pipe -c:v mjpeg', on the SOI/EOI markers.
+        0xFFD9 can not appear inside the entropy coded data (0xFF is
+        stuffed) so the first EOI after an SOI ends the image.
+    """
+    SOI = b'\xff\xd8'
+    EOI = b'\xff\xd9'
+
+    def __init__(self, maxSize=0x400000):
+        self.buf = bytearray()
+        self.maxSize = maxSize
+        # offset to resume the EOI search from
+        self.scan = 2
+
+    def feed(self, data):
+        """ Returns the list of images completed by data.
+        """
+        self.buf += data
+        images = []
+        while True:
+            start = self.buf.find(self.SOI)
+            if start == -1:
+                # keep a trailing 0xFF which may be half a marker
+                del self.buf[:-1]
+                self.scan = 2
+                break
+            if start > 0:
+                del self.buf[:start]
+                self.scan = 2
+            end = self.buf.find(self.EOI, self.scan)
+            if end == -1:
+                self.scan = max(len(self.buf) - 1, 2)
+                if len(self.buf) > self.maxSize:
+                    logging.error("JpegFramer: image larger than %d bytes dropped" %
+                        self.maxSize)
+                    del self.buf[:]
+                    self.scan = 2
+                break
+            images.append(bytes(self.buf[:end + 2]))
+            del self.buf[:end + 2]
+            self.scan = 2
+        return images
+
 
 class ImageGenerator:
     """ Listens to the <streamId>/input topic for chunks of video data 
-        then feeds them to ffmpeg that in turn generates an image
-        in the ram directory. Once a new image has been generated 
-        this class generates <streamId>/snapshot message.
+        then feeds them to ffmpeg that in turn generates an image.
+
+        In file mode the image is written to the ram directory and the
+        filename is published on the image topic once it changes. In
+        pipe mode ffmpeg writes MJPEG to a pipe, images are split in
+        memory and the JPEG bytes are published as soon as each one is
+        complete, no files or stat polling involved. The pipe is drained
+        on a thread of its own: an image can be larger than the pipe
+        buffer and ffmpeg stops reading its input while its output is
+        full, reading stdout only between writes to stdin would
+        deadlock. In graph mode the
+        input's own ffmpeg produces the MJPEG (filterGraph.SnapshotOutput)
+        and no second decoder is started.
     """
-    def __init__(self, streamId, interval=3):
+    def __init__(self, streamId, interval=3, mode=SNAPSHOT_MODE_FILE):
         
         self.imgfile = config.RAMDISK_DIR + "/%s.jpg" % streamId
         self.sid = streamId
+        self.mode = mode
         self.last_mtime = None
         self.subscribed = False
+        self.framer = JpegFramer()
         
         self.vin_r,self.vin_w = os.pipe()
-        cmdfmt = "%s -re -loglevel -8 -i pipe:%d -r 1/%d -f image2 -update 1 %s"
-        self.cmd = cmdfmt % (config.FFMPEG,self.vin_r,interval,self.imgfile)
+        if mode == SNAPSHOT_MODE_GRAPH:
+            # no ffmpeg of our own, don't look at its capabilities
+            rate = ""
+        elif capabilities.get().has_filter("fps"):
+            # the fps filter picks the frame closest to each tick, -r
+            # only drops frames
+            rate = "-vf fps=1/%d" % interval
+        else:
+            rate = "-r 1/%d" % interval
+        if mode == SNAPSHOT_MODE_PIPE:
+            cmdfmt = "%s -re -loglevel -8 -i pipe:%d %s -f image2pipe -c:v mjpeg pipe:1"
+            self.cmd = cmdfmt % (config.FFMPEG,self.vin_r,rate)
+        else:
+            cmdfmt = "%s -re -loglevel -8 -i pipe:%d %s -f image2 -update 1 %s"
+            self.cmd = cmdfmt % (config.FFMPEG,self.vin_r,rate,self.imgfile)
         self.si_topic = config.StreamInputTopic(self.sid) 
+        self.snap_topic = config.StreamOutputTopic(self.sid, filterGraph.OUTPUT_SNAPSHOT)
         self.img_topic = config.ImageTopic(self.sid) 
         self.stop_topic = config.StreamStopTopic(self.sid) 
        
         self.proc = None
+        self.reader = None
 
     def __del__(self):
         try: 
@@ -50,19 +132,49 @@ class ImageGenerator:
             return 
  
         os.write(self.vin_w,data)
-        if os.access(self.imgfile,os.F_OK):
+        if self.mode != SNAPSHOT_MODE_PIPE and os.access(self.imgfile,os.F_OK):
             mtime = os.stat(self.imgfile) 
             logging.info("mtime = %s" % str(mtime))
             if not self.last_mtime or mtime != self.last_mtime:
+                if latency.enabled:
+                    latency.record_current('image')
                 signals.publish(self.img_topic, self.imgfile)
                 self.last_mtime = mtime
           
 
+    def _frame_images(self, data):
+        for image in self.framer.feed(data):
+            if latency.enabled:
+                latency.record_current('image')
+            signals.publish(self.img_topic, image)
+
+    def _read_images(self, stdout):
+        # runs until ffmpeg exits and closes its end of the pipe
+        while True:
+            try:
+                data = os.read(stdout.fileno(), 0x10000)
+            except (OSError, ValueError):
+                return
+            if not data:
+                return
+            try:
+                self._frame_images(data)
+            except:
+                logging.exception("imageGenerator: publishing image failed")
+
     def start(self):
         # listen for data from the streamInput object, route to
         # internal process that generates 
+        if self.mode == SNAPSHOT_MODE_GRAPH:
+            if not self.subscribed:
+                signals.subscribe(self.snap_topic,self._frame_images)
+                signals.subscribe(self.stop_topic,self.stop)
+                self.subscribed = True
+            return
+
         if not self.subscribed: 
-            signals.subscribe(self.si_topic,self.feed)
+            # feed from a queue so a slow ffmpeg never stalls the input stream
+            signals.subscribe_async(self.si_topic,self.feed,maxsize=16)
             signals.subscribe(self.stop_topic,self.stop)
             self.subscribed = True
 
@@ -70,7 +182,18 @@ class ImageGenerator:
             os.remove(self.imgfile)
   
         logging.info(self.cmd) 
-        self.proc = subprocess.Popen(shlex.split(self.cmd),shell=False)
+        if self.mode == SNAPSHOT_MODE_PIPE:
+            self.framer = JpegFramer()
+            self.proc = subprocess.Popen(shlex.split(self.cmd),shell=False,
+                pass_fds=(self.vin_r,),stdout=subprocess.PIPE)
+            self.reader = threading.Thread(target=self._read_images,
+                args=(self.proc.stdout,), name="snapshot-%s" % self.sid)
+            self.reader.daemon = True
+            self.reader.start()
+        else:
+            self.proc = subprocess.Popen(shlex.split(self.cmd),shell=False,
+                pass_fds=(self.vin_r,))
+        placement.service().place(self.proc.pid, self.sid, placement.STAGE_SNAPSHOT)
         atexit.register(self.stop)
 
     def stop(self):
@@ -79,14 +202,21 @@ class ImageGenerator:
             retval = self.proc.poll()
             if not retval: 
                 self.proc.kill()
-                self.proc.communicate(b'')
+                self.proc.wait()
+            if self.reader:
+                self.reader.join(1)
+                self.reader = None
+                self.proc.stdout.close()
             self.proc = None
 
 
 def onStreamCreate(stream):
-    gen = ImageGenerator(stream['streamId'])
-    
-    
+    # the input's ffmpeg produces the snapshots, see Stream.outputs()
+    if stream.snapshotInterval:
+        gen = ImageGenerator(stream.sid, stream.snapshotInterval,
+            SNAPSHOT_MODE_GRAPH)
+        gen.start()
+        return gen
 
 
 
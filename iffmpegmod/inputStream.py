@@ -7,7 +7,8 @@ module to listeners.
 The inputStream object is responsible for:
 
 1. automatic restarts of the stream if no output is received after
-a configurable amount of time (default 180 seconds).
+a configurable amount of time (default 180 seconds), when to restart
+is up to the supervisor.
 2. gathers bit rate stats
 3. Probes input with ffprobe if this is first time the url
    is used and if there have been more than 3 failed restarts,
@@ -19,10 +20,36 @@ Configuration spec:
 {
     url: "...",
     maxInActvity: 180, # 180 seconds with output and the stream input has failed
-    retryAfter: 1800,  # 1800 seconds before stream is restarted
-    streamId: "..."
+    retryAfter: 1800,  # longest wait before a faulted stream is restarted
+    streamId: "...",
+    chunkSize: 65535,  # size of each ring buffer slot
+    ringSlots: 32,     # number of preallocated slots
+    ringMaxSlots: 256, # slots the ring may grow to while subscribers hold them
+    readBatch: 1,      # reads per wakeup used to fill a slot
+    statsInterval: 5,  # seconds between messages on the stats topic
+    sharedMemory: False, # also write the relay to a shmRing for other processes
+    sharedMemorySlots: 64,
+    frames: False,     # also publish the relay as aviDemux.Frame records
+    inputArgs: "",     # ffmpeg options for the input, e.g. -probesize
+    hwaccel: None,     # hardware decoder, "auto" for the first whose
+                       # device ffmpeg can open, software otherwise
+    outputs: [...]     # filterGraph outputs, default is the relay only
 }
 
+Video chunks are published as memoryview slices of a preallocated
+ring buffer, they are only valid for the duration of the callback
+unless retained with ringBuffer.retain(). With conf 'frames' the same
+bytes are split into frames and published on
+config.StreamFrameTopic(streamId), see aviDemux.
+
+All outputs are produced by one ffmpeg, see filterGraph. The relay is
+published on the stream input topic, other pipe outputs on
+config.StreamOutputTopic(streamId, name). Outputs can be attached and
+detached while running, ffmpeg is then restarted with the new graph.
+
+Stats messages are the latest progressParser.ProgressStats as a dict
+plus rolling aggregates for the last 10s and 60s under 'windows'.
+
 
 """
 import subprocess
@@ -37,13 +64,30 @@ import sys
 import time
 import signals
 import readline
+import fcntl
+import ringBuffer
+import progressParser
+import filterGraph
+import latency
+import metrics
+import shmRing
+import aviDemux
+import supervisor
+import placement
+import capabilities
 from nonblockingReadline import nonblockingReadline
 
-# input stream formats
+# input stream formats, stats are read from the -progress report on stdout
+# and the outputs are compiled by filterGraph
 _isfmt_http = "%s -re -reconnect_at_eof 1 -reconnect_streamed 1 " +\
-         "-reconnect_delay_max 2 -i %s -psnr -vstats -f avi pipe:%d"
-_isfmt = "%s -re -i %s -psnr -vstats -f avi pipe:%d"
-_isfmt_testsrc = "%s -re  -f lavfi -i testsrc=size=352x240:rate=15 -psnr -vstats -f avi pipe:%d"
+         "-reconnect_delay_max 2 %s-i %s -nostats -progress pipe:1 %s"
+_isfmt = "%s -re %s-i %s -nostats -progress pipe:1 %s"
+_isfmt_testsrc = "%s -re  -f lavfi -i testsrc=size=352x240:rate=15 -nostats -progress pipe:1 %s"
+
+# command pipe messages
+_CMD_STOP = b'x'
+_CMD_RELOAD = b'r'
+_CMD_RESTART = b's'
 
 
 
@@ -57,16 +101,39 @@ class InputStream(threading.Thread):
         self.conf = conf
         self.vout_r, self.vout_w = os.pipe()
         self.cmd_r, self.cmd_w = os.pipe()
+        fl = fcntl.fcntl(self.vout_r, fcntl.F_GETFL)
+        fcntl.fcntl(self.vout_r, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        self.ring = self._ring()
+        self.read_batch = conf.get('readBatch', 1)
+        self.progress = progressParser.ProgressParser()
+        self.stats = progressParser.ProgressAggregator()
+        self.stats_interval = conf.get('statsInterval', 5)
+        self.next_stats_time = 0
+        self.demuxer = aviDemux.Demuxer() if conf.get('frames') else None
+        self.shm = None
+        if conf.get('sharedMemory'):
+            self.shm = shmRing.ShmWriter(conf['streamId'],
+                conf.get('sharedMemorySlots', 64), conf.get('chunkSize', 0xFFFF))
+        self.outputs = list(conf.get('outputs') or [filterGraph.RelayOutput()])
+        # name -> (read fd, write fd, ring) of pipe outputs other than the relay
+        self.out_pipes = {}
+        self.lock = threading.Lock()
         self.proc = None
         self.iomap = {}
         self.sid = conf['streamId']
         self.si_topic = config.StreamInputTopic(self.sid)
         self.ss_topic = config.StreamInputStatsTopic(self.sid)
         self.sf_topic = config.StreamFaultTopic(self.sid)
+        self.fr_topic = config.StreamFrameTopic(self.sid)
         self.last_output_time = None
         self.state = config.STREAM_STATE_IDLE
+        self.admitted = False
+        metrics.register_stream(self)
 
     def __del__(self):
+        if self.shm:
+            self.shm.close()
+        self._sync_pipes([])
         try:
             os.close(self.vout_r)
             os.close(self.vout_w)
@@ -80,56 +147,117 @@ class InputStream(threading.Thread):
             self.proc.communicate(b'')
 
     def _line_proc(self, line):
-        logging.debug("line = %s" % line)
-        # process stats
-        # We're looking for this:
-        #  'frame=  138 fps= 11 q=31.0 PSNR=Y:30.88 U:36.31 V:37.12 *:32.10 size=     882kB'
-        t = line.split()
-        if len(t) > 0 and t[0] == 'frame=':
-            def translate(text):
-                text = text.replace('kB', ' * 1000')
-                text = text.replace('kbits/s', ' * 1000')
-                text = text.replace('M', ' * 1000000')
-                return eval(text)
-
-            def psnr(t):
-                 for tt in t:
-                     if tt.startswith('*:'):
-                         return float(tt[2:])
-                 return 0
-
-            def bitrate(line):
-                 pos = line.find('bitrate=')
-                 if pos > -1:
-                     pos += len('bitrate=')
-                     return line[pos:].split()[0]
-
-                 pos = line.find('size=')
-                 if pos > -1:
-                     return line[pos:].split()[1]
-  
-                 return "0"              
-
-
-            logging.debug(psnr)
-            input_stats = {
-                'fps': t[3],
-                # signal to noise ratio, in example: *:(32.10)
-                'psnr': psnr(t),
-                'bitrate': translate( bitrate(line) )
-            }
-            logging.debug("received stats: %s" % str(input_stats))
-            # route stats to whoever is listening
-            signals.publish(self.ss_topic, input_stats)
-
-    def _route_video(self, video_chunk):
+        """ Feed a line of ffmpeg's -progress output to the parser, the
+            aggregated stats are published every conf.statsInterval
+            seconds.
+        """
+        rec = self.progress.feed(line)
+        if rec:
+            self.stats.add(rec)
+            if rec.time >= self.next_stats_time:
+                self.next_stats_time = rec.time + self.stats_interval
+                report = self.stats.report()
+                if latency.enabled:
+                    report['latency'] = latency.summary(self.sid)
+                # route stats to whoever is listening
+                signals.publish(self.ss_topic, report)
+
+    def _stderr_proc(self, line):
+        logging.debug("ffmpeg %s: %s" % (self.sid, line))
+
+    def _route_video(self, video_chunk, t_read=None):
+        """ t_read is the time.monotonic() stamp of the read when latency
+            tracing is enabled.
+        """
         logging.debug(
             "_route_video: %d bytes of video received" %
             len(video_chunk))
+        if t_read:
+            latency.begin(self.sid, t_read)
         signals.publish(self.si_topic, video_chunk)
+        if self.demuxer:
+            self._route_frames(video_chunk)
+        if t_read:
+            latency.record(self.sid, 'publish', t_read)
+            latency.end()
+        if self.shm:
+            self.shm.write(video_chunk)
+        # drop the reader's reference to the ring slot
+        ringBuffer.release(video_chunk)
         self.state = config.STREAM_STATE_PLAYING
         self.last_output_time = time.time()
 
+    def _route_frames(self, video_chunk):
+        for item in self.demuxer.feed(video_chunk):
+            if isinstance(item, aviDemux.Frame):
+                signals.publish(self.fr_topic, item)
+                # drop the demuxer's references to the frame's parts
+                item.release()
+
+    def _route_output(self, name):
+        r, w, ring = self.out_pipes[name]
+        chunk = ring.readinto(r, self.read_batch)
+        if chunk:
+            if latency.enabled:
+                latency.begin(self.sid, latency.now())
+            signals.publish(config.StreamOutputTopic(self.sid, name), chunk)
+            if latency.enabled:
+                latency.end()
+            ringBuffer.release(chunk)
+            self.last_output_time = time.time()
+
+    def _sync_pipes(self, outputs):
+        """ Create a pipe for each output written to a pipe and close the
+            pipes of outputs that are gone, only called while ffmpeg is
+            not running.
+        """
+        names = set(name for o in outputs for name in o.pipes()
+            if name != filterGraph.OUTPUT_RELAY)
+        for name in list(self.out_pipes):
+            if name not in names:
+                r, w, ring = self.out_pipes.pop(name)
+                os.close(r)
+                os.close(w)
+        for name in names - set(self.out_pipes):
+            r, w = os.pipe()
+            os.set_blocking(r, False)
+            self.out_pipes[name] = (r, w, self._ring())
+
+    def _ring(self):
+        return ringBuffer.RingBuffer(self.conf.get('ringSlots', 32),
+            self.conf.get('chunkSize', 0xFFFF),
+            self.conf.get('ringMaxSlots', ringBuffer.MAX_SLOTS))
+
+    def ring_allocations(self):
+        """ temporary buffers allocated by the relay and output rings """
+        return self.ring.allocations + sum(p[2].allocations
+            for p in list(self.out_pipes.values()))
+
+    def ring_slots(self):
+        return len(self.ring.slots) + sum(len(p[2].slots)
+            for p in list(self.out_pipes.values()))
+
+    def out_fds(self):
+        """ read fd -> output name of the current pipe outputs """
+        return dict((p[0], name) for name, p in self.out_pipes.items())
+
+    def attach(self, output):
+        """ Add or replace an output, ffmpeg is restarted to apply it.
+        """
+        with self.lock:
+            self.outputs = [o for o in self.outputs if o.name != output.name] + [output]
+        os.write(self.cmd_w, _CMD_RELOAD)
+
+    def detach(self, name):
+        with self.lock:
+            self.outputs = [o for o in self.outputs if o.name != name]
+        os.write(self.cmd_w, _CMD_RELOAD)
+
+    def reload(self):
+        """ Restart ffmpeg with a newly compiled command line.
+        """
+        os.write(self.cmd_w, _CMD_RELOAD)
+
     def _inactivity_fault(self):
         """ Test to see if traffic was received from the output pipe conf.maxInActvity
             seconds ago.
@@ -143,38 +271,122 @@ class InputStream(threading.Thread):
             return True
         return False
 
-    def _while_ffmpeg_running(self):
-        """
-        launch ffmpeg
-             route output traffic to stream input topic
-             parse
-        """
+    def _exit_fault(self):
+        self.state = config.STREAM_STATE_FAULT
+        # the exit code may not be reaped yet when stdout hit eof
+        code = self.proc.poll()
+        signals.publish(self.sf_topic, {
+            'error': 'BadInput',
+            'desc': 'ffmpeg exited' if code is None else
+                'ffmpeg exited with code %d' % code
+        })
+
+    def _command(self, outputs):
+        fds = dict((name, p[1]) for name, p in self.out_pipes.items())
+        fds[filterGraph.OUTPUT_RELAY] = self.vout_w
+        graph = filterGraph.compile(outputs, fds)
+        inputArgs = self.conf.get('inputArgs')
+        inputArgs = inputArgs + " " if inputArgs else ""
+        hwaccel = self._hwaccel()
+        if hwaccel:
+            inputArgs = "-hwaccel %s %s" % (hwaccel, inputArgs)
+
         if self.conf['url'] == 'testsrc':
-            cmdargs = (config.FFMPEG, self.vout_w)
+            cmdargs = (config.FFMPEG, graph)
             cmd = _isfmt_testsrc % cmdargs
         elif self.conf['url'].startswith('http:'):
-            cmdargs = (config.FFMPEG, self.conf['url'], self.vout_w)
+            cmdargs = (config.FFMPEG, inputArgs, self.conf['url'], graph)
             cmd = _isfmt_http % cmdargs            
         else: 
-            cmdargs = (config.FFMPEG, self.conf['url'], self.vout_w)
+            cmdargs = (config.FFMPEG, inputArgs, self.conf['url'], graph)
             cmd = _isfmt % cmdargs
+        return cmd
+
+    def _hwaccel(self):
+        """ conf 'hwaccel' if the local ffmpeg has it, frames are copied
+            back to memory for the filters. "auto" is left to ffmpeg, it
+            falls back to software when no device can be created.
+        """
+        wanted = self.conf.get('hwaccel')
+        if not wanted:
+            return None
+        caps = capabilities.get()
+        if wanted == "auto":
+            return "auto" if caps.hwaccels else None
+        if wanted not in caps.hwaccels:
+            logging.warning("%s: ffmpeg has no hwaccel %s, decoding in software" % (
+                self.sid, wanted))
+            return None
+        return wanted
+
+    def _read_cmd(self):
+        """ Consume a command pipe message, returns the command.
+        """
+        return os.read(self.cmd_r, 1)
+
+    def _spawn(self):
+        """ launch ffmpeg and enter the starting state, shared with
+            streamManager which drives many streams from one thread.
+            Returns False if the node has no cpu left for the stream, it
+            is then stopped.
+        """
+        if not self.admitted:
+            if not placement.service().admit(self.sid, self.stop):
+                self.state = config.STREAM_STATE_STOPPED
+                return False
+            self.admitted = True
+        with self.lock:
+            outputs = list(self.outputs)
+        self._sync_pipes(outputs)
+        cmd = self._command(outputs)
         logging.debug(cmd)
+        if self.demuxer:
+            # a killed ffmpeg may have left a partial frame behind
+            self.demuxer.reset()
         self.proc = subprocess.Popen(
             shlex.split(cmd),
             shell=False,
+            pass_fds=self._pass_fds(),
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE)
+        placement.service().place(self.proc.pid, self.sid, placement.STAGE_INGEST,
+            filterGraph.cores(outputs))
+
+        # initialize reference time to now
+        self.last_output_time = time.time()
+        self.state = config.STREAM_STATE_STARTING
+        return True
+
+    def _pass_fds(self):
+        """ descriptors ffmpeg inherits, the write ends of the output pipes """
+        return [self.vout_w] + [p[1] for p in self.out_pipes.values()]
+
+    def _kill(self):
+        # shutdown ffmpeg and what for process to die so we
+        # don't leave defunct process.
+        logging.warning("existing ffmpeg loop state=%s" % self.state)  
+        self.proc.kill()
+        self.proc.communicate(b'')
+        self.proc = None
+
+    def _while_ffmpeg_running(self):
+        """
+        launch ffmpeg
+             route output traffic to stream input topic
+             parse
+        """
+        if not self._spawn():
+            return
 
         plist = select.poll()
         plist.register(self.cmd_r, select.POLLIN)
         plist.register(self.vout_r, select.POLLIN)
         plist.register(self.proc.stdout.fileno(), select.POLLIN)
         plist.register(self.proc.stderr.fileno(), select.POLLIN)
+        out_fds = self.out_fds()
+        for fd in out_fds:
+            plist.register(fd, select.POLLIN)
 
-        # initialize reference time to now
-        self.last_output_time = time.time()
-
-        self.state = config.STREAM_STATE_STARTING
         nb_stdout = nonblockingReadline(self.proc.stdout)
         nb_stderr = nonblockingReadline(self.proc.stderr)
  
@@ -185,7 +397,7 @@ class InputStream(threading.Thread):
                 config.STREAM_STATE_STARTING, config.STREAM_STATE_PLAYING):
 
             logging.debug("get next io activity")
-            line, video_chunk = None, None
+            video_chunk = None
             for (fd, evt) in plist.poll(2000):  # select on 3 sources
                 if not (evt & select.POLLIN):
                     self.state = config.STREAM_STATE_FAULT
@@ -196,41 +408,55 @@ class InputStream(threading.Thread):
                     break
 
                 if fd == self.cmd_r:
-                    self.state = config.STREAM_STATE_STOPPED
+                    cmd = self._read_cmd()
+                    if cmd == _CMD_STOP:
+                        self.state = config.STREAM_STATE_STOPPED
+                    elif cmd == _CMD_RESTART:
+                        # stale, we are running already
+                        continue
+                    else:
+                        # outputs changed, go through idle to restart
+                        self.state = config.STREAM_STATE_IDLE
                     break
 
+                elif fd in out_fds:
+                    self._route_output(out_fds[fd])
+
                 elif fd == self.proc.stdout.fileno():
-                    logging.debug("stdout line")
-                    line = nb_stdout.readline()
+                    for line in nb_stdout.readlines():
+                        self._line_proc(line)
                 elif fd == self.proc.stderr.fileno():
-                    logging.debug("stdout error")
-                    line = nb_stderr.readline()
+                    for line in nb_stderr.readlines():
+                        self._stderr_proc(line)
                 else:
-                    video_chunk = os.read(self.vout_r, 0xFFFF)
+                    video_chunk = self.ring.readinto(
+                        self.vout_r, self.read_batch)
 
-                if line:
-                    self._line_proc(line)
                 if video_chunk:
-                    self._route_video(video_chunk)
+                    self._route_video(video_chunk,
+                        latency.now() if latency.enabled else None)
            
-
-        # shutdown ffmpeg and what for process to die so we
-        # don't leave defunct process.
-        logging.warning("existing ffmpeg loop state=%" % self.state)  
-        self.proc.kill()
-        self.proc.communicate(b'')
-        self.proc = None
+        if self.state in (config.STREAM_STATE_STARTING, config.STREAM_STATE_PLAYING):
+            # ffmpeg exited on its own, the supervisor restarts it
+            self._exit_fault()
+        self._kill()
 
     def _while_fault_state(self):
-        retry_time = time.time() + self.conf['retryAfter']
-        plist = select.poll()
-        plist.register(self.cmd_r, select.POLLIN)
-        while time.time() < retry_time:
-            if len(plist.poll(2000)) > 0:
+        """ Block on the command pipe until the supervisor restarts the
+            stream or it is stopped.
+        """
+        supervisor.service().schedule(self)
+        while True:
+            cmd = self._read_cmd()
+            if cmd == _CMD_STOP:
                 self.state = config.STREAM_STATE_STOPPED
+                supervisor.service().cancel(self.sid)
                 return
-        # return to idel state so we can try ffmpeg again
-        self.state = config.STREAM_STATE_IDLE
+            if cmd == _CMD_RESTART:
+                # return to idle state so we can try ffmpeg again
+                self.state = config.STREAM_STATE_IDLE
+                return
+            # outputs changed, applied when ffmpeg is restarted
 
     def _run(self):
         while True:
@@ -244,8 +470,8 @@ class InputStream(threading.Thread):
                 self._while_ffmpeg_running()
 
             elif self.state == config.STREAM_STATE_FAULT:
-                # wait for conf.retryAfter seconds, monitor command pipe
-                # since we might receive a stop event while waiting
+                # wait for the supervisor to restart us, monitor command
+                # pipe since we might receive a stop event while waiting
                 self._while_fault_state()
 
     # start implemented by threading.Thread
@@ -253,7 +479,12 @@ class InputStream(threading.Thread):
 
     def stop(self):
         # any pipe activity
-        os.write(self.cmd_w, 'x')
+        os.write(self.cmd_w, _CMD_STOP)
+
+    def restart(self):
+        """ Called by the supervisor when a faulted stream may start again.
+        """
+        os.write(self.cmd_w, _CMD_RESTART)
 
     def run(self):
         # run worker thread that oversees the ffmpeg process, prmorning the
@@ -271,6 +502,7 @@ class InputStream(threading.Thread):
         if self.proc and not self.proc.poll():
             self.proc.kill()
             self.proc.communicate(b'')
+        placement.service().release(self.sid)
 
 
 def unittest():
@@ -0,0 +1,133 @@
+"""
+Hot path latency tracing from the ffmpeg pipe to the subscribers.
+
+InputStream stamps every chunk with time.monotonic() when it is read and
+makes the stamp the trace context of the publishing thread (async
+subscribers in signals carry it with the queued message). Each
+subscriber boundary records the delay since the read into a fixed
+memory Histogram per stream and stage:
+
+    publish         read until every inline subscriber returned
+    <subscriber>    read until the subscriber is called, includes the
+                    time spent queued for async subscribers
+    image           read until ImageGenerator completed an image
+
+summary() reduces the histograms to p50/p99/max which InputStream adds
+to its stats messages. With enabled False the hot path costs one
+attribute test.
+"""
+import threading
+import time
+import config
+
+enabled = config.LATENCY_TRACING
+
+_local = threading.local()
+_histograms = {}
+_lock = threading.Lock()
+
+
+class Histogram:
+    """ Log-linear (HDR style) histogram of integer microseconds. Values
+        below subBuckets are counted exactly, above that every power of
+        two is split into subBuckets/2 linear buckets, a relative error
+        of at most 2/subBuckets in a fixed number of counters.
+    """
+    def __init__(self, subBucketBits=5, maxBits=31):
+        self.bits = subBucketBits
+        self.sub = 1 << subBucketBits
+        self.half = self.sub >> 1
+        self.counts = [0] * (self.sub + (maxBits - subBucketBits) * self.half)
+        self.total = 0
+        self.max = 0
+
+    def index(self, value):
+        if value < self.sub:
+            return value
+        shift = value.bit_length() - self.bits
+        i = self.sub + (shift - 1) * self.half + (value >> shift) - self.half
+        return min(i, len(self.counts) - 1)
+
+    def value(self, index):
+        """ Lowest value counted in bucket index. """
+        if index < self.sub:
+            return index
+        j = index - self.sub
+        return (j % self.half + self.half) << (j // self.half + 1)
+
+    def record(self, value):
+        self.counts[self.index(value)] += 1
+        self.total += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if self.total == 0:
+            return None
+        rank = max(int(self.total * p / 100.0 + 0.5), 1)
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.value(i)
+        return self.max
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.total = 0
+        self.max = 0
+
+
+def now():
+    return time.monotonic()
+
+def begin(sid, stamp):
+    """ Make (sid, stamp) the trace context of this thread. """
+    _local.trace = (sid, stamp)
+
+def end():
+    _local.trace = None
+
+def context():
+    return getattr(_local, 'trace', None)
+
+def record(sid, stage, stamp):
+    """ Record the delay since stamp for stage of stream sid. """
+    key = (sid, stage)
+    h = _histograms.get(key)
+    if h is None:
+        with _lock:
+            h = _histograms.setdefault(key, Histogram())
+    h.record(int((time.monotonic() - stamp) * 1000000))
+
+def record_current(stage):
+    """ Record stage against the trace context of this thread, if any. """
+    trace = getattr(_local, 'trace', None)
+    if trace:
+        record(trace[0], stage, trace[1])
+
+def summary(sid, reset=True):
+    """ {stage: {p50, p99, max, count}} in microseconds for stream sid,
+        by default the histograms restart so each summary covers the
+        time since the previous one.
+    """
+    result = {}
+    with _lock:
+        items = [(k[1], h) for k, h in _histograms.items() if k[0] == sid]
+    for stage, h in items:
+        if h.total == 0:
+            continue
+        result[stage] = {
+            'p50': h.percentile(50),
+            'p99': h.percentile(99),
+            'max': h.max,
+            'count': h.total
+        }
+        if reset:
+            h.reset()
+    return result
+
+def forget(sid):
+    with _lock:
+        for key in [k for k in _histograms if k[0] == sid]:
+            del _histograms[key]
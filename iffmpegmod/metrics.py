@@ -0,0 +1,140 @@
+"""
+Exposes the counters of the signals bus and the state of every
+InputStream in Prometheus text format on a local HTTP endpoint:
+
+    metrics.start_server()       # http://127.0.0.1:9108/metrics
+
+    iffmpeg_signals_messages_total{topic}            counter
+    iffmpeg_signals_bytes_total{topic}               counter
+    iffmpeg_signals_handler_calls_total{topic,subscriber}
+    iffmpeg_signals_handler_errors_total{topic,subscriber}
+    iffmpeg_signals_handler_seconds{topic,subscriber,quantile}  summary
+    iffmpeg_signals_queue_depth{topic,subscriber}    gauge
+    iffmpeg_signals_queue_dropped_total{topic,subscriber}
+    iffmpeg_stream_state{stream,state}               1 for the current state
+    iffmpeg_stream_output_age_seconds{stream}        since the last output
+    iffmpeg_stream_ring_slots{stream}                ring buffer slots, grown included
+    iffmpeg_stream_ring_allocations_total{stream}    ring buffer fallbacks
+    iffmpeg_tour_switches_total{stream}              tour source switches
+    iffmpeg_tour_switch_seconds{stream,quantile}     slot boundary to first frame
+"""
+import http.server
+import logging
+import threading
+import time
+import weakref
+import config
+import signals
+
+_streams = weakref.WeakValueDictionary()
+_tours = weakref.WeakValueDictionary()
+
+_states = (config.STREAM_STATE_IDLE, config.STREAM_STATE_STARTING,
+    config.STREAM_STATE_PLAYING, config.STREAM_STATE_FAULT,
+    config.STREAM_STATE_STOPPED)
+
+
+def register_stream(stream):
+    """ Report the state of an InputStream for as long as it exists. """
+    _streams[stream.sid] = stream
+
+def register_tour(tour):
+    """ Report the switches of a tour.Tour for as long as it exists. """
+    _tours[tour.sid] = tour
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(**labels):
+    return "{%s}" % ",".join('%s="%s"' % (k, _label(v))
+        for k, v in sorted(labels.items()))
+
+def render():
+    lines = []
+    def metric(name, kind, doc, samples):
+        lines.append("# HELP %s %s" % (name, doc))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for suffix, labels, value in samples:
+            lines.append("%s%s%s %s" % (name, suffix, _labels(**labels), repr(float(value))))
+
+    topics = sorted(signals.topic_stats().items())
+    metric("iffmpeg_signals_messages_total", "counter", "Messages published per topic",
+        [("", {'topic': t}, c[0]) for t, c in topics])
+    metric("iffmpeg_signals_bytes_total", "counter", "Buffer bytes published per topic",
+        [("", {'topic': t}, c[1]) for t, c in topics])
+
+    handlers = sorted(signals.handler_stats(), key=lambda h: (h.topic, h.subscriber))
+    metric("iffmpeg_signals_handler_calls_total", "counter", "Handler calls",
+        [("", {'topic': h.topic, 'subscriber': h.subscriber}, h.calls) for h in handlers])
+    metric("iffmpeg_signals_handler_errors_total", "counter", "Handler exceptions",
+        [("", {'topic': h.topic, 'subscriber': h.subscriber}, h.errors) for h in handlers])
+    samples = []
+    for h in handlers:
+        labels = {'topic': h.topic, 'subscriber': h.subscriber}
+        for q in (50, 99):
+            value = h.histogram.percentile(q)
+            if value is not None:
+                samples.append(("", dict(labels, quantile=q / 100.0), value / 1e6))
+        samples.append(("_sum", labels, h.seconds))
+        samples.append(("_count", labels, h.calls))
+    metric("iffmpeg_signals_handler_seconds", "summary", "Time spent in handlers", samples)
+
+    queues = signals.queue_stats()
+    metric("iffmpeg_signals_queue_depth", "gauge", "Messages queued for async subscribers",
+        [("", {'topic': q['topic'], 'subscriber': q['subscriber']}, q['depth']) for q in queues])
+    metric("iffmpeg_signals_queue_dropped_total", "counter", "Messages dropped by overflow policy",
+        [("", {'topic': q['topic'], 'subscriber': q['subscriber']}, q['dropped']) for q in queues])
+
+    streams = sorted(_streams.items())
+    now = time.time()
+    metric("iffmpeg_stream_state", "gauge", "Current state of each input stream",
+        [("", {'stream': sid, 'state': state}, int(s.state == state))
+            for sid, s in streams for state in _states])
+    metric("iffmpeg_stream_output_age_seconds", "gauge", "Seconds since the last ffmpeg output",
+        [("", {'stream': sid}, now - s.last_output_time)
+            for sid, s in streams if s.last_output_time])
+    metric("iffmpeg_stream_ring_slots", "gauge",
+        "Ring buffer slots of the relay and pipe outputs",
+        [("", {'stream': sid}, s.ring_slots()) for sid, s in streams])
+    metric("iffmpeg_stream_ring_allocations_total", "counter",
+        "Reads that found the ring buffers at their maximum size and in use",
+        [("", {'stream': sid}, s.ring_allocations()) for sid, s in streams])
+
+    tours = sorted(_tours.items())
+    metric("iffmpeg_tour_switches_total", "counter", "Tour source switches",
+        [("", {'stream': sid}, t.switches) for sid, t in tours])
+    samples = []
+    for sid, t in tours:
+        for q in (50, 99):
+            value = t.switch_latency.percentile(q)
+            if value is not None:
+                samples.append(("", {'stream': sid, 'quantile': q / 100.0}, value / 1e6))
+        samples.append(("_count", {'stream': sid}, t.switch_latency.total))
+    metric("iffmpeg_tour_switch_seconds", "summary",
+        "Seconds from a tour slot boundary to the first frame of the next source", samples)
+
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logging.debug("metrics: " + fmt % args)
+
+
+def start_server(port=config.METRICS_PORT, host="127.0.0.1"):
+    server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    t = threading.Thread(target=server.serve_forever, name="metrics")
+    t.daemon = True
+    t.start()
+    return server
@@ -0,0 +1,338 @@
+"""
+Forwards chosen signals topics to the MQTT broker without flooding it.
+
+Topics are forwarded by class:
+
+    stats   the latest message of every forwarded stats topic is kept
+            and all of them go out together every batchInterval seconds
+            as one message on <prefix>/<nodeId>/stats
+    fault   sent immediately on <prefix>/<nodeId>/<signals topic>
+    event   same as fault, with its own QoS
+
+The payload encoding is json (compact separators), msgpack (needs the
+msgpack package) or struct. struct packs stats batches with a fixed
+record per stream (see STATS_RECORD), other messages fall back to json.
+
+While the broker is unreachable messages wait in a bounded queue, the
+oldest are dropped (and counted) once it is full, and the queue is sent
+when the connection comes back.
+
+The bridge only needs a paho style client (publish, on_connect,
+on_disconnect) so FakeBroker/FakeClient below can stand in for
+mosquitto in tests.
+"""
+import collections
+import json
+import logging
+import math
+import struct
+import threading
+import time
+import config
+import signals
+
+ENCODING_JSON = "json"
+ENCODING_MSGPACK = "msgpack"
+ENCODING_STRUCT = "struct"
+
+TOPIC_CLASS_STATS = "stats"
+TOPIC_CLASS_FAULT = "fault"
+TOPIC_CLASS_EVENT = "event"
+
+DEFAULT_QOS = {
+    TOPIC_CLASS_STATS: 0,
+    TOPIC_CLASS_FAULT: 1,
+    TOPIC_CLASS_EVENT: 1,
+}
+
+# version, record count, batch time
+STATS_HEADER = struct.Struct("<BHd")
+# fps, bitrate, psnr, speed, frame, drop_frames, preceded by the topic
+# as a length prefixed utf-8 string
+STATS_RECORD = struct.Struct("<ffffII")
+# topic length prefix of each version, version 1 limited topics to 255
+# bytes which stream ids made of camera urls exceed
+STATS_VERSION = 2
+_TOPIC_LENGTH = {1: struct.Struct("<B"), 2: struct.Struct("<H")}
+
+
+def _float(value):
+    return float('nan') if value is None else float(value)
+
+def encode_stats_struct(stamp, stats):
+    length = _TOPIC_LENGTH[STATS_VERSION]
+    parts = [STATS_HEADER.pack(STATS_VERSION, len(stats), stamp)]
+    for topic, s in sorted(stats.items()):
+        name = topic.encode()
+        parts.append(length.pack(len(name)) + name)
+        parts.append(STATS_RECORD.pack(_float(s.get('fps')),
+            _float(s.get('bitrate')), _float(s.get('psnr')),
+            _float(s.get('speed')), s.get('frame') or 0,
+            s.get('drop_frames') or 0))
+    return b"".join(parts)
+
+def decode_stats_struct(payload):
+    version, count, stamp = STATS_HEADER.unpack_from(payload)
+    # batches of nodes not upgraded yet are version 1
+    length = _TOPIC_LENGTH[version]
+    pos = STATS_HEADER.size
+    stats = {}
+    for i in range(count):
+        n = length.unpack_from(payload, pos)[0]
+        pos += length.size
+        topic = payload[pos:pos + n].decode()
+        pos += n
+        values = STATS_RECORD.unpack_from(payload, pos)
+        pos += STATS_RECORD.size
+        stats[topic] = dict(zip(('fps', 'bitrate', 'psnr', 'speed', 'frame',
+            'drop_frames'), [None if isinstance(v, float) and math.isnan(v)
+            else v for v in values]))
+    return stamp, stats
+
+
+class MqttBridge:
+    def __init__(self, client, nodeId, encoding=config.MQTT_ENCODING,
+            qos=None, batchInterval=config.MQTT_STATS_INTERVAL,
+            offlineQueue=config.MQTT_OFFLINE_QUEUE, prefix=config.MQTT_NODE_TOPIC):
+        self.client = client
+        self.nodeId = nodeId
+        self.encoding = encoding
+        self.qos = dict(DEFAULT_QOS, **(qos or {}))
+        self.batchInterval = batchInterval
+        self.prefix = prefix
+        self.queue = collections.deque()
+        self.queueSize = offlineQueue
+        self.dropped = 0
+        self.sent = 0
+        self.stats = {}
+        self.forwards = []
+        self.connected = False
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.thread = None
+
+        if encoding == ENCODING_MSGPACK:
+            import msgpack
+            self.packb = msgpack.packb
+
+        client.on_connect = self.on_connect
+        client.on_disconnect = self.on_disconnect
+
+    def topic(self, name):
+        return "%s/%s/%s" % (self.prefix, self.nodeId, name)
+
+    def encode(self, obj):
+        if self.encoding == ENCODING_MSGPACK:
+            return self.packb(obj, use_bin_type=True)
+        return json.dumps(obj, separators=(',', ':'), default=str).encode()
+
+    def forward(self, signalsTopic, topicClass=TOPIC_CLASS_EVENT, mqttTopic=None):
+        """ Forward a signals topic, mqttTopic defaults to
+            <prefix>/<nodeId>/<signalsTopic> and is not used for stats.
+        """
+        if topicClass == TOPIC_CLASS_STATS:
+            def handler(message):
+                with self.lock:
+                    self.stats[signalsTopic] = message
+        else:
+            target = mqttTopic or self.topic(signalsTopic)
+            def handler(message=None):
+                self.send(target, message, self.qos[topicClass])
+        signals.subscribe(signalsTopic, handler)
+        self.forwards.append((signalsTopic, handler))
+
+    def forward_stream(self, streamId):
+        self.forward(config.StreamInputStatsTopic(streamId), TOPIC_CLASS_STATS)
+        self.forward(config.StreamFaultTopic(streamId), TOPIC_CLASS_FAULT)
+
+    def send(self, topic, message, qos=0, payload=None):
+        if payload is None:
+            payload = self.encode(message)
+        with self.lock:
+            if self.connected and not self.queue and self._publish(topic, payload, qos):
+                return
+            if len(self.queue) >= self.queueSize:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append((topic, payload, qos))
+
+    def _publish(self, topic, payload, qos):
+        info = self.client.publish(topic, payload, qos)
+        if getattr(info, 'rc', 0) != 0:
+            return False
+        self.sent += 1
+        return True
+
+    def _drain(self):
+        with self.lock:
+            while self.connected and self.queue:
+                if not self._publish(*self.queue[0]):
+                    break
+                self.queue.popleft()
+
+    def flush_stats(self):
+        with self.lock:
+            stats, self.stats = self.stats, {}
+        if not stats:
+            return
+        stamp = time.time()
+        if self.encoding == ENCODING_STRUCT:
+            payload = encode_stats_struct(stamp, stats)
+        else:
+            payload = self.encode({'node': self.nodeId, 'time': stamp, 'stats': stats})
+        self.send(self.topic(TOPIC_CLASS_STATS), None,
+            self.qos[TOPIC_CLASS_STATS], payload)
+
+    # paho callbacks
+    def on_connect(self, client, userdata, flags, rc, *args):
+        if rc != 0:
+            logging.error("mqtt connect refused rc=%s" % str(rc))
+            return
+        with self.lock:
+            self.connected = True
+        self._drain()
+
+    def on_disconnect(self, client, userdata, rc, *args):
+        logging.warning("mqtt disconnected rc=%s" % str(rc))
+        with self.lock:
+            self.connected = False
+
+    def _run(self):
+        while not self.done.wait(self.batchInterval):
+            try:
+                self.flush_stats()
+                self._drain()
+            except:
+                logging.exception("mqtt bridge flush failed")
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="mqtt-bridge")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.done.set()
+        for signalsTopic, handler in self.forwards:
+            signals.unsubscribe(signalsTopic, handler)
+        self.forwards = []
+        self.flush_stats()
+
+
+def topic_matches(pattern, topic):
+    """ MQTT topic filter match, + is one level and # the rest. """
+    p = pattern.split('/')
+    t = topic.split('/')
+    for i, level in enumerate(p):
+        if level == '#':
+            return True
+        if i >= len(t) or (level != '+' and level != t[i]):
+            return False
+    return len(p) == len(t)
+
+
+class FakeBroker:
+    """ In process stand in for the broker, records what was published
+        and can be taken down and brought back up. Subscribed clients
+        get messages delivered on the publishing thread, kill() sends a
+        client's will like a broker noticing a dead connection.
+    """
+    def __init__(self):
+        self.messages = []
+        self.clients = []
+        self.up = True
+
+    def deliver(self, topic, payload, qos):
+        self.messages.append((topic, payload, qos))
+        for c in list(self.clients):
+            if c.on_message and any(topic_matches(s, topic) for s in c.subscriptions):
+                c.on_message(c, None, _Message(topic, payload, qos))
+
+    def kill(self, client):
+        self.clients.remove(client)
+        if client.will:
+            self.deliver(*client.will)
+
+    def down(self):
+        self.up = False
+        for c in self.clients:
+            c.on_disconnect(c, None, 1)
+
+    def restore(self):
+        self.up = True
+        for c in self.clients:
+            c.on_connect(c, None, {}, 0)
+
+
+class _Info:
+    def __init__(self, rc):
+        self.rc = rc
+
+
+class _Message:
+    def __init__(self, topic, payload, qos):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+
+
+class FakeClient:
+    """ The part of paho.mqtt.client.Client the bridge uses. """
+    def __init__(self, broker):
+        self.broker = broker
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.subscriptions = set()
+        self.will = None
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        self.will = (topic, payload, qos)
+
+    def connect(self, *args, **kwargs):
+        self.broker.clients.append(self)
+        if self.broker.up and self.on_connect:
+            self.on_connect(self, None, {}, 0)
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.add(topic)
+        return (0, 1)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if not self.broker.up:
+            return _Info(4)
+        self.broker.deliver(topic, payload, qos)
+        return _Info(0)
+
+
+def unittest():
+    import sys
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.DEBUG,
+        format="%(asctime)s %(message)s")
+
+    broker = FakeBroker()
+    client = FakeClient(broker)
+    bridge = MqttBridge(client, "node1", encoding=ENCODING_STRUCT, offlineQueue=2)
+    client.connect()
+    for sid in ("cam1", "cam2"):
+        bridge.forward_stream(sid)
+        for fps in (10, 11, 12):
+            signals.publish(config.StreamInputStatsTopic(sid),
+                {'fps': fps, 'bitrate': 1e6, 'frame': 100})
+    bridge.flush_stats()
+    topic, payload, qos = broker.messages[-1]
+    assert len(broker.messages) == 1
+    assert decode_stats_struct(payload)[1]["cam2-input-stats"]['fps'] == 12
+
+    broker.down()
+    for i in range(3):
+        signals.publish(config.StreamFaultTopic("cam1"), {'error': 'BadInput', 'n': i})
+    assert len(bridge.queue) == 2 and bridge.dropped == 1
+    broker.restore()
+    assert len(bridge.queue) == 0 and len(broker.messages) == 3
+    logging.info("mqtt bridge ok: %s" % str(broker.messages))
+
+
+if __name__ == '__main__':
+    unittest()
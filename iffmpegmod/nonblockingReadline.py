@@ -2,19 +2,73 @@ import fcntl
 import os
 
 class nonblockingReadline:
-    def __init__(self, fileObj):
+    """ Splits the output of a non blocking fd into lines. Each call to
+        readlines() drains the fd until it would block and returns every
+        complete line, '\\r' (ffmpeg progress updates) and '\\n' both end
+        a line. Lines longer than maxLine are truncated and at most
+        maxBuffer bytes are read per call so a chatty process can not
+        hold up the caller.
+    """
+    def __init__(self, fileObj, maxLine=4096, maxBuffer=0x10000, encoding='utf-8'):
         self.fd = fileObj.fileno()
         fl = fcntl.fcntl(self.fd, fcntl.F_GETFL)
         fcntl.fcntl(self.fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-        self.buf = ''
+        self.buf = bytearray()
+        self.maxLine = maxLine
+        self.maxBuffer = maxBuffer
+        self.encoding = encoding
+        self.pending = []
+        self.truncated = 0
+        self.eof = False
+
+    def _drain(self):
+        total = 0
+        while total < self.maxBuffer:
+            try:
+                chunk = os.read(self.fd, 4096)
+            except BlockingIOError:
+                break
+            if not chunk:
+                self.eof = True
+                break
+            self.buf += chunk
+            total += len(chunk)
+
+    def _split(self):
+        end = max(self.buf.rfind(b'\n'), self.buf.rfind(b'\r'))
+        if end == -1:
+            if len(self.buf) > self.maxLine:
+                # no terminator in sight, emit what we have
+                lines = [bytes(self.buf[:self.maxLine])]
+                self.truncated += len(self.buf) - self.maxLine
+                del self.buf[:]
+                return lines
+            return []
+
+        lines = []
+        for line in self.buf[:end].replace(b'\r', b'\n').split(b'\n'):
+            if len(line) > self.maxLine:
+                self.truncated += len(line) - self.maxLine
+                line = line[:self.maxLine]
+            if line:
+                lines.append(bytes(line))
+        del self.buf[:end + 1]
+        return lines
+
+    def readlines(self):
+        """ Every complete line available, decoded.
+        """
+        self._drain()
+        lines = self.pending + [line.decode(self.encoding, 'replace')
+            for line in self._split()]
+        self.pending = []
+        return lines
 
     def readline(self):
-        chunk = os.read(self.fd,4096)
-        if chunk and len(chunk) > 0:
-            self.buf += chunk 
-        pos = self.buf.find('\n')
-        if pos > -1:
-            r = self.buf[:pos]
-            self.buf = self.buf[pos+1:]
-            return r
-  
+        """ One line at a time, lines read but not yet returned are kept
+            for the next call.
+        """
+        if not self.pending:
+            self.pending = self.readlines()
+        if self.pending:
+            return self.pending.pop(0)
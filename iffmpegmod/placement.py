@@ -0,0 +1,256 @@
+"""
+CPU aware placement of the ffmpeg children of the node.
+
+Every ffmpeg is placed when it is started:
+
+1. pinned with sched_setaffinity to the cores with the least measured
+   load (pinCores), as many as the process is expected to keep busy.
+   An ingest ffmpeg runs the whole graph of its stream, decode plus
+   every encoder (filterGraph.Output.cores), a transcode with automatic
+   threads is not pinned at all.
+2. given a nice value and an io priority by stage, ingest above
+   snapshots above analytics (see PRIORITIES).
+
+The CPU used by each child is sampled from /proc/<pid>/stat every
+interval seconds. A new stream is only admitted if the measured load
+plus what an average stream costs fits in budget (a fraction of all
+usable cores), a refused stream gets an 'Overload' fault. Streams
+admitted but not sampled yet count at that average cost too, so a burst
+of starts is not admitted wholesale and then shed. When the
+measured load stays above budget + shedMargin for two samples the most
+recently admitted stream is shed: its shed callback is called and an
+'Overload' fault is published on its fault topic.
+"""
+import ctypes
+import logging
+import os
+import platform
+import threading
+import time
+import config
+import signals
+
+STAGE_INGEST = "ingest"
+STAGE_SNAPSHOT = "snapshot"
+STAGE_ANALYTICS = "analytics"
+
+# stage -> (nice, io priority class, io priority level)
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+PRIORITIES = {
+    STAGE_INGEST: (0, IOPRIO_CLASS_BE, 2),
+    STAGE_SNAPSHOT: (5, IOPRIO_CLASS_BE, 5),
+    STAGE_ANALYTICS: (10, IOPRIO_CLASS_BE, 7),
+}
+
+CPU_BUDGET = 0.85
+SHED_MARGIN = 0.05
+SAMPLE_INTERVAL = 5
+# cores a stream is expected to use before any has been measured
+DEFAULT_STREAM_COST = 0.25
+
+_IOPRIO_SET = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'armv6l': 314,
+}
+_IOPRIO_WHO_PROCESS = 1
+_CLK_TCK = os.sysconf("SC_CLK_TCK")
+
+
+def cpu_ticks(pid):
+    """ utime + stime of pid in clock ticks, None if it is gone. """
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # the command may contain spaces, fields resume after its ')'
+    fields = stat[stat.rindex(')') + 2:].split()
+    return int(fields[11]) + int(fields[12])
+
+def set_ioprio(pid, cls, level):
+    nr = _IOPRIO_SET.get(platform.machine())
+    if nr is None:
+        return False
+    libc = ctypes.CDLL(None, use_errno=True)
+    return libc.syscall(nr, _IOPRIO_WHO_PROCESS, pid, (cls << 13) | level) == 0
+
+
+class _Proc:
+    def __init__(self, pid, sid, stage, cores):
+        self.pid = pid
+        self.sid = sid
+        self.stage = stage
+        # cores pinned to, every usable core if not pinned
+        self.cores = cores
+        self.sampled = False
+        self.ticks = cpu_ticks(pid) or 0
+        self.time = time.time()
+        # cores used over the last interval
+        self.cpu = 0.0
+
+
+class Placement(threading.Thread):
+    def __init__(self, budget=CPU_BUDGET, shedMargin=SHED_MARGIN,
+            interval=SAMPLE_INTERVAL, pinCores=True, cores=None):
+        threading.Thread.__init__(self, name="placement")
+        self.daemon = True
+        self.budget = budget
+        self.shedMargin = shedMargin
+        self.interval = interval
+        self.pinCores = pinCores
+        self.cores = sorted(cores or os.sched_getaffinity(0))
+        # pid -> _Proc
+        self.procs = {}
+        # admitted streams in order, sid -> shed callback
+        self.streams = {}
+        # admitted streams without a cpu sample yet, sid -> expected cores
+        self.pending = {}
+        self.over = 0
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def load(self):
+        """ Measured load as a fraction of the usable cores. """
+        return sum(p.cpu for p in self.procs.values()) / len(self.cores)
+
+    def stream_cost(self):
+        """ Average cores used per measured stream. """
+        sampled = [p for p in self.procs.values() if p.sampled]
+        sids = set(p.sid for p in sampled)
+        if not sids or not any(p.cpu for p in sampled):
+            return DEFAULT_STREAM_COST
+        return sum(p.cpu for p in sampled) / len(sids)
+
+    def admit(self, sid, shed=None):
+        """ Returns True if stream sid fits in the budget, shed is called
+            if the stream has to go later. A refusal is published on the
+            stream's fault topic.
+        """
+        with self.lock:
+            if sid in self.streams:
+                return True
+            cost = self.stream_cost()
+            projected = self.load() + (sum(self.pending.values()) + cost) / len(self.cores)
+            if projected <= self.budget:
+                self.streams[sid] = shed
+                self.pending[sid] = cost
+                return True
+        logging.warning("placement: refusing %s, projected load %.2f" % (sid, projected))
+        signals.publish(config.StreamFaultTopic(sid), {
+            'error': 'Overload',
+            'desc': 'Refused, projected cpu load %d%% exceeds budget %d%%' % (
+                projected * 100, self.budget * 100)
+        })
+        return False
+
+    def release(self, sid):
+        """ Stream sid stopped. """
+        with self.lock:
+            self.streams.pop(sid, None)
+            self.pending.pop(sid, None)
+            for pid in [p.pid for p in self.procs.values() if p.sid == sid]:
+                del self.procs[pid]
+
+    def pick_cores(self, count):
+        """ The count least loaded cores, all of them if count is None. """
+        if count is None or count >= len(self.cores):
+            return set(self.cores)
+        loads = dict((c, 0.0) for c in self.cores)
+        for p in self.procs.values():
+            cpu = p.cpu if p.sampled else DEFAULT_STREAM_COST
+            for c in p.cores:
+                if c in loads:
+                    loads[c] += cpu / len(p.cores)
+        return set(sorted(self.cores, key=lambda c: loads[c])[:max(count, 1)])
+
+    def place(self, pid, sid, stage=STAGE_INGEST, cores=1):
+        """ Pin and prioritize the ffmpeg pid started for stream sid, cores
+            is how many cores it keeps busy, None for as many as there are.
+        """
+        nice, ioclass, iolevel = PRIORITIES.get(stage, PRIORITIES[STAGE_ANALYTICS])
+        with self.lock:
+            pinned = self.pick_cores(cores) if self.pinCores else set(self.cores)
+            self.procs[pid] = _Proc(pid, sid, stage, pinned)
+        try:
+            if len(pinned) < len(self.cores):
+                os.sched_setaffinity(pid, pinned)
+            if nice:
+                os.setpriority(os.PRIO_PROCESS, pid, nice)
+            set_ioprio(pid, ioclass, iolevel)
+        except OSError as e:
+            # the process may already be gone
+            logging.debug("placement: %d: %s" % (pid, str(e)))
+
+    def sample(self):
+        now = time.time()
+        with self.lock:
+            for pid, p in list(self.procs.items()):
+                ticks = cpu_ticks(pid)
+                if ticks is None:
+                    del self.procs[pid]
+                    continue
+                p.cpu = (ticks - p.ticks) / float(_CLK_TCK) / max(now - p.time, 1e-3)
+                p.ticks = ticks
+                p.time = now
+                p.sampled = True
+                # measured now, no longer counted at the expected cost
+                self.pending.pop(p.sid, None)
+            load = self.load()
+            if load > self.budget + self.shedMargin:
+                self.over += 1
+            else:
+                self.over = 0
+            victim = None
+            if self.over >= 2 and self.streams:
+                sid = list(self.streams)[-1]
+                victim = (sid, self.streams.pop(sid))
+                self.over = 0
+        if victim:
+            sid, shed = victim
+            logging.warning("placement: shedding %s, load %.2f" % (sid, load))
+            signals.publish(config.StreamFaultTopic(sid), {
+                'error': 'Overload',
+                'desc': 'Shed, cpu load %d%% exceeds budget %d%%' % (
+                    load * 100, self.budget * 100)
+            })
+            if shed:
+                shed()
+
+    def report(self):
+        """ {load, budget, pending, procs: [{pid, sid, stage, cores, cpu}]} """
+        with self.lock:
+            return {
+                'load': self.load(),
+                'budget': self.budget,
+                'pending': sum(self.pending.values()) / len(self.cores),
+                'procs': [{'pid': p.pid, 'sid': p.sid, 'stage': p.stage,
+                    'cores': sorted(p.cores), 'cpu': p.cpu} for p in self.procs.values()]
+            }
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            try:
+                self.sample()
+            except:
+                logging.exception("placement sample failed")
+
+    def stop(self):
+        self.done.set()
+
+
+_placement = None
+_placement_lock = threading.Lock()
+
+def service():
+    """ The node's placement, started on first use. """
+    global _placement
+    with _placement_lock:
+        if _placement is None:
+            _placement = Placement()
+            _placement.start()
+        return _placement
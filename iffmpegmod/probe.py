@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+Uses ffprobe to inspect a stream to determine the format,frame rate
+and quality of the stream.
+
+Probes go through a ProbeService which
+
+1. runs ffprobe on a bounded pool of workers, a probe that exceeds its
+   timeout is killed.
+2. keeps results in an LRU cache with a time to live, the cache is
+   saved to disk so a restarted daemon does not probe again. Camera
+   urls carry credentials, so entries are keyed by a sha256 of the url,
+   the filename ffprobe reports is redacted and the file is only
+   readable by its owner.
+3. collapses concurrent requests for the same url into one probe, so
+   restarting every camera after a network blip does not start an
+   ffprobe storm.
+"""
+import collections
+import concurrent.futures
+import config
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+import urllib.parse
+
+PROBE_WORKERS = 4
+PROBE_TIMEOUT = 60
+PROBE_CACHE_SIZE = 256
+PROBE_CACHE_TTL = 3600
+PROBE_CACHE_FILE = config.DATA_DIR + "probe-cache.json"
+
+
+class ProbeError(Exception):
+    pass
+
+
+def redact(url):
+    """ url without the password of its user info """
+    try:
+        parts = urllib.parse.urlsplit(url)
+    except ValueError:
+        return url
+    if parts.password is None:
+        return url
+    netloc = "%s:***@%s" % (parts.username, parts.netloc.rpartition('@')[2])
+    return urllib.parse.urlunsplit(parts._replace(netloc=netloc))
+
+def cache_key(url):
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+class ProbeService:
+    def __init__(self, workers=PROBE_WORKERS, cacheSize=PROBE_CACHE_SIZE,
+            ttl=PROBE_CACHE_TTL, cacheFile=PROBE_CACHE_FILE):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="ffprobe")
+        self.cacheSize = cacheSize
+        self.ttl = ttl
+        self.cacheFile = cacheFile
+        # cache_key(url) -> (time probed, result), least recently used first
+        self.cache = collections.OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not self.cacheFile or not os.access(self.cacheFile, os.F_OK):
+            return
+        try:
+            entries = json.loads(open(self.cacheFile).read())
+        except ValueError:
+            logging.warning("ignoring corrupt probe cache %s" % self.cacheFile)
+            return
+        now = time.time()
+        legacy = False
+        for key, (probed, result) in sorted(entries.items(), key=lambda e: e[1][0]):
+            if len(key) != 64:
+                # keyed by the plain url before, drop it from the file
+                legacy = True
+            elif probed + self.ttl > now:
+                self.cache[key] = (probed, result)
+        if legacy:
+            self._save()
+
+    def _save(self):
+        if not self.cacheFile:
+            return
+        tmp = self.cacheFile + ".tmp"
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(json.dumps(self.cache))
+            os.rename(tmp, self.cacheFile)
+        except OSError as e:
+            logging.warning("unable to save probe cache: %s" % str(e))
+
+    def cached(self, url):
+        """ The cached result for url or None, must hold self.lock.
+        """
+        key = cache_key(url)
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] + self.ttl < time.time():
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        return entry[1]
+
+    def _probe(self, url, timeout):
+        try:
+            proc = subprocess.run([config.FFPROBE, "-loglevel", "-8",
+                "-print_format", "json", "-show_format", "-show_streams", url],
+                stdout=subprocess.PIPE, timeout=timeout)
+            if proc.returncode != 0 or not proc.stdout:
+                raise ProbeError("ffprobe failed for %s (code %d)" % (
+                    redact(url), proc.returncode))
+            result = json.loads(proc.stdout)
+            if 'filename' in result.get('format', {}):
+                result['format']['filename'] = redact(url)
+
+            key = cache_key(url)
+            with self.lock:
+                self.cache[key] = (time.time(), result)
+                self.cache.move_to_end(key)
+                while len(self.cache) > self.cacheSize:
+                    self.cache.popitem(last=False)
+                self._save()
+            return result
+        finally:
+            with self.lock:
+                del self.inflight[url]
+
+    def probe(self, url, timeout=PROBE_TIMEOUT):
+        """ Returns a Future for the ffprobe json of url. A timed out probe
+            raises subprocess.TimeoutExpired, a failed one ProbeError.
+        """
+        with self.lock:
+            result = self.cached(url)
+            if result is not None:
+                future = concurrent.futures.Future()
+                future.set_result(result)
+                return future
+            future = self.inflight.get(url)
+            if future is None:
+                future = self.executor.submit(self._probe, url, timeout)
+                self.inflight[url] = future
+            return future
+
+    def invalidate(self, url):
+        with self.lock:
+            if self.cache.pop(cache_key(url), None) is not None:
+                self._save()
+
+
+_service = None
+_service_lock = threading.Lock()
+
+def service():
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = ProbeService()
+        return _service
+
+def inspect(url, timeout=PROBE_TIMEOUT):
+    return service().probe(url, timeout).result()
+
+def async_inspect(url, success, failure, timeout=PROBE_TIMEOUT):
+    def done(future):
+        if future.exception() is not None:
+            logging.warning("probe of %s failed: %s" % (redact(url), str(future.exception())))
+            failure()
+        else:
+            success(future.result())
+    service().probe(url, timeout).add_done_callback(done)
+
+
+if __name__ == '__main__':
+    import sys
+
+    def success(jobj):
+        print( json.dumps(jobj,indent=4,sort_keys=True) )
+        sys.exit(0)
+
+    def failure():
+        print( "timeout" )
+        sys.exit(-1)
+
+    jobj = async_inspect(sys.argv[1], success, failure)
+    time.sleep( 70 )
+
+
@@ -0,0 +1,148 @@
+"""
+Incremental parser for the key=value report ffmpeg writes with
+'-progress pipe:1'. A report is a block of lines such as
+
+    frame=138
+    fps=11.00
+    stream_0_0_q=31.0
+    stream_0_0_psnr_all=32.10
+    bitrate= 882.1kbits/s
+    total_size=882000
+    out_time_us=12533333
+    dup_frames=0
+    drop_frames=0
+    speed=1.01x
+    progress=continue
+
+terminated by the progress key. Each complete block becomes a
+ProgressStats record, ProgressAggregator keeps rolling windows of them.
+"""
+import collections
+import time
+
+STATS_WINDOWS = (10, 60)
+
+_units = {
+    'bits/s': 1,
+    'kbits/s': 1000,
+    'mbits/s': 1000000,
+}
+
+
+def _number(text, cast=float):
+    text = text.strip()
+    try:
+        return cast(text)
+    except ValueError:
+        # N/A or empty
+        return None
+
+def _bitrate(text):
+    text = text.strip().lower()
+    for unit in ('kbits/s', 'mbits/s', 'bits/s'):
+        if text.endswith(unit):
+            value = _number(text[:-len(unit)])
+            return value * _units[unit] if value is not None else None
+    return _number(text)
+
+
+class ProgressStats:
+    __slots__ = ('time', 'frame', 'fps', 'bitrate', 'total_size',
+        'out_time_us', 'dup_frames', 'drop_frames', 'speed', 'psnr', 'end')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+    def asdict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class ProgressParser:
+    def __init__(self):
+        self.current = ProgressStats()
+
+    def feed(self, line):
+        """ Parse one line, returns a ProgressStats once a block is
+            complete otherwise None.
+        """
+        key, sep, value = line.partition('=')
+        if not sep:
+            return None
+        key = key.strip()
+        rec = self.current
+
+        if key == 'frame':
+            rec.frame = _number(value, int)
+        elif key == 'fps':
+            rec.fps = _number(value)
+        elif key == 'bitrate':
+            rec.bitrate = _bitrate(value)
+        elif key == 'total_size':
+            rec.total_size = _number(value, int)
+        elif key == 'out_time_us':
+            rec.out_time_us = _number(value, int)
+        elif key == 'dup_frames':
+            rec.dup_frames = _number(value, int)
+        elif key == 'drop_frames':
+            rec.drop_frames = _number(value, int)
+        elif key == 'speed':
+            rec.speed = _number(value.strip().rstrip('x'))
+        elif key.endswith('_psnr_all'):
+            # only the first output stream is reported
+            if rec.psnr is None:
+                rec.psnr = _number(value)
+        elif key == 'progress':
+            rec.end = value.strip() == 'end'
+            rec.time = time.time()
+            self.current = ProgressStats()
+            return rec
+        return None
+
+
+class ProgressAggregator:
+    """ Keeps the records of the last max(windows) seconds and reduces
+        them to mean/min/max fps, mean bitrate and drop rate per window.
+    """
+    def __init__(self, windows=STATS_WINDOWS):
+        self.windows = windows
+        self.records = collections.deque()
+
+    def add(self, rec):
+        self.records.append(rec)
+        horizon = rec.time - max(self.windows)
+        while self.records[0].time < horizon:
+            self.records.popleft()
+
+    def window(self, seconds, now=None):
+        now = now or time.time()
+        recs = [r for r in self.records if r.time >= now - seconds]
+        fps = [r.fps for r in recs if r.fps is not None]
+        bitrate = [r.bitrate for r in recs if r.bitrate is not None]
+        result = {
+            'fps_mean': sum(fps) / len(fps) if fps else None,
+            'fps_min': min(fps) if fps else None,
+            'fps_max': max(fps) if fps else None,
+            'bitrate': sum(bitrate) / len(bitrate) if bitrate else None,
+            'drop_rate': None
+        }
+        counted = [r for r in recs if r.frame is not None and
+            r.drop_frames is not None]
+        if len(counted) > 1:
+            frames = counted[-1].frame - counted[0].frame
+            drops = counted[-1].drop_frames - counted[0].drop_frames
+            if frames + drops > 0:
+                result['drop_rate'] = float(drops) / (frames + drops)
+        return result
+
+    def report(self):
+        """ Latest record plus the window aggregates, 'fps', 'psnr' and
+            'bitrate' keep the names earlier stats messages used.
+        """
+        if not self.records:
+            return None
+        latest = self.records[-1]
+        stats = latest.asdict()
+        stats['windows'] = dict(
+            ('%ds' % w, self.window(w, latest.time)) for w in self.windows)
+        return stats
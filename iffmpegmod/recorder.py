@@ -0,0 +1,360 @@
+"""
+Records a stream into rotating segment files under RECORD_DIR/<streamId>/
+named by their start time in milliseconds, tuned for many streams
+writing to slow flash:
+
+1. chunks are retained (not copied) as they arrive and written with one
+   os.writev once batchBytes have accumulated or the oldest has waited
+   maxDelay seconds. The queue and the batch together hold at most
+   QUEUE_SIZE + BATCH_BYTES / slot size ring slots, well within the 32
+   an InputStream's ring starts with, so recording never pushes the
+   reader onto grown or temporary buffers.
+2. each segment is preallocated with fallocate(FALLOC_FL_KEEP_SIZE) so
+   the filesystem can place it contiguously while the file size stays
+   what was written, and truncated on close to free what was not used.
+3. data is fdatasync'ed every fsyncInterval seconds (None only at the
+   end of each segment).
+4. a segment ends at the first keyframe after segmentSeconds or
+   segmentBytes and starts with a copy of the stream's AVI header, then
+   the oldest segments of all streams are removed until RECORD_DIR fits
+   in budget bytes.
+
+Each segment gets a segmentIndex next to it with the time, offset and
+keyframe flag of every frame, see segmentIndex.extract_clip().
+
+By default the recorder takes the record output of the stream's graph
+(filterGraph.RecordOutput, a stream copy of the input) which Stream adds
+when record is set.
+"""
+import ctypes
+import logging
+import os
+import threading
+import time
+import config
+import filterGraph
+import aviDemux
+import ringBuffer
+import segmentIndex
+import signals
+
+RECORD_DIR = config.DATA_DIR + "recordings/"
+RECORD_BUDGET = 8 << 30
+SEGMENT_SECONDS = 300
+SEGMENT_BYTES = 256 << 20
+# 4 ring slots of 64k
+BATCH_BYTES = 256 << 10
+MAX_DELAY = 0.5
+FSYNC_INTERVAL = 10
+QUEUE_SIZE = 16
+# os.writev takes at most IOV_MAX buffers
+IOV_MAX = os.sysconf("SC_IOV_MAX") if "SC_IOV_MAX" in os.sysconf_names else 1024
+
+FALLOC_FL_KEEP_SIZE = 1
+
+_budget_lock = threading.Lock()
+# segments being written, never removed by enforce_budget
+_open_segments = set()
+
+
+def preallocate(fd, size):
+    """ Reserve size bytes for fd without changing its size, False where
+        fallocate is not supported.
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fallocate = libc.fallocate
+    except (OSError, AttributeError):
+        return False
+    fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    return fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) == 0
+
+def segments(root=RECORD_DIR):
+    """ [(path, size, mtime)] of every segment under root, oldest first """
+    found = []
+    for sid in os.listdir(root) if os.path.isdir(root) else []:
+        d = os.path.join(root, sid)
+        if not os.path.isdir(d):
+            continue
+        for name in os.listdir(d):
+            if not name.endswith(".avi"):
+                continue
+            try:
+                st = os.stat(os.path.join(d, name))
+            except FileNotFoundError:
+                continue
+            found.append((os.path.join(d, name), st.st_size, st.st_mtime))
+    found.sort(key=lambda s: s[2])
+    return found
+
+def enforce_budget(budget=RECORD_BUDGET, root=RECORD_DIR):
+    """ Remove the oldest closed segments until root holds at most budget
+        bytes, open segments count with what was written so far.
+    """
+    with _budget_lock:
+        found = segments(root)
+        total = sum(s[1] for s in found)
+        for path, size, mtime in found:
+            if total <= budget:
+                break
+            if path in _open_segments:
+                continue
+            try:
+                os.unlink(path)
+                os.unlink(path[:-4] + ".idx")
+            except FileNotFoundError:
+                pass
+            total -= size
+            logging.info("recorder: removed %s to stay within budget" % path)
+
+
+class Recorder:
+    def __init__(self, streamId, topic=None, segmentSeconds=SEGMENT_SECONDS,
+            segmentBytes=SEGMENT_BYTES, budget=RECORD_BUDGET,
+            batchBytes=BATCH_BYTES, maxDelay=MAX_DELAY,
+            fsyncInterval=FSYNC_INTERVAL, root=RECORD_DIR):
+        self.sid = streamId
+        self.topic = topic or config.StreamOutputTopic(streamId,
+            filterGraph.OUTPUT_RECORD)
+        self.stop_topic = config.StreamStopTopic(streamId)
+        self.segmentSeconds = segmentSeconds
+        self.segmentBytes = segmentBytes
+        self.budget = budget
+        self.batchBytes = batchBytes
+        self.maxDelay = maxDelay
+        self.fsyncInterval = fsyncInterval
+        self.root = root
+        self.dir = os.path.join(root, streamId)
+
+        # only frame positions are needed, the payloads are written from
+        # pending
+        self.demuxer = aviDemux.Demuxer(parts=False)
+        # stream offset of the next byte fed
+        self.stream_pos = 0
+        # [(stream offset, view)] not written yet
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_since = None
+        # [(time, stream offset, size, flags)] not indexed yet
+        self.events = []
+        # stream offset the current segment starts at and the header
+        # written in front of it
+        self.base = 0
+        self.prefix = None
+        self.prefix_len = 0
+        self.fd = None
+        self.index = None
+        self.path = None
+        self.written = 0
+        self.segment_start = 0
+        self.next_sync = 0
+        self.lock = threading.Lock()
+        self.subscribed = False
+
+        # totals
+        self.bytes = 0
+        self.writes = 0
+        self.rotations = 0
+
+    def _open(self, now):
+        os.makedirs(self.dir, exist_ok=True)
+        self.path = os.path.join(self.dir, "%013d.avi" % int(now * 1000))
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.index = segmentIndex.IndexWriter(self.path[:-4] + ".idx")
+        _open_segments.add(self.path)
+        if not preallocate(self.fd, self.segmentBytes):
+            # not supported on every filesystem (tmpfs on old kernels)
+            logging.debug("recorder: fallocate %s: %s" % (self.path,
+                os.strerror(ctypes.get_errno())))
+        self.written = 0
+        self.prefix_len = 0
+        if self.prefix:
+            # later segments of a stream repeat its header so each one
+            # plays on its own
+            self._write([self.prefix])
+            self.prefix_len = len(self.prefix)
+            self.index.add(now, 0, self.prefix_len, segmentIndex.FLAG_HEADER)
+        self.segment_start = now
+        if self.fsyncInterval:
+            self.next_sync = now + self.fsyncInterval
+
+    def _close(self):
+        if self.fd is None:
+            return
+        self.index.close()
+        self.index = None
+        os.ftruncate(self.fd, self.written)
+        os.fdatasync(self.fd)
+        os.close(self.fd)
+        _open_segments.discard(self.path)
+        self.fd = None
+        self.rotations += 1
+
+    def _write(self, bufs):
+        while bufs:
+            n = os.writev(self.fd, bufs[:IOV_MAX])
+            self.written += n
+            self.bytes += n
+            self.writes += 1
+            # drop what was written, a short write leaves part of a buffer
+            while bufs and n >= len(bufs[0]):
+                n -= len(bufs[0])
+                bufs = bufs[1:]
+            if n:
+                bufs[0] = memoryview(bufs[0])[n:]
+
+    def _split(self, offset):
+        """ Split pending at stream offset, the view across it is sliced
+            and both halves hold a reference.
+        """
+        before = []
+        after = []
+        for pos, view in self.pending:
+            if pos + len(view) <= offset:
+                before.append((pos, view))
+            elif pos >= offset:
+                after.append((pos, view))
+            else:
+                tail = view[offset - pos:]
+                ringBuffer.retain(tail)
+                before.append((pos, view[:offset - pos]))
+                after.append((offset, tail))
+        return before, after
+
+    def _flush(self, now, limit):
+        """ Write pending bytes before stream offset limit, must hold
+            self.lock.
+        """
+        batch, self.pending = self._split(limit)
+        self.pending_bytes = sum(len(v) for p, v in self.pending)
+        self.pending_since = now if self.pending else None
+        if not batch:
+            return
+        if self.fd is None:
+            self._open(now)
+        try:
+            self._write([v for p, v in batch])
+        finally:
+            for pos, view in batch:
+                ringBuffer.release(view)
+        delta = self.prefix_len - self.base
+        while self.events and self.events[0][1] < limit:
+            stamp, offset, size, flags = self.events.pop(0)
+            self.index.add(stamp, offset + delta, size, flags)
+        self.index.flush()
+        if self.fsyncInterval and now >= self.next_sync:
+            os.fdatasync(self.fd)
+            self.index.sync()
+            self.next_sync = now + self.fsyncInterval
+
+    def _due(self, now):
+        return self.fd is not None and (now - self.segment_start >= self.segmentSeconds
+            or self.written + self.pending_bytes >= self.segmentBytes)
+
+    def _cut(self, offset, prefix, now):
+        """ End the segment at stream offset, the next one starts there
+            with prefix in front.
+        """
+        self._flush(now, offset)
+        self._close()
+        self.base = offset
+        self.prefix = prefix
+
+    def flush(self):
+        """ Write everything received so far. """
+        with self.lock:
+            self._flush(time.time(), self.stream_pos)
+
+    def feed(self, chunk):
+        # keep the ring slot past this callback instead of copying it
+        if not ringBuffer.retain(chunk):
+            chunk = memoryview(bytes(chunk))
+        now = time.time()
+        rotated = False
+        with self.lock:
+            pos = self.stream_pos
+            self.stream_pos += len(chunk)
+            self.pending.append((pos, chunk))
+            self.pending_bytes += len(chunk)
+            if self.pending_since is None:
+                self.pending_since = now
+
+            for item in self.demuxer.feed(chunk):
+                if isinstance(item, aviDemux.Header):
+                    if item.offset > self.base:
+                        # ffmpeg restarted, the new stream starts a segment
+                        self._cut(item.offset, None, now)
+                        rotated = True
+                    self.events.append((now, item.offset, item.size,
+                        segmentIndex.FLAG_HEADER))
+                elif item.video:
+                    if item.keyframe and self._due(now):
+                        self._cut(item.offset, self.demuxer.header, now)
+                        rotated = True
+                    self.events.append((now, item.offset, item.chunk_size,
+                        segmentIndex.FLAG_KEYFRAME if item.keyframe else 0))
+
+            if self.pending_bytes >= self.batchBytes or \
+                    now - self.pending_since >= self.maxDelay:
+                held = self.demuxer.holding()
+                self._flush(now, self.stream_pos if held is None else held)
+                if self.demuxer.failed and self._due(now):
+                    # not an avi stream, rotate without regard to frames
+                    self._close()
+                    self.base = self.stream_pos
+                    rotated = True
+        if rotated:
+            enforce_budget(self.budget, self.root)
+
+    def start(self):
+        if not self.subscribed:
+            signals.subscribe_async(self.topic, self.feed, maxsize=QUEUE_SIZE)
+            signals.subscribe(self.stop_topic, self.stop)
+            self.subscribed = True
+
+    def stop(self):
+        if self.subscribed:
+            signals.unsubscribe(self.topic, self.feed)
+            signals.unsubscribe(self.stop_topic, self.stop)
+            self.subscribed = False
+        self.flush()
+        with self.lock:
+            self._close()
+        enforce_budget(self.budget, self.root)
+
+
+def onStreamCreate(stream):
+    if stream.record:
+        recorder = Recorder(stream.sid)
+        recorder.start()
+        return recorder
+
+
+def benchmark(streams=16, seconds=10, chunk=0xFFFF, root="/tmp/iffmpeg-recorder-bench/"):
+    """ Sustained MB/s of streams recorders fed from one thread, compared
+        with a write per chunk.
+    """
+    import shutil
+    data = memoryview(bytearray(os.urandom(chunk)))
+    for batched in (False, True):
+        shutil.rmtree(root, ignore_errors=True)
+        recorders = [Recorder("bench%d" % i, root=root, batchBytes=
+            BATCH_BYTES if batched else 0, segmentSeconds=seconds * 2)
+            for i in range(streams)]
+        start = time.time()
+        while time.time() - start < seconds:
+            for r in recorders:
+                r.feed(data)
+        for r in recorders:
+            r.flush()
+            r._close()
+        elapsed = time.time() - start
+        total = sum(r.bytes for r in recorders)
+        writes = sum(r.writes for r in recorders)
+        print("%s: %.1f MB/s in %d writes" % ("batched" if batched else "per chunk",
+            total / elapsed / 1e6, writes))
+    shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,115 @@
+"""
+Preallocated pool of fixed size buffers that a pipe is drained into with
+readinto semantics. Each read hands out a memoryview slice of a slot so
+the same bytes can be fanned out to every subscriber without allocating
+or copying.
+
+Slots are reference counted. The reader holds one reference while it
+publishes the view, anyone keeping the view past the callback (the
+async subscribers in signals for example) calls retain(view) and later
+release(view). A slot is only read into again once its count is zero.
+
+Subscribers hold slots for as long as their queues are deep, so when
+every slot is still referenced the ring grows by a slot, up to
+maxSlots. Only past that a temporary buffer is allocated, counted in
+RingBuffer.allocations (see metrics). Temporary buffers are not ring
+slots, retain() and release() ignore them and holders simply keep the
+buffer alive.
+"""
+import os
+import threading
+
+# default bound on slots added while subscribers hold the initial ones
+MAX_SLOTS = 256
+
+
+class _Slot(bytearray):
+    """ A ring slot, knows its ring so a bare memoryview can be retained. """
+    __slots__ = ('ring', 'index')
+
+
+class RingBuffer:
+    def __init__(self, slots=32, slotSize=0xFFFF, maxSlots=MAX_SLOTS):
+        self.slotSize = slotSize
+        self.maxSlots = max(slots, maxSlots)
+        self.slots = []
+        self.refs = []
+        self.index = 0
+        self.lock = threading.Lock()
+        self.allocations = 0
+        for i in range(slots):
+            self._add_slot()
+
+    def _add_slot(self):
+        buf = _Slot(self.slotSize)
+        buf.ring = self
+        buf.index = len(self.slots)
+        self.slots.append(buf)
+        self.refs.append(0)
+        return buf
+
+    def _acquire(self):
+        with self.lock:
+            count = len(self.slots)
+            for n in range(count):
+                i = (self.index + n) % count
+                if self.refs[i] == 0:
+                    self.refs[i] = 1
+                    self.index = (i + 1) % count
+                    return self.slots[i]
+            if count < self.maxSlots:
+                buf = self._add_slot()
+                self.refs[buf.index] = 1
+                return buf
+            self.allocations += 1
+        return bytearray(self.slotSize)
+
+    def readinto(self, fd, batch=1):
+        """ Read from fd into the next free slot. Up to batch reads are
+            made to fill the slot, fd should be non blocking when batch is
+            more than 1. Returns a memoryview holding one reference to
+            the slot or None if nothing was read.
+        """
+        buf = self._acquire()
+        view = memoryview(buf)
+        n = 0
+        for i in range(batch):
+            try:
+                r = os.readv(fd, [view[n:]])
+            except BlockingIOError:
+                break
+            if r == 0:
+                break
+            n += r
+            if n == len(buf):
+                break
+        if n == 0:
+            release(view)
+            return None
+        return view[:n]
+
+    def in_use(self):
+        return len(self.slots) - self.refs.count(0)
+
+
+def retain(view):
+    """ Take a reference on the slot backing view, returns False if the
+        view is not backed by a ring slot.
+    """
+    slot = view.obj if isinstance(view, memoryview) else None
+    if not isinstance(slot, _Slot):
+        return False
+    ring = slot.ring
+    with ring.lock:
+        ring.refs[slot.index] += 1
+    return True
+
+def release(view):
+    slot = view.obj if isinstance(view, memoryview) else None
+    if not isinstance(slot, _Slot):
+        return False
+    ring = slot.ring
+    with ring.lock:
+        if ring.refs[slot.index] > 0:
+            ring.refs[slot.index] -= 1
+    return True
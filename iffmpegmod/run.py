@@ -3,7 +3,7 @@
 Runs the iffmpeg daemon service. 
 """
 import config
-from pubsub import pub
+import signals
 import paho.mqtt.client as mqtt
 import json
 
@@ -12,9 +12,9 @@ class MqttCommunication:
         self.client = mqtt.Client()
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
-        self.will_set(config.MQTT_SERVICE_DOWN_TOPIC, 
+        self.client.will_set(config.MQTT_SERVICE_DOWN_TOPIC, 
             payload=json.dumps({
-                "id": serviceId
+                "id": streamId
             })
         )
         self.routes = {}
@@ -28,16 +28,16 @@ class MqttCommunication:
         self.routes[topic] = handler
 
     def start(self):
-        self.client.start_loop()
+        self.client.loop_start()
         
     def stop(self):
-        self.client.stop_loop()
+        self.client.loop_stop()
 
      # The callback for when the client receives a CONNACK response from the server.
     def on_connect(self, client, userdata, flags, rc):
-        pub.subscribe(self.mqtt_send,"mqtt-send")
-        pub.subscribe(self.mqtt_listen,"mqtt-listen")
-        pub.sendMessage("mqtt-ready", streamId=self.sid)
+        signals.subscribe("mqtt-send", self.mqtt_send)
+        signals.subscribe("mqtt-listen", self.mqtt_listen)
+        signals.publish("mqtt-ready", self.sid)
 
     # The callback for when a PUBLISH message is received from the server.
     def on_message(self, client, userdata, msg):
@@ -46,3 +46,45 @@ class MqttCommunication:
             cb(msg)
             
 
+
+def _client(nodeId, encoding):
+    """ The paho client of nodeId, its will announces the node down, and
+        the mqttBridge.MqttBridge on it. Neither is connected yet.
+    """
+    import mqttBridge
+    client = mqtt.Client(client_id=nodeId)
+    client.will_set(config.MQTT_SERVICE_DOWN_TOPIC,
+        payload=json.dumps({"id": nodeId}), qos=1)
+    return client, mqttBridge.MqttBridge(client, nodeId, encoding=encoding)
+
+
+def _connect(client, *started):
+    """ Connect client in the background, then start the objects using it.
+    """
+    client.connect_async(config.MQTT_BROKER_IP, config.MQTT_BROKER_PORT, 60)
+    client.loop_start()
+    for o in started:
+        o.start()
+
+
+def start_bridge(nodeId, encoding=config.MQTT_ENCODING):
+    """ Connects to the broker and returns a started mqttBridge.MqttBridge,
+        streams are forwarded with bridge.forward_stream(streamId).
+    """
+    client, bridge = _client(nodeId, encoding)
+    _connect(client, bridge)
+    return bridge
+
+
+def start_node(nodeId, manager, capabilities=None, encoding=config.MQTT_ENCODING):
+    """ Joins the cluster: a mqttBridge.MqttBridge and a cluster.NodeAgent
+        starting the streams assigned to this node on manager
+        (streamManager.StreamManager). Returns (bridge, agent).
+    """
+    import cluster
+    client, bridge = _client(nodeId, encoding)
+    # the agent subscribes on connect, it is created first
+    local = cluster.LocalStreams(manager)
+    agent = cluster.NodeAgent(client, nodeId, local.start, local.stop, capabilities)
+    _connect(client, bridge, agent)
+    return bridge, agent
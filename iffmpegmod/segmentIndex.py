@@ -0,0 +1,176 @@
+"""
+Keyframe/timestamp index of recorded segments and clip extraction.
+
+Next to each segment <start ms>.avi the recorder appends fixed size
+records to <start ms>.idx as it writes:
+
+    time (double, epoch seconds), file offset (u64), size (u32), flags (u32)
+
+one per video frame plus a FLAG_HEADER record for the AVI header at the
+start of the segment. The file is only ever appended to so a reader can
+mmap it while it grows and binary search on time, a torn last record is
+ignored.
+
+extract_clip() uses the indexes to copy the header and the byte ranges
+from the keyframe at or before the start of the clip to the last frame
+before its end, across segments, without decoding or scanning the
+recordings.
+
+The recorder learns where frames and keyframes are from aviDemux.
+"""
+import bisect
+import mmap
+import os
+import struct
+
+RECORD = struct.Struct("<dQII")
+
+FLAG_KEYFRAME = 1
+FLAG_HEADER = 2
+
+
+class IndexWriter:
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.pending = []
+
+    def add(self, stamp, offset, size, flags):
+        self.pending.append(RECORD.pack(stamp, offset, size, flags))
+
+    def flush(self):
+        if self.pending:
+            os.write(self.fd, b"".join(self.pending))
+            self.pending = []
+
+    def sync(self):
+        os.fdatasync(self.fd)
+
+    def close(self):
+        self.flush()
+        os.close(self.fd)
+
+
+class Index:
+    """ Read only view of an index file, entries are (time, offset, size,
+        flags) tuples.
+    """
+    def __init__(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            self.map = mmap.mmap(fd, size, prot=mmap.PROT_READ) if size else None
+        finally:
+            os.close(fd)
+        self.count = size // RECORD.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return RECORD.unpack_from(self.map, i * RECORD.size)
+
+    def close(self):
+        if self.map:
+            self.map.close()
+
+    def header(self):
+        for i in range(self.count):
+            entry = self[i]
+            if entry[3] & FLAG_HEADER:
+                return entry
+        return None
+
+    def find(self, stamp):
+        """ Index of the first entry at or after stamp """
+        return bisect.bisect_left(self, stamp, key=lambda e: e[0])
+
+    def keyframe_before(self, stamp):
+        """ Index of the last keyframe at or before stamp, or the first
+            keyframe when there is none before.
+        """
+        i = bisect.bisect_right(self, stamp, key=lambda e: e[0]) - 1
+        for j in range(i, -1, -1):
+            if self[j][3] & FLAG_KEYFRAME:
+                return j
+        for j in range(max(i, 0), self.count):
+            if self[j][3] & FLAG_KEYFRAME:
+                return j
+        return None
+
+
+def _segment_files(streamId, root):
+    d = os.path.join(root, streamId)
+    names = sorted(n for n in os.listdir(d) if n.endswith(".avi")) \
+        if os.path.isdir(d) else []
+    return [(int(n[:-4]) / 1000.0, os.path.join(d, n)) for n in names]
+
+def _copy(out, path, start, end):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        while start < end:
+            n = os.sendfile(out, fd, start, end - start)
+            if n == 0:
+                break
+            start += n
+    finally:
+        os.close(fd)
+
+def extract_clip(streamId, start, end, out, root=None):
+    """ Write the recording of streamId from start to end (epoch seconds)
+        to out, a path or a writable file descriptor. The clip begins
+        with the segment's AVI header and the keyframe at or before
+        start. Returns the number of bytes written.
+    """
+    if root is None:
+        import recorder
+        root = recorder.RECORD_DIR
+    files = _segment_files(streamId, root)
+    chosen = [path for i, (t, path) in enumerate(files)
+        if t < end and (i + 1 == len(files) or files[i + 1][0] > start)]
+
+    fd = os.open(out, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644) \
+        if isinstance(out, str) else out
+    written = 0
+    header = None
+    try:
+        for path in chosen:
+            if not os.path.exists(path[:-4] + ".idx"):
+                continue
+            index = Index(path[:-4] + ".idx")
+            try:
+                first = index.keyframe_before(start) if header is None else \
+                    index.keyframe_before(0)
+                if first is None:
+                    continue
+                last = index.find(end)
+                if last <= first:
+                    continue
+                entry = index.header()
+                if entry is None:
+                    continue
+                with open(path, 'rb') as f:
+                    f.seek(entry[1])
+                    data = f.read(entry[2])
+                if header is None:
+                    header = data
+                    os.write(fd, header)
+                    written += len(header)
+                elif data != header:
+                    # ffmpeg restarted with other parameters, the frames
+                    # that follow need their own header
+                    break
+                begin = index[first][1]
+                stop = index[last - 1][1] + index[last - 1][2]
+                _copy(fd, path, begin, stop)
+                written += stop - begin
+            finally:
+                index.close()
+    finally:
+        if isinstance(out, str):
+            os.close(fd)
+    return written
@@ -0,0 +1,289 @@
+"""
+Shared memory ring per stream so consumers in other processes can read
+video chunks without a copy through a socket or MQTT.
+
+InputStream owns a ShmWriter (conf 'sharedMemory') and writes every
+relay chunk into /dev/shm/iffmpeg-<streamId>. Any local process opens
+a ShmReader on the same streamId and reads at its own pace:
+
+    reader = shmRing.ShmReader("cam1")
+    while True:
+        r = reader.read(timeout=5)
+        if r:
+            seq, view = r
+            ... use view ...
+            if not reader.valid(seq):
+                # the writer lapped us while we were using view
+                ...
+
+Layout, little endian:
+
+    header   magic 'IFSR', slots, slotSize, pad, write sequence (u64)
+    slot     sequence (u64), length (u32), pad, slotSize bytes of data
+
+Sequence numbers start at 1 and chunk n goes to slot n % slots. The
+writer zeroes a slot's sequence while it copies so a reader can tell a
+slot that is being rewritten, a reader that falls more than slots
+behind skips ahead to the oldest chunk still in the ring and counts the
+chunks it missed in lost.
+
+Wakeups go through a FIFO per reader in SHM_FIFO_DIR named
+<streamId>.<pid>.<n>. The writer writes one byte to each after a chunk,
+a full FIFO means the reader has a wakeup pending already. FIFOs whose
+reader went away are removed by the writer.
+"""
+import itertools
+import logging
+import mmap
+import os
+import select
+import struct
+import time
+from multiprocessing import shared_memory
+import config
+
+SHM_FIFO_DIR = config.DATA_DIR + "shm/"
+SHM_PREFIX = "iffmpeg-"
+SHM_DIR = "/dev/shm/"
+# seconds between scans of SHM_FIFO_DIR for new readers
+RESCAN_INTERVAL = 1
+
+MAGIC = b"IFSR"
+HEADER = struct.Struct("<4sIII")
+SEQ = struct.Struct("<Q")
+SEQ_OFFSET = HEADER.size
+SLOT_HEADER = struct.Struct("<QI4x")
+DATA_OFFSET = 64
+
+READ_LATEST = "latest"
+READ_OLDEST = "oldest"
+
+_counter = itertools.count()
+
+
+def shm_name(streamId):
+    return SHM_PREFIX + streamId
+
+def _stride(slotSize):
+    # keep slots cache line aligned
+    return (SLOT_HEADER.size + slotSize + 63) & ~63
+
+
+class ShmWriter:
+    def __init__(self, streamId, slots=64, slotSize=0xFFFF):
+        self.streamId = streamId
+        self.slots = slots
+        self.slotSize = slotSize
+        self.stride = _stride(slotSize)
+        size = DATA_OFFSET + slots * self.stride
+        try:
+            self.shm = shared_memory.SharedMemory(shm_name(streamId), True, size)
+        except FileExistsError:
+            # left over from a daemon that did not exit cleanly
+            os.unlink(SHM_DIR + shm_name(streamId))
+            self.shm = shared_memory.SharedMemory(shm_name(streamId), True, size)
+        self.buf = self.shm.buf
+        HEADER.pack_into(self.buf, 0, MAGIC, slots, slotSize, 0)
+        SEQ.pack_into(self.buf, SEQ_OFFSET, 0)
+        self.seq = 0
+        # fifo path -> write fd
+        self.readers = {}
+        self.next_scan = 0
+        os.makedirs(SHM_FIFO_DIR, exist_ok=True)
+
+    def write(self, chunk):
+        """ Copy chunk into the next slot, returns its sequence number. """
+        n = len(chunk)
+        if n > self.slotSize:
+            raise ValueError("chunk of %d bytes exceeds slot size %d" % (n, self.slotSize))
+        seq = self.seq + 1
+        off = DATA_OFFSET + (seq % self.slots) * self.stride
+        SLOT_HEADER.pack_into(self.buf, off, 0, 0)
+        data = off + SLOT_HEADER.size
+        self.buf[data:data + n] = chunk
+        SLOT_HEADER.pack_into(self.buf, off, seq, n)
+        SEQ.pack_into(self.buf, SEQ_OFFSET, seq)
+        self.seq = seq
+        self._wake()
+        return seq
+
+    def _scan(self):
+        prefix = self.streamId + "."
+        for name in os.listdir(SHM_FIFO_DIR):
+            path = SHM_FIFO_DIR + name
+            if not name.startswith(prefix) or path in self.readers:
+                continue
+            try:
+                self.readers[path] = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError:
+                # ENXIO, nobody has the fifo open for reading anymore
+                self._remove(path)
+
+    def _remove(self, path):
+        fd = self.readers.pop(path, None)
+        if fd is not None:
+            os.close(fd)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _wake(self):
+        now = time.monotonic()
+        if now >= self.next_scan:
+            self.next_scan = now + RESCAN_INTERVAL
+            self._scan()
+        for path, fd in list(self.readers.items()):
+            try:
+                os.write(fd, b'\0')
+            except BlockingIOError:
+                pass
+            except OSError:
+                # EPIPE, the reader exited
+                self._remove(path)
+
+    def close(self):
+        for path in list(self.readers):
+            os.close(self.readers.pop(path))
+        self.buf = None
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class ShmReader:
+    def __init__(self, streamId, start=READ_LATEST):
+        # mapped directly rather than through SharedMemory, whose
+        # resource tracker would unlink the segment when a reader exits
+        fd = os.open(SHM_DIR + shm_name(streamId), os.O_RDONLY)
+        try:
+            self.map = mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+        finally:
+            os.close(fd)
+        self.buf = memoryview(self.map)
+        magic, self.slots, self.slotSize, pad = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a stream ring" % shm_name(streamId))
+        self.stride = _stride(self.slotSize)
+        self.lost = 0
+        self.overruns = 0
+
+        self.fifo = "%s%s.%d.%d" % (SHM_FIFO_DIR, streamId, os.getpid(), next(_counter))
+        os.makedirs(SHM_FIFO_DIR, exist_ok=True)
+        os.mkfifo(self.fifo)
+        # read/write so the fifo stays open when no writer is attached
+        self.fd = os.open(self.fifo, os.O_RDWR | os.O_NONBLOCK)
+
+        head = self.head()
+        self.next = head + 1 if start == READ_LATEST else max(head - self.slots + 2, 1)
+
+    def fileno(self):
+        """ Readable when a chunk may be available, for select/poll. """
+        return self.fd
+
+    def head(self):
+        return SEQ.unpack_from(self.buf, SEQ_OFFSET)[0]
+
+    def _slot(self, seq):
+        return DATA_OFFSET + (seq % self.slots) * self.stride
+
+    def _wait(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return False
+        try:
+            os.read(self.fd, 4096)
+        except BlockingIOError:
+            pass
+        return True
+
+    def read(self, timeout=None):
+        """ Returns (seq, memoryview) of the next chunk, or None if none
+            arrived within timeout seconds. The view points into shared
+            memory, check valid(seq) after using it.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            head = self.head()
+            if self.next > head:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if (remaining is not None and remaining <= 0) or not self._wait(remaining):
+                    return None
+                continue
+            oldest = head - self.slots + 2
+            if self.next < oldest:
+                self.overrun(oldest)
+            seq = self.next
+            off = self._slot(seq)
+            slotSeq, length = SLOT_HEADER.unpack_from(self.buf, off)
+            if slotSeq != seq:
+                # rewritten since we read head
+                self.overrun(self.head() - self.slots + 2)
+                continue
+            self.next = seq + 1
+            data = off + SLOT_HEADER.size
+            return seq, self.buf[data:data + length]
+
+    def read_bytes(self, timeout=None):
+        """ Like read but returns a verified copy of the chunk. """
+        while True:
+            r = self.read(timeout)
+            if r is None:
+                return None
+            seq, view = r
+            data = bytes(view)
+            view.release()
+            if self.valid(seq):
+                return seq, data
+            self.overrun(self.head() - self.slots + 2)
+
+    def valid(self, seq):
+        """ False if the slot of seq has been rewritten since it was read. """
+        return SLOT_HEADER.unpack_from(self.buf, self._slot(seq))[0] == seq
+
+    def overrun(self, oldest):
+        if oldest > self.next:
+            self.lost += oldest - self.next
+            self.overruns += 1
+            logging.debug("shm reader overrun, %d chunks lost" % (oldest - self.next))
+            self.next = oldest
+
+    def close(self):
+        os.close(self.fd)
+        try:
+            os.unlink(self.fifo)
+        except OSError:
+            pass
+        self.buf.release()
+        self.map.close()
+
+
+def unittest():
+    import sys
+    global SHM_FIFO_DIR
+    SHM_FIFO_DIR = "/tmp/iffmpeg-shm-unittest/"
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.DEBUG,
+        format="%(asctime)s %(message)s")
+
+    writer = ShmWriter("unittest", slots=8, slotSize=1024)
+    reader = ShmReader("unittest")
+    assert reader.read(timeout=0.1) is None
+    writer.write(b"hello")
+    seq, view = reader.read(timeout=1)
+    assert seq == 1 and bytes(view) == b"hello" and reader.valid(seq)
+    view.release()
+
+    for i in range(20):
+        writer.write(b"chunk %d" % i)
+    seq, data = reader.read_bytes(timeout=1)
+    assert data == b"chunk 13" and reader.lost == 13, (seq, data, reader.lost)
+    reader.close()
+    writer.close()
+    logging.info("shm ring ok")
+
+
+if __name__ == '__main__':
+    unittest()
@@ -1,7 +1,249 @@
+"""
+Internal pubsub used to route video chunks, stats and faults between
+the objects of the daemon.
+
+Subscribers added with subscribe() are called inline on the publisher's
+thread. Subscribers added with subscribe_async() get their own bounded
+queue and delivery thread so a slow consumer never stalls the producer,
+when the queue is full the topic's overflow policy decides what happens:
+
+    block          publisher waits for room in the queue
+    drop-oldest    oldest queued message is discarded (default)
+    drop-newest    the new message is discarded
+    keyframe-only  only messages whose first argument has a true
+                   'keyframe' attribute are queued, displacing queued
+                   non keyframe messages
+
+Every topic counts messages and bytes published and every subscriber
+counts calls, errors and handler time (see topic_stats/handler_stats,
+exported by the metrics module). A failing handler logs its traceback
+at most once per ERROR_LOG_INTERVAL seconds.
+"""
+import collections
 import logging
+import threading
+import time
 import traceback
+import config
+import ringBuffer
+import latency
+
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_OLDEST = "drop-oldest"
+OVERFLOW_DROP_NEWEST = "drop-newest"
+OVERFLOW_KEYFRAME_ONLY = "keyframe-only"
+
+DEFAULT_QUEUE_SIZE = 64
+ERROR_LOG_INTERVAL = 60
+
+# time every handler call
+metrics_enabled = config.SIGNALS_METRICS
 
 __pubsub = {}
+__policy = {}
+__lock = threading.Lock()
+# topic -> [messages, bytes]
+__topics = {}
+# (topic, callback) -> HandlerStats
+__handlers = {}
+
+
+def _hold(args):
+    # queued video chunks and frames are borrowed ring buffer slots, keep
+    # them from being read into again until delivered
+    for arg in args:
+        if isinstance(arg, memoryview):
+            ringBuffer.retain(arg)
+        elif hasattr(arg, 'retain'):
+            arg.retain()
+
+def _unhold(args):
+    for arg in args:
+        if isinstance(arg, memoryview):
+            ringBuffer.release(arg)
+        elif hasattr(arg, 'release'):
+            arg.release()
+
+def _name(callback):
+    return getattr(callback, '__qualname__', None) or str(callback)
+
+def _is_keyframe(args):
+    return len(args) > 0 and bool(getattr(args[0], 'keyframe', False))
+
+
+class HandlerStats:
+    """ Counters of one subscriber of one topic, also rate limits the
+        logging of its exceptions.
+    """
+    def __init__(self, topic, callback):
+        self.topic = topic
+        self.subscriber = _name(callback)
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.histogram = latency.Histogram()
+        self.suppressed = 0
+        self.next_log = 0
+
+    def call(self, callback, args):
+        if not metrics_enabled:
+            self.calls += 1
+            try:
+                callback(*args)
+            except:
+                self.error()
+            return
+
+        start = time.monotonic()
+        try:
+            callback(*args)
+        except:
+            self.error()
+        elapsed = time.monotonic() - start
+        self.calls += 1
+        self.seconds += elapsed
+        self.histogram.record(int(elapsed * 1000000))
+
+    def error(self):
+        self.errors += 1
+        now = time.monotonic()
+        if now < self.next_log:
+            self.suppressed += 1
+            return
+        if self.suppressed:
+            logging.error("%d errors of %s on %s not logged" % (
+                self.suppressed, self.subscriber, self.topic))
+        logging.error(traceback.format_exc())
+        self.suppressed = 0
+        self.next_log = now + ERROR_LOG_INTERVAL
+
+def _handler(topic, callback):
+    stats = __handlers.get((topic, callback))
+    if stats is None:
+        stats = __handlers.setdefault((topic, callback),
+            HandlerStats(topic, callback))
+    return stats
+
+
+class AsyncSubscriber:
+    """ Wraps a callback with a bounded queue and a delivery thread, the
+        publisher only ever enqueues.
+    """
+    def __init__(self, topic, callback, maxsize=DEFAULT_QUEUE_SIZE, policy=None,
+            accept=None):
+        self.topic = topic
+        self.callback = callback
+        self.maxsize = maxsize
+        # None means use the policy of the topic
+        self.policy = policy
+        # predicate run on the publisher's thread, rejected messages are
+        # never queued
+        self.accept = accept
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.delivered = 0
+        self.dropped = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._deliver,
+            name="signals-%s" % topic)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __str__(self):
+        return "async(%s)" % str(self.callback)
+
+    def overflow_policy(self):
+        return self.policy or get_overflow_policy(self.topic)
+
+    def __call__(self, *args):
+        # the trace context travels with the message to the delivery thread
+        if self.accept is not None and not self.accept(*args):
+            return
+        trace = latency.context() if latency.enabled else None
+        with self.cond:
+            if not self.running:
+                return
+            if len(self.queue) >= self.maxsize:
+                policy = self.overflow_policy()
+                if policy == OVERFLOW_BLOCK:
+                    while self.running and len(self.queue) >= self.maxsize:
+                        self.cond.wait()
+                    if not self.running:
+                        # stopped while waiting, nothing drains the queue
+                        return
+                elif policy == OVERFLOW_DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                elif policy == OVERFLOW_KEYFRAME_ONLY:
+                    if not _is_keyframe(args):
+                        self.dropped += 1
+                        return
+                    self._evict_non_keyframe()
+                else:
+                    _unhold(self.queue.popleft()[0])
+                    self.dropped += 1
+            _hold(args)
+            self.queue.append((args, trace))
+            self.cond.notify_all()
+
+    def _evict_non_keyframe(self):
+        for i, (queued, trace) in enumerate(self.queue):
+            if not _is_keyframe(queued):
+                del self.queue[i]
+                _unhold(queued)
+                break
+        else:
+            _unhold(self.queue.popleft()[0])
+        self.dropped += 1
+
+    def _deliver(self):
+        while True:
+            with self.cond:
+                while self.running and len(self.queue) == 0:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                args, trace = self.queue.popleft()
+                # wake publishers blocked on a full queue
+                self.cond.notify_all()
+            if trace:
+                latency.begin(*trace)
+                latency.record(trace[0], _name(self.callback), trace[1])
+            _handler(self.topic, self.callback).call(self.callback, args)
+            if trace:
+                latency.end()
+            _unhold(args)
+            self.delivered += 1
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            for args, trace in self.queue:
+                _unhold(args)
+            self.queue.clear()
+            self.cond.notify_all()
+
+    def stats(self):
+        return {
+            'topic': self.topic,
+            'subscriber': _name(self.callback),
+            'policy': self.overflow_policy(),
+            'depth': len(self.queue),
+            'maxsize': self.maxsize,
+            'delivered': self.delivered,
+            'dropped': self.dropped
+        }
+
+
+def set_overflow_policy(topic, policy):
+    global __policy
+    if policy not in (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST,
+            OVERFLOW_DROP_NEWEST, OVERFLOW_KEYFRAME_ONLY):
+        raise ValueError("unknown overflow policy %s" % policy)
+    __policy[topic] = policy
+
+def get_overflow_policy(topic):
+    return __policy.get(topic, OVERFLOW_DROP_OLDEST)
 
 def subscribe(topic, callback):
     global __pubsub
@@ -9,9 +251,20 @@ def subscribe(topic, callback):
     logging.debug("subscribe to %s, callback = %s" % (
         topic, str(callback) ))
 
-    if topic not in __pubsub: 
-        __pubsub[topic] = []
-    __pubsub[topic].append(callback)
+    # replace rather than mutate the list so publish() can iterate
+    # without holding the lock
+    with __lock:
+        __pubsub[topic] = __pubsub.get(topic, []) + [callback]
+
+def subscribe_async(topic, callback, maxsize=DEFAULT_QUEUE_SIZE, policy=None,
+        accept=None):
+    """ Subscribe callback so it is called from its own delivery thread,
+        returns the AsyncSubscriber which can also be passed to unsubscribe.
+        Only messages for which accept(*args) is true are queued.
+    """
+    subscriber = AsyncSubscriber(topic, callback, maxsize, policy, accept)
+    subscribe(topic, subscriber)
+    return subscriber
 
 def unsubscribe(topic, callback):
     global __pubsub
@@ -19,18 +272,65 @@ def unsubscribe(topic, callback):
     logging.debug("unsubscribe to %s, callback = %s" % (
         topic, str(callback) ))
 
-    if topic not in __pubsub and callback in __pubsub[topic]:
-        del __pubsub[topic][ __pubsub[topic].index(callback) ]
-        if len(__pubsub[topic]) == 0:
+    with __lock:
+        callbacks = __pubsub.get(topic, [])
+        for cb in callbacks:
+            if cb == callback or (isinstance(cb, AsyncSubscriber) and
+                    cb.callback == callback):
+                break
+        else:
+            return
+        callbacks = [c for c in callbacks if c is not cb]
+        if len(callbacks) == 0:
             del __pubsub[topic]
+        else:
+            __pubsub[topic] = callbacks
+
+    __handlers.pop((topic, cb), None)
+    if isinstance(cb, AsyncSubscriber):
+        __handlers.pop((topic, cb.callback), None)
+        cb.stop()
 
 def publish(topic, *args):
-    if topic in __pubsub:
-        for cb in __pubsub[topic]:
-            try:  
+    # one read, unsubscribe() may remove the topic meanwhile, the list
+    # itself is never mutated
+    callbacks = __pubsub.get(topic)
+    if callbacks is not None:
+        counts = __topics.get(topic)
+        if counts is None:
+            counts = __topics.setdefault(topic, [0, 0])
+        counts[0] += 1
+        if len(args) > 0:
+            if isinstance(args[0], (bytes, bytearray)):
+                counts[1] += len(args[0])
+            elif hasattr(args[0], 'nbytes'):
+                # memoryview, aviDemux.Frame
+                counts[1] += args[0].nbytes
+
+        trace = latency.context() if latency.enabled else None
+        for cb in callbacks:
+            if isinstance(cb, AsyncSubscriber):
+                # only enqueues, the handler is timed on delivery
                 cb( *args )
-            except:
-                logging.error(traceback.format_exc())
- 
+                continue
+            if trace:
+                latency.record(trace[0], _name(cb), trace[1])
+            _handler(topic, cb).call(cb, args)
+
+def queue_stats():
+    """ Queue depth and drop counters of every async subscriber.
+    """
+    result = []
+    for callbacks in list(__pubsub.values()):
+        for cb in callbacks:
+            if isinstance(cb, AsyncSubscriber):
+                result.append(cb.stats())
+    return result
 
+def topic_stats():
+    """ {topic: (messages, bytes)} published so far. """
+    return dict((topic, tuple(c)) for topic, c in list(__topics.items()))
 
+def handler_stats():
+    """ HandlerStats of every subscriber that has been called. """
+    return list(__handlers.values())
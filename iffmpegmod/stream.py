@@ -1,5 +1,11 @@
+import importlib
+import logging
+import threading
 import signals
 import config
+import filterGraph
+import transcode
+import hlsServer
 
 """
 Describes at a high level a filter graph composed of processes
@@ -12,6 +18,9 @@ Input1 ---+--+
 Input2 --+---+                 |
                            recording   
 
+Each input is run by one ffmpeg: Stream.outputs() compiles the stages
+this stream needs into filterGraph outputs which share a single decode,
+stages can be attached and detached while the inputs are running.
 """
 
 
@@ -24,7 +33,7 @@ class StreamInputs:
         # [{
         #     url: ...,
         #     duration: ..., <- if mode=tour
-        #     panel: ..,  <- if mode=videoWall    
+        #     panel: {x, y, width, height}, <- if mode=videoWall
         # }]
         self.src = [] 
 
@@ -34,6 +43,9 @@ class StreamAnalytics:
     def __init__(self):
         self.enabled = False
         self.motion_detector = False 
+        self.width = 160
+        self.height = 90
+        self.rate = 4
 
 class Stream:
     def __init__(self, sid):
@@ -42,9 +54,136 @@ class Stream:
         self.analytics = StreamAnalytics()
         self.desturl = None
         self.record = False
+        # serve low latency HLS from this node, see hlsServer
+        self.hls = False
+        # seconds between snapshots, None for no snapshots
+        self.snapshotInterval = 3
         # enabled|disabled|outage        
         self.state = None    
+        # stages attached at runtime, name -> filterGraph.Output
+        self.attached = {}
+        # InputStream objects running this stream's inputs
+        self.inputStreams = []
+        # node capabilities the stream needs, e.g. an encoder, see cluster
+        self.requires = []
+
+    def spec(self):
+        """ json serializable description of the stream, sent to the node
+            it is placed on.
+        """
+        return {
+            'sid': self.sid,
+            'mode': self.inputs.mode,
+            'src': self.inputs.src,
+            'analytics': dict(vars(self.analytics)),
+            'desturl': self.desturl,
+            'record': self.record,
+            'hls': self.hls,
+            'snapshotInterval': self.snapshotInterval,
+            'requires': self.requires
+        }
+
+    @staticmethod
+    def fromSpec(spec):
+        stream = Stream(spec['sid'])
+        stream.inputs.mode = spec.get('mode')
+        stream.inputs.src = spec.get('src', [])
+        for k, v in spec.get('analytics', {}).items():
+            setattr(stream.analytics, k, v)
+        stream.desturl = spec.get('desturl')
+        stream.record = spec.get('record', False)
+        stream.hls = spec.get('hls', False)
+        stream.snapshotInterval = spec.get('snapshotInterval', 3)
+        stream.requires = spec.get('requires', [])
+        return stream
+
+    def outputs(self):
+        """ The filterGraph outputs each input of this stream produces.
+        """
+        outputs = [filterGraph.RelayOutput()]
+        if self.snapshotInterval:
+            outputs.append(filterGraph.SnapshotOutput(self.snapshotInterval))
+        if self.analytics.enabled:
+            outputs.append(filterGraph.AnalyticsOutput(self.analytics.width,
+                self.analytics.height, self.analytics.rate))
+        if self.record:
+            outputs.append(filterGraph.RecordOutput())
+        if self.desturl and self.hls:
+            # one encode for both
+            outputs.append(hlsServer.output(desturl=self.desturl))
+        elif self.desturl:
+            outputs.append(transcode.output(self.desturl))
+        elif self.hls:
+            outputs.append(hlsServer.output())
+        names = set(o.name for o in self.attached.values())
+        return [o for o in outputs if o.name not in names] + \
+            list(self.attached.values())
+
+    def inputConf(self, src, **conf):
+        """ InputStream configuration for one entry of inputs.src.
+        """
+        conf.setdefault('maxInActvity', 180)
+        conf.setdefault('retryAfter', 1800)
+        conf.update({
+            'url': src['url'],
+            'streamId': self.sid,
+            'outputs': self.outputs()
+        })
+        return conf
+
+    def wallConf(self, **conf):
+        """ videoWall.VideoWallStream configuration compositing all of
+            inputs.src into one ffmpeg.
+        """
+        conf.setdefault('maxInActvity', 180)
+        conf.setdefault('retryAfter', 1800)
+        conf.update({
+            'url': 'videoWall',
+            'streamId': self.sid,
+            'panels': [dict(src['panel'], url=src['url']) for src in self.inputs.src],
+            'outputs': self.outputs()
+        })
+        return conf
+
+    def attach(self, output):
+        self.attached[output.name] = output
+        for inputStream in self.inputStreams:
+            inputStream.attach(output)
+
+    def detach(self, name):
+        self.attached.pop(name, None)
+        for inputStream in self.inputStreams:
+            inputStream.detach(name)
             
     def setup(self):
+        subscribe_consumers()
         signals.publish(config.STREAM_CREATE_TOPIC, self) 
 
+    def teardown(self):
+        """ Stops what the consumers started for this stream. """
+        signals.publish(config.StreamStopTopic(self.sid))
+
+
+# modules whose onStreamCreate(stream) starts the consumer of one of the
+# graph outputs, optional ones may be missing their dependencies
+_CONSUMERS = ("imageGenerator", "analytics", "recorder", "hlsServer")
+_consumers_subscribed = False
+_consumers_lock = threading.Lock()
+
+def subscribe_consumers():
+    """ Subscribe the onStreamCreate of every consumer module to
+        config.STREAM_CREATE_TOPIC, once.
+    """
+    global _consumers_subscribed
+    with _consumers_lock:
+        if _consumers_subscribed:
+            return
+        for name in _CONSUMERS:
+            try:
+                module = importlib.import_module(name)
+            except ImportError as e:
+                logging.warning("%s disabled: %s" % (name, str(e)))
+                continue
+            signals.subscribe(config.STREAM_CREATE_TOPIC, module.onStreamCreate)
+        _consumers_subscribed = True
+
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+"""
+Drives many InputStream objects from a single thread.
+
+Instead of a thread and a poll loop per stream the manager registers
+every stream's video pipe, ffmpeg stdout/stderr and command pipe with
+one selector (epoll on linux). Streams keep the same states
+(idle/starting/playing/fault/stopped), publish on the same signals
+topics and follow the same restart rules: a faulted stream is restarted
+when the supervisor says so unless it is stopped first.
+
+Inactivity and process exit are checked by a sweep every sweepInterval
+seconds across all streams rather than by a per stream wakeup.
+
+    manager = StreamManager()
+    manager.start()
+    stream = manager.add({ "url": ..., "streamId": ..., ... })
+    ...
+    stream.stop()    # or manager.stop() for all of them
+"""
+import logging
+import os
+import selectors
+import sys
+import threading
+import time
+import traceback
+import config
+import signals
+import ringBuffer
+import latency
+import supervisor
+import placement
+import inputStream
+from inputStream import InputStream
+from nonblockingReadline import nonblockingReadline
+
+_WAKE = "wake"
+_CMD = "cmd"
+_VIDEO = "video"
+_STDOUT = "stdout"
+_STDERR = "stderr"
+_OUTPUT = "output"
+
+
+class StreamManager(threading.Thread):
+    def __init__(self, sweepInterval=1.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.selector = selectors.DefaultSelector()
+        self.sweepInterval = sweepInterval
+        self.streams = {}
+        self.readers = {}
+        self.pending = []
+        self.lock = threading.Lock()
+        self.running = True
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, (None, _WAKE))
+
+    def add(self, conf, cls=InputStream):
+        """ Create an InputStream (or subclass cls, e.g.
+            videoWall.VideoWallStream) for conf and start it on the
+            manager's thread, returns the stream.
+        """
+        stream = cls(conf)
+        with self.lock:
+            self.pending.append(stream)
+        os.write(self.wake_w, b'a')
+        return stream
+
+    def stop_stream(self, sid):
+        stream = self.streams.get(sid)
+        if stream:
+            stream.stop()
+
+    def stop(self):
+        self.running = False
+        os.write(self.wake_w, b'x')
+
+    def _start(self, stream):
+        try:
+            if not stream._spawn():
+                # refused, no cpu left on the node
+                self._finish(stream)
+                return
+        except BaseException:
+            logging.error(traceback.format_exc())
+            stream.state = config.STREAM_STATE_FAULT
+            signals.publish(stream.sf_topic, {
+                'error': 'SystemError',
+                'desc': 'Exception thrown check error log'
+            })
+            self._schedule_retry(stream)
+            return
+
+        nb_stdout = nonblockingReadline(stream.proc.stdout)
+        nb_stderr = nonblockingReadline(stream.proc.stderr)
+        self.readers[stream.sid] = (nb_stdout, nb_stderr)
+        self.selector.register(nb_stdout.fd, selectors.EVENT_READ,
+            (stream, _STDOUT))
+        self.selector.register(nb_stderr.fd, selectors.EVENT_READ,
+            (stream, _STDERR))
+        for fd in stream.out_fds():
+            self.selector.register(fd, selectors.EVENT_READ, (stream, _OUTPUT))
+
+    def _add(self, stream):
+        self.streams[stream.sid] = stream
+        self.selector.register(stream.cmd_r, selectors.EVENT_READ,
+            (stream, _CMD))
+        self.selector.register(stream.vout_r, selectors.EVENT_READ,
+            (stream, _VIDEO))
+        self._start(stream)
+
+    def _finish(self, stream):
+        """ ffmpeg is done, either because of a fault or a stop request.
+        """
+        readers = self.readers.pop(stream.sid, None)
+        if readers:
+            for reader in readers:
+                self.selector.unregister(reader.fd)
+            # output pipes may be replaced when ffmpeg is restarted
+            for fd in stream.out_fds():
+                self.selector.unregister(fd)
+        if stream.proc:
+            stream._kill()
+
+        if stream.state == config.STREAM_STATE_FAULT:
+            self._schedule_retry(stream)
+        elif stream.state == config.STREAM_STATE_STOPPED:
+            self.selector.unregister(stream.cmd_r)
+            self.selector.unregister(stream.vout_r)
+            del self.streams[stream.sid]
+            supervisor.service().cancel(stream.sid)
+            placement.service().release(stream.sid)
+
+    def _schedule_retry(self, stream):
+        supervisor.service().schedule(stream)
+
+    def _on_event(self, stream, kind, fd):
+        if kind == _CMD:
+            cmd = stream._read_cmd()
+            if cmd == inputStream._CMD_STOP:
+                stream.state = config.STREAM_STATE_STOPPED
+                self._finish(stream)
+            elif cmd == inputStream._CMD_RESTART:
+                if stream.state == config.STREAM_STATE_FAULT:
+                    stream.state = config.STREAM_STATE_IDLE
+                    self._start(stream)
+            elif stream.state != config.STREAM_STATE_FAULT:
+                # outputs changed, restart ffmpeg with the new graph
+                stream.state = config.STREAM_STATE_IDLE
+                self._finish(stream)
+                self._start(stream)
+
+        elif kind == _OUTPUT:
+            name = stream.out_fds().get(fd)
+            if name:
+                stream._route_output(name)
+
+        elif kind == _VIDEO:
+            video_chunk = stream.ring.readinto(stream.vout_r, stream.read_batch)
+            if video_chunk and stream.proc:
+                stream._route_video(video_chunk,
+                    latency.now() if latency.enabled else None)
+            elif video_chunk:
+                # left over output of a killed ffmpeg
+                ringBuffer.release(video_chunk)
+
+        elif stream.sid in self.readers:
+            reader = self.readers[stream.sid][kind == _STDERR]
+            for line in reader.readlines():
+                if kind == _STDOUT:
+                    stream._line_proc(line)
+                else:
+                    stream._stderr_proc(line)
+            if reader.eof:
+                stream._exit_fault()
+                self._finish(stream)
+
+    def _sweep(self):
+        for stream in list(self.streams.values()):
+            if stream.state in (config.STREAM_STATE_STARTING,
+                    config.STREAM_STATE_PLAYING):
+                if stream.proc.poll() is not None:
+                    stream._exit_fault()
+                    self._finish(stream)
+                elif stream._inactivity_fault():
+                    self._finish(stream)
+
+    def _run(self):
+        next_sweep = time.time() + self.sweepInterval
+        while self.running:
+            timeout = next_sweep - time.time()
+
+            for key, mask in self.selector.select(max(timeout, 0)):
+                stream, kind = key.data
+                if kind == _WAKE:
+                    try:
+                        os.read(self.wake_r, 4096)
+                    except BlockingIOError:
+                        pass
+                    with self.lock:
+                        pending, self.pending = self.pending, []
+                    for s in pending:
+                        self._add(s)
+                elif stream.sid in self.streams:
+                    try:
+                        self._on_event(stream, kind, key.fd)
+                    except BaseException:
+                        logging.error(traceback.format_exc())
+
+            now = time.time()
+            if now >= next_sweep:
+                self._sweep()
+                next_sweep = now + self.sweepInterval
+
+    def run(self):
+        try:
+            self._run()
+        except BaseException:
+            logging.error(traceback.format_exc())
+
+        for stream in list(self.streams.values()):
+            if stream.proc:
+                stream._kill()
+            stream.state = config.STREAM_STATE_STOPPED
+
+
+def benchmark(count=16, seconds=30):
+    """ Compare the thread per stream model with the manager using
+        testsrc inputs, reports cpu seconds used by this process,
+        thread count and chunk throughput for each.
+    """
+    import resource
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    def measure(model):
+        received = {'chunks': 0, 'bytes': 0}
+        def count_chunk(chunk):
+            received['chunks'] += 1
+            received['bytes'] += len(chunk)
+
+        confs = []
+        for i in range(count):
+            sid = "bench-%s-%d" % (model, i)
+            signals.subscribe(config.StreamInputTopic(sid), count_chunk)
+            confs.append({
+                "url": "testsrc",
+                "maxInActvity": 30,
+                "retryAfter": 5,
+                "streamId": sid
+            })
+
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.time()
+        if model == "threaded":
+            streams = [InputStream(conf) for conf in confs]
+            for stream in streams:
+                stream.start()
+        else:
+            manager = StreamManager()
+            manager.start()
+            streams = [manager.add(conf) for conf in confs]
+
+        time.sleep(seconds)
+        threads = threading.active_count()
+        elapsed = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_SELF)
+
+        for stream in streams:
+            stream.stop()
+        if model != "threaded":
+            manager.stop()
+        for conf in confs:
+            signals.unsubscribe(config.StreamInputTopic(conf['streamId']),
+                count_chunk)
+        time.sleep(2)
+
+        cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+        return {
+            'model': model,
+            'streams': count,
+            'cpu%': 100.0 * cpu / elapsed,
+            'threads': threads,
+            'chunks/s': received['chunks'] / elapsed,
+            'MB/s': received['bytes'] / elapsed / 1e6
+        }
+
+    for model in ("threaded", "manager"):
+        print(measure(model))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.WARNING,
+        format="%(asctime)s %(message)s")
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    benchmark(count, seconds)
@@ -0,0 +1,251 @@
+"""
+Schedules the restarts of faulted streams for the whole node.
+
+A faulted InputStream hands itself to the supervisor and blocks on its
+command pipe, it costs no wakeups until the supervisor writes the
+restart command. Restarts are spread out so a switch reboot that faults
+every camera at once does not restart them all at once either:
+
+1. the delay doubles with every consecutive failure, from baseDelay up
+   to the stream's conf retryAfter, a stream that ran for stableTime
+   starts over at baseDelay.
+2. each delay is randomized by +/- jitter.
+3. at most maxStarting streams are starting at any time, a start slot
+   is freed once the restarted stream plays, faults again (schedule())
+   or startTimeout passes. Until the stream handles the restart its
+   state is still the fault's, that does not free the slot.
+4. while a stream waits its source is checked with a TCP connect every
+   probeInterval seconds, when the host accepts the restart is moved up
+   to now. Only urls with a host are probed.
+
+All of this runs on one thread waiting on a heap of due times and a
+selector of pending connects.
+"""
+import heapq
+import itertools
+import logging
+import random
+import selectors
+import socket
+import threading
+import time
+import urllib.parse
+import config
+
+BASE_DELAY = 5
+JITTER = 0.2
+MAX_STARTING = 2
+START_TIMEOUT = 30
+STABLE_TIME = 300
+PROBE_INTERVAL = 15
+PROBE_TIMEOUT = 2
+
+DEFAULT_PORTS = {
+    'rtsp': 554,
+    'rtsps': 322,
+    'rtmp': 1935,
+    'http': 80,
+    'https': 443,
+}
+
+
+def probe_address(url):
+    """ (host, port) to check the source of url with, None if it has no
+        host.
+    """
+    try:
+        u = urllib.parse.urlsplit(url)
+        port = u.port or DEFAULT_PORTS.get(u.scheme)
+    except ValueError:
+        return None
+    if not u.hostname or not port:
+        return None
+    return u.hostname, port
+
+
+class _Entry:
+    def __init__(self, stream):
+        self.stream = stream
+        self.failures = 0
+        self.due = None
+        self.started = None
+        self.next_probe = None
+        self.probe = None
+
+
+class Supervisor(threading.Thread):
+    def __init__(self, baseDelay=BASE_DELAY, jitter=JITTER,
+            maxStarting=MAX_STARTING, startTimeout=START_TIMEOUT,
+            stableTime=STABLE_TIME, probeInterval=PROBE_INTERVAL):
+        threading.Thread.__init__(self, name="supervisor")
+        self.daemon = True
+        self.baseDelay = baseDelay
+        self.jitter = jitter
+        self.maxStarting = maxStarting
+        self.startTimeout = startTimeout
+        self.stableTime = stableTime
+        self.probeInterval = probeInterval
+
+        # sid -> _Entry
+        self.entries = {}
+        # heap of (time, seq, sid), stale items are skipped
+        self.heap = []
+        self.seq = itertools.count()
+        # sid -> (time the start slot is given back at the latest, _Entry
+        # restarted)
+        self.starting = {}
+        self.selector = selectors.DefaultSelector()
+        self.cond = threading.Condition()
+        self.running = True
+
+        # totals
+        self.restarts = 0
+        self.early = 0
+
+    def delay(self, entry):
+        limit = entry.stream.conf['retryAfter']
+        d = min(self.baseDelay * (2 ** max(entry.failures - 1, 0)), limit)
+        return d * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def schedule(self, stream):
+        """ Called by a stream that faulted, it is restarted later through
+            stream.restart().
+        """
+        now = time.time()
+        with self.cond:
+            entry = self.entries.get(stream.sid)
+            if entry is None or entry.stream is not stream:
+                entry = self.entries[stream.sid] = _Entry(stream)
+            if entry.started is not None and now - entry.started >= self.stableTime:
+                entry.failures = 0
+            entry.failures += 1
+            entry.due = now + self.delay(entry)
+            self.starting.pop(stream.sid, None)
+            heapq.heappush(self.heap, (entry.due, next(self.seq), stream.sid))
+            if probe_address(stream.conf.get('url', '')):
+                entry.next_probe = now + self.probeInterval
+                heapq.heappush(self.heap, (entry.next_probe, next(self.seq), stream.sid))
+            logging.info("supervisor: restart %s in %.0fs (failure %d)" % (
+                stream.sid, entry.due - now, entry.failures))
+            self.cond.notify()
+
+    def cancel(self, sid):
+        """ The stream stopped, forget it. """
+        with self.cond:
+            entry = self.entries.pop(sid, None)
+            self.starting.pop(sid, None)
+            if entry and entry.probe:
+                self._close_probe(entry)
+
+    def _close_probe(self, entry):
+        self.selector.unregister(entry.probe)
+        entry.probe.close()
+        entry.probe = None
+
+    def _start_probe(self, entry, now):
+        address = probe_address(entry.stream.conf['url'])
+        entry.next_probe = now + self.probeInterval
+        heapq.heappush(self.heap, (entry.next_probe, next(self.seq), entry.stream.sid))
+        if entry.probe:
+            # no answer within probeInterval
+            self._close_probe(entry)
+        try:
+            # resolving blocks, url hosts are expected to be addresses or
+            # in /etc/hosts on a camera network
+            addr = socket.getaddrinfo(address[0], address[1],
+                type=socket.SOCK_STREAM)[0]
+        except (OSError, UnicodeError):
+            return
+        s = socket.socket(addr[0], socket.SOCK_STREAM)
+        s.setblocking(False)
+        s.connect_ex(addr[4])
+        entry.probe = s
+        self.selector.register(s, selectors.EVENT_WRITE, entry)
+
+    def _probe_done(self, entry, now):
+        ok = entry.probe.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+        self._close_probe(entry)
+        if ok and entry.due > now:
+            logging.info("supervisor: %s reachable, restarting early" % entry.stream.sid)
+            self.early += 1
+            entry.due = now
+            heapq.heappush(self.heap, (now, next(self.seq), entry.stream.sid))
+
+    def _free_slots(self, now):
+        # a fault after the restart frees the slot in schedule(), a new
+        # stream object for the sid or cancel() replaces the entry
+        for sid, (deadline, restarted) in list(self.starting.items()):
+            if self.entries.get(sid) is not restarted or now >= deadline or \
+                    restarted.stream.state == config.STREAM_STATE_PLAYING:
+                del self.starting[sid]
+
+    def _due(self, now):
+        """ Restart what is due and has a slot, start due probes, returns
+            the time of the next thing to do.
+        """
+        self._free_slots(now)
+        waiting = []
+        while self.heap and self.heap[0][0] <= now:
+            t, seq, sid = heapq.heappop(self.heap)
+            entry = self.entries.get(sid)
+            if entry is None or entry.due is None:
+                continue
+            if t == entry.due:
+                if len(self.starting) >= self.maxStarting:
+                    waiting.append((t, seq, sid))
+                    continue
+                entry.due = None
+                entry.started = now
+                if entry.probe:
+                    self._close_probe(entry)
+                self.starting[sid] = (now + self.startTimeout, entry)
+                self.restarts += 1
+                entry.stream.restart()
+            elif t == entry.next_probe:
+                self._start_probe(entry, now)
+        for item in waiting:
+            heapq.heappush(self.heap, item)
+        if waiting:
+            # wait for a start slot, starting streams are polled
+            return now + 0.5
+        if self.starting:
+            return min(self.heap[0][0] if self.heap else now + 0.5, now + 0.5)
+        return self.heap[0][0] if self.heap else None
+
+    def run(self):
+        while self.running:
+            with self.cond:
+                now = time.time()
+                wake = self._due(now)
+                probing = bool(self.selector.get_map())
+                if not probing:
+                    self.cond.wait(None if wake is None else max(wake - now, 0))
+                    continue
+            timeout = PROBE_TIMEOUT if wake is None else \
+                min(max(wake - now, 0), PROBE_TIMEOUT)
+            events = self.selector.select(timeout)
+            with self.cond:
+                now = time.time()
+                for key, mask in events:
+                    # the probe may have been closed or replaced by
+                    # _start_probe while selecting
+                    if key.data.probe is key.fileobj:
+                        self._probe_done(key.data, now)
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+
+_supervisor = None
+_supervisor_lock = threading.Lock()
+
+def service():
+    """ The node's supervisor, started on first use. """
+    global _supervisor
+    with _supervisor_lock:
+        if _supervisor is None:
+            _supervisor = Supervisor()
+            _supervisor.start()
+        return _supervisor
@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+"""
+Tour: the sources of a StreamInputs 'tour' stream shown one after the
+other, each for its duration, without the black gap of a cold start.
+
+Starting a source at its slot means an RTSP connect, ffmpeg probing the
+input and waiting for a keyframe, seconds of nothing. Instead the next
+source is started prewarm seconds ahead of its slot as a hot standby:
+
+1. its relay is demuxed (aviDemux) and the frames since its latest
+   keyframe are held, so at any time the standby could be shown
+   starting at a keyframe. Held frames are copied out of the source's
+   ring buffer, a GOP larger than MAX_GOP_BYTES is dropped and the
+   standby waits for the next keyframe.
+2. if the url is in the probe cache (probe.ProbeService) ffmpeg is told
+   to probe little of the input, the cache knows what it holds. A url
+   that is not is probed once its source was shown, not while it starts.
+
+At the slot boundary the standby's AVI header and held GOP are
+published and it goes live, the previous source is stopped. A standby
+without a keyframe yet goes live on its first one, a standby that has
+none after switchTimeout seconds is skipped.
+
+The tour is published on the topics of its own streamId like an
+InputStream relay: the byte stream on config.StreamInputTopic (a new
+RIFF header at each switch, which aviDemux and the recorder take as a
+restart) and the frames on config.StreamFrameTopic.
+
+The sources only produce their relay. The other outputs of the stream
+(snapshot, record, transcode, hls ... see Stream.outputs()) are made by
+one more ffmpeg, TourOutputs, reading the tour's relay from a pipe and
+publishing on the tour's topics, restarted at each switch as the next
+source may differ in codec or size.
+
+The time from the slot boundary to the first published frame of the
+next source is recorded per switch, see report() and metrics.
+
+    t = Tour(stream.sid, stream.inputs.src, prewarm=5, outputs=stream.outputs())
+    t.start()
+    ...
+    t.stop()
+"""
+import logging
+import threading
+import os
+import time
+import config
+import filterGraph
+import signals
+import aviDemux
+import probe
+import latency
+import metrics
+from inputStream import InputStream
+
+PREWARM = 5
+SWITCH_TIMEOUT = 10
+# bytes of the held GOP, the GOP is dropped beyond this
+MAX_GOP_BYTES = 4 << 20
+# input options for a url the probe cache knows
+FAST_OPEN_ARGS = "-probesize 65536 -analyzeduration 500000"
+# TourOutputs reads the tour's relay
+_tofmt = "%s -f avi -i pipe:%d -nostats -progress pipe:1 %s"
+
+
+def _cached(url):
+    """ True if the probe cache knows url, never runs ffprobe. """
+    service = probe.service()
+    with service.lock:
+        return service.cached(url) is not None
+
+
+class _Source:
+    """ A running source, its InputStream and demuxer. """
+    def __init__(self, index, src, stream):
+        self.index = index
+        self.src = src
+        self.stream = stream
+        self.demuxer = aviDemux.Demuxer()
+        self.header = None
+        # frames from the latest video keyframe on, each holding its parts
+        self.gop = []
+        self.gop_bytes = 0
+        self.faulted = False
+        self.shown = False
+        self.on_chunk = self.on_fault = None
+
+    def hold(self, frame):
+        if frame.video and frame.keyframe:
+            self.drop()
+        elif not self.gop:
+            frame.release()
+            return
+        # held for seconds, don't keep the source's ring slots
+        frame.detach()
+        self.gop.append(frame)
+        self.gop_bytes += frame.size
+        if self.gop_bytes > MAX_GOP_BYTES:
+            # the frames reference those before them, all or none of the
+            # GOP is shown
+            logging.debug("tour: dropped a GOP over %d bytes" % MAX_GOP_BYTES)
+            self.drop()
+
+    def drop(self):
+        for frame in self.gop:
+            frame.release()
+        self.gop = []
+        self.gop_bytes = 0
+
+    def ready(self):
+        return self.header is not None and bool(self.gop)
+
+
+class TourOutputs(InputStream):
+    """ InputStream producing the outputs of a tour from its relay, conf
+        'streamId' is the tour's. ffmpeg is restarted at each new AVI
+        header, the bytes following it are kept until the new ffmpeg
+        runs so it starts at the header and the switch's keyframe.
+    """
+    def __init__(self, conf):
+        InputStream.__init__(self, conf)
+        self.feed_lock = threading.Lock()
+        self.in_r = self.in_w = None
+        # header written to the running ffmpeg
+        self.synced = False
+        # a reload is on its way, write nothing to the running ffmpeg
+        self.restarting = False
+        self.header = None
+        # relay bytes after the header while ffmpeg restarts, None if
+        # they are written as they come
+        self.pending = None
+        self.pending_bytes = 0
+        # the relay's writes are queued, drops are resynced by ffmpeg's
+        # avi demuxer
+        self.subscriber = signals.subscribe_async(self.si_topic, self._feed)
+
+    def _feed(self, data):
+        with self.feed_lock:
+            # the tour publishes headers as bytes, payload as ring views
+            if isinstance(data, bytes) and data.startswith(b"RIFF"):
+                self.header = data
+                self.pending = []
+                self.pending_bytes = 0
+                if self.synced:
+                    # the next source may differ in codec or size
+                    self.synced = False
+                    self.restarting = True
+                    self.reload()
+            elif self.pending is not None:
+                self.pending.append(bytes(data))
+                self.pending_bytes += len(data)
+                if self.pending_bytes > MAX_GOP_BYTES:
+                    self.pending = None
+            elif self.synced:
+                self._write(data)
+            if not (self.synced or self.restarting) and self.in_w is not None \
+                    and self.header:
+                self.synced = True
+                self._write(self.header)
+                for chunk in self.pending or []:
+                    self._write(chunk)
+                self.pending = None
+
+    def _write(self, data):
+        # must hold self.feed_lock
+        view = memoryview(data)
+        try:
+            while view and self.synced:
+                view = view[os.write(self.in_w, view):]
+        except OSError:
+            # ffmpeg went away, resync once it is restarted
+            self.synced = False
+
+    def _spawn(self):
+        r, w = os.pipe()
+        with self.feed_lock:
+            if self.in_w is not None:
+                os.close(self.in_w)
+            self.in_r, self.in_w = r, None
+            self.synced = self.restarting = False
+        try:
+            spawned = InputStream._spawn(self)
+        finally:
+            # ffmpeg has its copy, a write fails once it exits
+            os.close(r)
+        with self.feed_lock:
+            if spawned:
+                self.in_w = w
+            else:
+                os.close(w)
+        return spawned
+
+    def _pass_fds(self):
+        return InputStream._pass_fds(self) + [self.in_r]
+
+    def _command(self, outputs):
+        fds = dict((name, p[1]) for name, p in self.out_pipes.items())
+        return _tofmt % (config.FFMPEG, self.in_r, filterGraph.compile(outputs, fds))
+
+    def _line_proc(self, line):
+        InputStream._line_proc(self, line)
+        # outputs written to a target send nothing back, progress shows
+        # ffmpeg is not stuck
+        self.last_output_time = time.time()
+
+    def stop(self):
+        signals.unsubscribe(self.si_topic, self.subscriber)
+        with self.feed_lock:
+            self.synced = False
+            if self.in_w is not None:
+                os.close(self.in_w)
+                self.in_w = None
+        InputStream.stop(self)
+
+
+class Tour(threading.Thread):
+    def __init__(self, sid, src, prewarm=PREWARM, switchTimeout=SWITCH_TIMEOUT,
+            manager=None, conf=None, outputs=None):
+        """ src is StreamInputs.src, [{url, duration}]. Sources are run by
+            manager (streamManager.StreamManager) if given, on their own
+            thread otherwise, with conf as their base configuration.
+            outputs (Stream.outputs()) other than the relay are run by a
+            TourOutputs.
+        """
+        threading.Thread.__init__(self, name="tour-%s" % sid)
+        self.daemon = True
+        self.sid = sid
+        self.src = src
+        self.prewarm = prewarm
+        self.switchTimeout = switchTimeout
+        self.manager = manager
+        self.conf = dict(conf or {})
+        self.conf.setdefault('maxInActvity', 30)
+        self.conf.setdefault('retryAfter', 60)
+        self.outputs = [o for o in outputs or []
+            if o.name != filterGraph.OUTPUT_RELAY]
+        # the TourOutputs, once started
+        self.stage = None
+
+        self.si_topic = config.StreamInputTopic(sid)
+        self.fr_topic = config.StreamFrameTopic(sid)
+        self.sf_topic = config.StreamFaultTopic(sid)
+        self.live = None
+        self.standby = None
+        # slot boundary a pending switch is waiting on
+        self.switch_due = None
+        self.slot_end = None
+        self.cond = threading.Condition()
+        self.running = True
+
+        self.switches = 0
+        self.skipped = 0
+        self.switch_latency = latency.Histogram()
+        metrics.register_tour(self)
+
+    def _next_index(self, index):
+        return (index + 1) % len(self.src)
+
+    def _start_source(self, index):
+        src = self.src[index]
+        conf = dict(self.conf, url=src['url'],
+            streamId="%s-tour%d" % (self.sid, index))
+        if _cached(src['url']):
+            conf['inputArgs'] = FAST_OPEN_ARGS
+        source = _Source(index, src, None)
+        source.on_chunk = lambda chunk: self._on_chunk(source, chunk)
+        source.on_fault = lambda fault: self._on_fault(source, fault)
+        signals.subscribe(config.StreamInputTopic(conf['streamId']), source.on_chunk)
+        signals.subscribe(config.StreamFaultTopic(conf['streamId']), source.on_fault)
+        if self.manager:
+            source.stream = self.manager.add(conf)
+        else:
+            source.stream = InputStream(conf)
+            source.stream.start()
+        logging.info("tour %s: warming %s" % (self.sid, src['url']))
+        return source
+
+    def _stop_source(self, source):
+        signals.unsubscribe(config.StreamInputTopic(source.stream.sid), source.on_chunk)
+        signals.unsubscribe(config.StreamFaultTopic(source.stream.sid), source.on_fault)
+        source.stream.stop()
+        with self.cond:
+            source.drop()
+            source.demuxer.reset()
+        if source.shown and not _cached(source.src['url']):
+            # it answered, probe it now for a fast open next round
+            probe.service().probe(source.src['url'])
+
+    def _on_chunk(self, source, chunk):
+        # the chunk's ring slot is retained by each frame holding a part
+        with self.cond:
+            items = source.demuxer.feed(chunk)
+            for item in items:
+                if isinstance(item, aviDemux.Header):
+                    source.header = item
+                    source.drop()
+                    if source is self.live:
+                        self._publish_header(item)
+                elif source is self.live:
+                    self._publish_frame(item)
+                    item.release()
+                else:
+                    source.hold(item)
+                    if source is self.standby and self.switch_due and source.ready():
+                        self._switch(time.time())
+
+    def _on_fault(self, source, fault):
+        with self.cond:
+            source.faulted = True
+            if source is self.live:
+                signals.publish(self.sf_topic, dict(fault,
+                    desc="%s: %s" % (source.src['url'], fault.get('desc'))))
+            self.cond.notify()
+
+    def _publish_header(self, header):
+        signals.publish(self.si_topic, header.data)
+
+    def _publish_frame(self, frame):
+        signals.publish(self.si_topic, frame.chunk_header())
+        for part in frame.parts:
+            signals.publish(self.si_topic, part)
+        if frame.size & 1:
+            signals.publish(self.si_topic, b"\0")
+        signals.publish(self.fr_topic, frame)
+
+    def _switch(self, now):
+        """ Make the standby live, must hold self.cond. """
+        old, new = self.live, self.standby
+        self._publish_header(new.header)
+        for frame in new.gop:
+            self._publish_frame(frame)
+        new.drop()
+        self.switch_latency.record(int((now - self.switch_due) * 1000000))
+        self.switches += 1
+        logging.info("tour %s: switched to %s in %.3fs" % (
+            self.sid, new.src['url'], now - self.switch_due))
+        new.shown = True
+        self.live = new
+        self.standby = None
+        self.switch_due = None
+        self.slot_end = now + new.src.get('duration', 60)
+        if old is not None:
+            threading.Thread(target=self._stop_source, args=(old,)).start()
+        self.cond.notify()
+
+    def _skip(self, now):
+        """ The standby did not come up in time, keep the live source and
+            warm the one after it. Must hold self.cond.
+        """
+        source = self.standby
+        self.skipped += 1
+        signals.publish(self.sf_topic, {
+            'error': 'BadInput',
+            'desc': 'Tour skipped %s, no keyframe within %ds' % (
+                source.src['url'], self.switchTimeout)
+        })
+        self.standby = None
+        self.switch_due = None
+        threading.Thread(target=self._stop_source, args=(source,)).start()
+        index = self._next_index(source.index)
+        if self.live is None or index != self.live.index:
+            self.standby = self._start_source(index)
+        self.slot_end = now + self.prewarm
+
+    def _step(self, now):
+        """ Warm, switch or skip what is due, returns the time of the next
+            thing to do. Must hold self.cond.
+        """
+        if self.live is None and self.standby is None:
+            self.standby = self._start_source(0)
+            self.switch_due = now
+        if self.switch_due is not None:
+            if self.standby.ready():
+                self._switch(now)
+            elif self.standby.faulted or now >= self.switch_due + self.switchTimeout:
+                if self.live is None:
+                    # nothing shown yet, keep trying the first sources
+                    self.skipped += 1
+                    source = self.standby
+                    threading.Thread(target=self._stop_source, args=(source,)).start()
+                    self.standby = self._start_source(self._next_index(source.index))
+                    self.switch_due = now
+                else:
+                    self._skip(now)
+            else:
+                return min(self.switch_due + self.switchTimeout, now + 0.5)
+        if len(self.src) < 2:
+            return None
+        if self.standby is None and now >= self.slot_end - self.prewarm:
+            self.standby = self._start_source(self._next_index(self.live.index))
+        if self.standby is not None and now >= self.slot_end:
+            self.switch_due = now
+            return now
+        if self.standby is None:
+            return self.slot_end - self.prewarm
+        return self.slot_end
+
+    def start(self):
+        if self.outputs:
+            conf = dict(self.conf, url='tour', streamId=self.sid, outputs=self.outputs)
+            if self.manager:
+                self.stage = self.manager.add(conf, TourOutputs)
+            else:
+                self.stage = TourOutputs(conf)
+                self.stage.start()
+        threading.Thread.start(self)
+
+    def run(self):
+        with self.cond:
+            while self.running:
+                now = time.time()
+                try:
+                    wake = self._step(now)
+                except:
+                    logging.exception("tour %s failed" % self.sid)
+                    wake = now + 1
+                if wake is None or wake > now:
+                    self.cond.wait(None if wake is None else wake - now)
+            sources = (self.live, self.standby)
+        for source in sources:
+            if source is not None:
+                self._stop_source(source)
+        if self.stage is not None:
+            self.stage.stop()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+    def report(self):
+        """ {switches, skipped, switch latency {p50, p99, max} in seconds} """
+        h = self.switch_latency
+        return {
+            'switches': self.switches,
+            'skipped': self.skipped,
+            'switchLatency': {
+                'p50': (h.percentile(50) or 0) / 1e6,
+                'p99': (h.percentile(99) or 0) / 1e6,
+                'max': h.max / 1e6
+            }
+        }
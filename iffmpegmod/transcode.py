@@ -0,0 +1,292 @@
+"""
+Transcode stage for Stream.desturl with encoder profiles per hardware.
+
+    cpu      libx264, any node
+    rpi3     h264_v4l2m2m (the v4l2 driver of the Pi's VideoCore)
+    rpi3-omx h264_omx, older Raspbian ffmpeg builds
+    rock64   h264_rkmpp
+    intel    h264_vaapi
+
+A profile becomes a TranscodeOutput branch of the input's
+ffmpeg. Which profile, preset, thread count and resolution to use on a
+node is found by calibrate(). In production the encoder shares its
+ffmpeg with the decode of the camera stream and is pinned by placement
+to the cores of that graph, so calibration runs the same graph: a
+SOURCE_SIZE h264 clip is decoded and fed through the TranscodeOutput
+compiled by filterGraph, for a few seconds without -re, on the cores
+placement would pick for it. The speed is read from ffmpeg's progress
+report. The first combination, highest resolution and best quality
+preset first, whose speed is at least headroom times real time wins.
+The result is cached per node in DATA_DIR and reused by tuning() at
+startup.
+"""
+import json
+import logging
+import os
+import shlex
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import capabilities
+import config
+import filterGraph
+import placement
+import progressParser
+
+TUNING_FILE = config.DATA_DIR + "transcode-%s.json"
+CALIBRATE_SECONDS = 5
+HEADROOM = 1.3
+# (width, height, rate) tried in order
+TARGETS = ((1280, 720, 15), (960, 540, 15), (640, 360, 15), (640, 360, 10))
+# bits per pixel per frame used to pick a bitrate
+BITS_PER_PIXEL = 0.08
+GOP_SECONDS = 2
+# (width, height, rate) of the camera stream decoded while calibrating
+SOURCE_SIZE = (1920, 1080, 15)
+# bumped when calibrate() measures differently, older results are redone
+CALIBRATION_VERSION = 2
+
+
+class Profile:
+    def __init__(self, name, encoder, args="", presets=(None,), threads=(None,),
+            filters=""):
+        self.name = name
+        self.encoder = encoder
+        # encoder options, {preset} and {threads} are filled in
+        self.args = args
+        # best quality first
+        self.presets = presets
+        self.threads = threads
+        # appended after scaling, e.g. uploading frames to the gpu
+        self.filters = filters
+
+    def encoder_args(self, preset=None, threads=None):
+        """ preset and threads default to the profile's first """
+        preset = self.presets[0] if preset is None else preset
+        threads = self.threads[0] if threads is None else threads
+        args = "-c:v %s " % self.encoder + self.args.format(preset=preset, threads=threads)
+        return args.strip()
+
+
+PROFILES = dict((p.name, p) for p in (
+    Profile("cpu", "libx264", "-preset {preset} -tune zerolatency -threads {threads}",
+        presets=("veryfast", "superfast", "ultrafast"), threads=(0, 2, 1),
+        filters="format=yuv420p"),
+    Profile("rpi3", "h264_v4l2m2m", "-num_capture_buffers 16",
+        filters="format=yuv420p"),
+    Profile("rpi3-omx", "h264_omx", "-zerocopy 1", filters="format=yuv420p"),
+    Profile("rock64", "h264_rkmpp", filters="format=nv12"),
+    Profile("intel", "h264_vaapi", "-vaapi_device /dev/dri/renderD128",
+        filters="format=nv12,hwupload"),
+))
+
+
+def encoder_cores(profile, threads):
+    """ Cores the encoder of profile keeps busy, None when libx264 picks
+        its thread count (threads 0 or unset) and spreads over all cores.
+    """
+    if PROFILES[profile].encoder != "libx264":
+        return 0
+    return threads or None
+
+def default_bitrate(width, height, rate):
+    return int(width * height * rate * BITS_PER_PIXEL)
+
+def muxer(url):
+    """ ffmpeg output format for a destination url """
+    if url.startswith(("rtmp:", "rtmps:")):
+        return "flv"
+    if url.startswith(("rtsp:", "rtsps:")):
+        return "rtsp"
+    if url.endswith(".m3u8"):
+        return "hls"
+    return "mpegts"
+
+
+class TranscodeOutput(filterGraph.Output):
+    audio = True
+
+    def __init__(self, target, profile="cpu", width=1280, height=720, rate=15,
+            preset=None, threads=None, bitrate=None, gop=None, fmt=None,
+            name=filterGraph.OUTPUT_TRANSCODE, tee=None):
+        """ fmt replaces the audio and muxer arguments picked for target,
+            gop defaults to GOP_SECONDS. tee is (name, encoder arguments,
+            tee muxer options) of a second output of the same encode
+            written to the pipe of name, see hlsServer.output().
+        """
+        p = PROFILES[profile]
+        self.profile = profile
+        self.tee = tee
+        if tee:
+            fmt = "-c:a aac -flags +global_header %s -f tee" % tee[1]
+        self.cores = encoder_cores(profile, threads)
+        filters = "fps=%s,scale=%d:%d" % (rate, width, height)
+        if p.filters:
+            filters += "," + p.filters
+        rate_bits = bitrate or default_bitrate(width, height, rate)
+        args = "%s -b:v %d -maxrate %d -bufsize %d -g %d %s" % (
+            p.encoder_args(preset, threads), rate_bits, rate_bits,
+            2 * rate_bits, gop or rate * GOP_SECONDS,
+            fmt or "-c:a aac -f %s" % muxer(target))
+        filterGraph.Output.__init__(self, name, filters, args, target)
+
+    def pipes(self):
+        return filterGraph.Output.pipes(self) + ([self.tee[0]] if self.tee else [])
+
+    def target_arg(self, fds):
+        if not self.tee:
+            return filterGraph.Output.target_arg(self, fds)
+        return "[f=%s]%s|[%s]pipe:%d" % (muxer(self.target), self.target,
+            self.tee[2], fds[self.tee[0]])
+
+
+def source_clip(path, seconds=CALIBRATE_SECONDS, size=SOURCE_SIZE):
+    """ Write a SOURCE_SIZE h264 clip standing in for a camera stream to
+        path, returns False if it could not be made.
+    """
+    width, height, rate = size
+    encoder = "libx264" if capabilities.get().has_encoder("libx264") else "mpeg4"
+    cmd = [config.FFMPEG, "-hide_banner", "-loglevel", "error", "-y", "-f", "lavfi",
+        "-i", "testsrc2=size=%dx%d:rate=%s" % (width, height, rate), "-t", str(seconds),
+        "-c:v", encoder, "-g", str(rate * GOP_SECONDS), "-b:v",
+        str(default_bitrate(width, height, rate) * 4), "-f", "matroska", path]
+    try:
+        return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            timeout=seconds * 20).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+def measure(profile, width, height, rate, preset=None, threads=None,
+        seconds=CALIBRATE_SECONDS, source=None):
+    """ Speed as a multiple of real time of decoding source (a clip from
+        source_clip()) and encoding it with the TranscodeOutput of these
+        settings in one ffmpeg, pinned like placement pins an ingest
+        ffmpeg. None if it failed.
+    """
+    if source is None:
+        tmp = tempfile.mkdtemp(prefix="iffmpeg-calibrate-")
+        try:
+            path = os.path.join(tmp, "source.mkv")
+            if not source_clip(path, seconds):
+                return None
+            return measure(profile, width, height, rate, preset, threads,
+                seconds, path)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    out = TranscodeOutput("-", profile, width, height, rate, preset, threads,
+        fmt="-an -f null")
+    cores = placement.service().pick_cores(filterGraph.cores([out]))
+    cmd = [config.FFMPEG, "-hide_banner", "-loglevel", "error", "-nostats",
+        "-progress", "pipe:1", "-stream_loop", "-1", "-t", str(seconds),
+        "-i", source] + shlex.split(filterGraph.compile([out], {}))
+    parser = progressParser.ProgressParser()
+    last = None
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            timeout=seconds * 20, preexec_fn=lambda: os.sched_setaffinity(0, cores))
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if proc.returncode != 0:
+        return None
+    for line in proc.stdout.decode(errors='replace').splitlines():
+        rec = parser.feed(line)
+        if rec:
+            last = rec
+    return last.speed if last else None
+
+def calibrate(profiles=None, targets=TARGETS, headroom=HEADROOM,
+        seconds=CALIBRATE_SECONDS):
+    """ Find and cache the best setting that holds real time on this
+        node, hardware profiles are tried before cpu.
+    """
+    encoders = capabilities.get().encoders
+    names = profiles or [n for n in PROFILES if n != "cpu"] + ["cpu"]
+    best = None
+    tmp = tempfile.mkdtemp(prefix="iffmpeg-calibrate-")
+    source = os.path.join(tmp, "source.mkv")
+    if not source_clip(source, seconds):
+        logging.error("transcode calibrate: unable to make a source clip")
+        names = []
+    for name in names:
+        p = PROFILES[name]
+        if p.encoder not in encoders:
+            continue
+        for width, height, rate in targets:
+            for preset in p.presets:
+                for threads in p.threads:
+                    speed = measure(name, width, height, rate, preset, threads,
+                        seconds, source)
+                    logging.info("transcode calibrate %s %dx%d@%s preset=%s threads=%s: %s" % (
+                        name, width, height, rate, preset, threads, speed))
+                    if speed is not None and speed >= headroom:
+                        best = {
+                            'profile': name,
+                            'width': width,
+                            'height': height,
+                            'rate': rate,
+                            'preset': preset,
+                            'threads': threads,
+                            'speed': speed
+                        }
+                        break
+                if best:
+                    break
+            if best:
+                break
+        if best:
+            break
+    shutil.rmtree(tmp, ignore_errors=True)
+    if best:
+        best.update({'node': socket.gethostname(), 'ffmpeg': config.FFMPEG,
+            'time': time.time(), 'version': CALIBRATION_VERSION})
+        save(best)
+    return best
+
+def _tuning_file():
+    return TUNING_FILE % socket.gethostname()
+
+def save(tuning):
+    path = _tuning_file()
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(tuning, indent=4, sort_keys=True))
+        os.rename(tmp, path)
+    except OSError as e:
+        logging.warning("unable to save transcode tuning: %s" % str(e))
+
+def tuning(calibrateIfMissing=False):
+    """ The cached calibration of this node, calibrated now if there is
+        none (or ffmpeg or the calibration changed) and calibrateIfMissing
+        is set.
+    """
+    result = config.load(_tuning_file())
+    if result and (result.get('ffmpeg') != config.FFMPEG or
+            result.get('version') != CALIBRATION_VERSION):
+        result = None
+    if result is None and calibrateIfMissing:
+        result = calibrate()
+    return result
+
+def output(target, tuned=None, **kwargs):
+    """ TranscodeOutput to target using the node's calibration, the cpu
+        profile at 640x360 if the node is not calibrated. kwargs go to
+        TranscodeOutput.
+    """
+    tuned = tuned or tuning() or {'profile': 'cpu', 'width': 640,
+        'height': 360, 'rate': 15, 'preset': 'veryfast', 'threads': 0}
+    return TranscodeOutput(target, tuned['profile'], tuned['width'],
+        tuned['height'], tuned['rate'], tuned.get('preset'), tuned.get('threads'),
+        **kwargs)
+
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format="%(asctime)s %(message)s")
+    print(json.dumps(calibrate(sys.argv[1:] or None), indent=4))
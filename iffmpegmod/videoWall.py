@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+"""
+Video wall: the panels of a StreamInputs 'videoWall' stream composited
+by one ffmpeg.
+
+Every panel url is an input of the same ffmpeg. Each input is decoded,
+scaled once to its panel size and stacked with xstack into the wall,
+which then feeds the stream's outputs (relay, snapshot, transcode ...)
+like a single input would:
+
+    [0:v] fps,scale --> concat --+
+    color ------------> concat --+--> xstack --> split --> outputs
+    [1:v] fps,scale --> concat --+
+    ...
+
+A panel that faults is swapped for its placeholder without restarting
+the wall: network inputs are opened with a read timeout so a dead
+source ends its input, concat then continues with a color source of
+the panel's size which costs next to nothing until it is used. Panels
+that do not play when the wall starts are placeholders from the start,
+one dead camera does not keep the wall from starting. Only a failure to
+open a panel's input or the end of it faults the panel, decoder errors
+do not.
+
+A faulted panel is checked after recoverInterval seconds: its source
+must accept a connection and ffmpeg must decode a frame of it, a
+source that accepts connections but refuses the stream (404, 401, an
+unknown codec) stays a placeholder. Only a panel that passed the check
+restarts the wall. Each failed check, and each return that faults
+again within recoverInterval, doubles the panel's wait up to
+MAX_RECOVER_INTERVAL.
+
+Checks connect, resolve host names and run ffmpeg, so they never run on
+the thread starting the wall, which under a StreamManager is shared by
+every stream. They run on a small executor and post their result back
+with reload(): the wall starts with the panels known to play
+(placeholders for the rest until the first check is back).
+
+Panel errors are attributed by the [in#N] prefix ffmpeg 6.1 and later
+put on input log lines, older builds by the panel's url or host:port in
+the line.
+
+    conf = stream.wallConf(maxInActvity=60)
+    manager.add(conf, VideoWallStream)
+
+Panel placement is {x, y, width, height} in wall pixels, grid() lays out
+urls on a grid. benchmark() compares the cpu use and latency of the
+single graph with a pipeline per panel feeding a compositor.
+"""
+import concurrent.futures
+import logging
+import re
+import selectors
+import shlex
+import socket
+import subprocess
+import threading
+import time
+import capabilities
+import config
+import filterGraph
+import signals
+import supervisor
+from inputStream import InputStream
+
+WALL_RATE = 15
+# microseconds without data before a panel input ends
+PANEL_TIMEOUT = 5000000
+PLACEHOLDER_COLOR = "0x202020"
+RECOVER_INTERVAL = 30
+MAX_RECOVER_INTERVAL = 600
+PROBE_TIMEOUT = 1.0
+# seconds for ffmpeg to decode the first frame of a panel being checked
+PLAY_TIMEOUT = 10
+PROBE_WORKERS = 4
+
+WALL_LABEL = "[wall]"
+
+# input number in ffmpeg's log lines, [in#1/rtsp @ ...] or stream #1:0
+_INPUT_RE = re.compile(r"\[in#(\d+)|[Ii]nput #(\d+)|stream #(\d+):")
+# a panel input that failed to open or ended, not decoder errors
+_FAULT_RE = re.compile(r"[Ee]nd of file|[Ee]rror (opening input|during demuxing)|"
+    r"Input/output error|[Cc]onnection (refused|timed out|reset)|"
+    r"[Oo]peration timed out|No route to host|[Nn]etwork is unreachable|"
+    r"Server returned [45]\d\d|method \w+ failed|"
+    r"Invalid data found when processing input")
+
+# reachability checks of every wall, off the threads running the walls
+_checks = concurrent.futures.ThreadPoolExecutor(max_workers=PROBE_WORKERS,
+    thread_name_prefix="videowall-probe")
+
+
+def grid(urls, width=1920, height=1080, columns=None):
+    """ StreamInputs.src entries placing urls on a grid covering width x
+        height.
+    """
+    columns = columns or max(1, int(len(urls) ** 0.5 + 0.999))
+    rows = (len(urls) + columns - 1) // columns
+    w = width // columns & ~1
+    h = height // rows & ~1
+    return [{
+        'url': url,
+        'panel': {'x': (i % columns) * w, 'y': (i // columns) * h,
+            'width': w, 'height': h}
+    } for i, url in enumerate(urls)]
+
+def input_args(url, timeout=PANEL_TIMEOUT):
+    """ ffmpeg arguments opening url as a panel input """
+    if url == 'testsrc':
+        return ["-re", "-f", "lavfi", "-i", "testsrc=size=352x240:rate=15"]
+    if url.startswith(("rtsp:", "rtsps:")):
+        return ["-timeout", str(timeout), "-i", url]
+    if "://" in url:
+        return ["-rw_timeout", str(timeout), "-i", url]
+    return ["-re", "-i", url]
+
+def wall_graph(panels, rate=WALL_RATE, placeholders=()):
+    """ (input arguments, filter chains producing WALL_LABEL) for panels,
+        the panels numbered in placeholders get no input.
+    """
+    inputs = []
+    chains = []
+    stacked = []
+    n = 0
+    for i, p in enumerate(panels):
+        size = "%dx%d" % (p['width'], p['height'])
+        color = "color=c=%s:s=%s:r=%s,format=yuv420p,settb=AVTB" % (
+            PLACEHOLDER_COLOR, size, rate)
+        if i in placeholders:
+            chains.append("%s[q%d]" % (color, i))
+        else:
+            inputs += input_args(p['url'])
+            chains.append("[%d:v]setpts=PTS-STARTPTS,fps=%s,scale=%d:%d,"
+                "setsar=1,format=yuv420p,settb=AVTB[p%d]" % (
+                n, rate, p['width'], p['height'], i))
+            chains.append("%s[c%d]" % (color, i))
+            chains.append("[p%d][c%d]concat=n=2:v=1:a=0[q%d]" % (i, i, i))
+            n += 1
+        stacked.append("[q%d]" % i)
+    # realtime paces a wall of placeholders only
+    if len(stacked) > 1:
+        layout = "|".join("%d_%d" % (p['x'], p['y']) for p in panels)
+        chains.append("%sxstack=inputs=%d:layout=%s:fill=black,realtime%s" % (
+            "".join(stacked), len(stacked), layout, WALL_LABEL))
+    else:
+        chains.append("%srealtime%s" % (stacked[0], WALL_LABEL))
+    return inputs, chains
+
+
+class _Probes:
+    """ Non blocking TCP connects to the sources of faulted panels. """
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+
+    def start(self, panel, url):
+        address = supervisor.probe_address(url)
+        if address is None or panel in self.pending():
+            return
+        try:
+            addr = socket.getaddrinfo(address[0], address[1],
+                type=socket.SOCK_STREAM)[0]
+        except (OSError, UnicodeError):
+            return
+        s = socket.socket(addr[0], socket.SOCK_STREAM)
+        s.setblocking(False)
+        s.connect_ex(addr[4])
+        self.selector.register(s, selectors.EVENT_WRITE, (panel, time.time()))
+
+    def pending(self):
+        return set(key.data[0] for key in self.selector.get_map().values())
+
+    def poll(self, timeout=0):
+        """ Panels whose source accepted a connection """
+        reachable = set()
+        for key, mask in self.selector.select(timeout):
+            if key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                reachable.add(key.data[0])
+            self._close(key)
+        now = time.time()
+        for key in list(self.selector.get_map().values()):
+            if now - key.data[1] > PROBE_TIMEOUT:
+                self._close(key)
+        return reachable
+
+    def _close(self, key):
+        self.selector.unregister(key.fileobj)
+        key.fileobj.close()
+
+    def close(self):
+        for key in list(self.selector.get_map().values()):
+            self._close(key)
+
+
+def reachable(urls, timeout=PROBE_TIMEOUT):
+    """ Indexes of urls whose source accepts a connection within timeout,
+        urls without a host count as reachable.
+    """
+    probes = _Probes()
+    result = set(i for i, url in enumerate(urls)
+        if supervisor.probe_address(url) is None)
+    for i, url in enumerate(urls):
+        probes.start(i, url)
+    deadline = time.time() + timeout
+    while probes.pending() and time.time() < deadline:
+        result |= probes.poll(deadline - time.time())
+    probes.close()
+    return result
+
+
+def playable(urls, timeout=PLAY_TIMEOUT):
+    """ Indexes of urls ffmpeg decodes a frame of within timeout, urls
+        without a host count as playable. Sources refusing connections
+        are left out without starting ffmpeg.
+    """
+    result = set()
+    procs = {}
+    for i in reachable(urls):
+        if supervisor.probe_address(urls[i]) is None:
+            result.add(i)
+            continue
+        procs[i] = subprocess.Popen([config.FFMPEG, "-nostdin", "-v", "quiet"] +
+            input_args(urls[i]) + ["-map", "0:v:0", "-frames:v", "1", "-f", "null", "-"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + timeout
+    for i, proc in procs.items():
+        try:
+            if proc.wait(max(deadline - time.time(), 0)) == 0:
+                result.add(i)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+    return result
+
+
+class VideoWallStream(InputStream):
+    """ InputStream running the wall of conf 'panels', a list of {url, x,
+        y, width, height}. Also takes 'rate' and 'recoverInterval'.
+    """
+    def __init__(self, conf):
+        InputStream.__init__(self, conf)
+        self.panels = conf['panels']
+        self.rate = conf.get('rate', WALL_RATE)
+        self.recover_interval = conf.get('recoverInterval', RECOVER_INTERVAL)
+        urls = [p['url'] for p in self.panels]
+        # panels that passed their last check, those without a host until
+        # the first check is back
+        self.up = set(i for i, url in enumerate(urls)
+            if supervisor.probe_address(url) is None)
+        # panels showing their placeholder
+        self.faulted = set()
+        # faulted panels a fault was published for
+        self.reported = set()
+        # panel -> time of its next check, its wait after that
+        self.retry_at = {}
+        self.delay = {}
+        # panel -> time the wall last started with it
+        self.started = {}
+        self.panel_lock = threading.Lock()
+        self.check = None
+        # ffmpeg input number -> panel number of the running wall
+        self.input_panels = {}
+        self.next_recover = 0
+        self.indexed_log = self._indexed_log()
+
+    def _indexed_log(self):
+        """ True if ffmpeg prefixes input log lines with [in#N] (6.1+) """
+        version = capabilities.get().version or ""
+        m = re.match(r"n?(\d+)\.(\d+)", version)
+        # git builds report a commit, assume they are recent
+        return m is None or (int(m.group(1)), int(m.group(2))) >= (6, 1)
+
+    def _backoff(self, panel, now):
+        """ Schedule the next check of panel, must hold self.panel_lock. """
+        delay = self.delay.get(panel, self.recover_interval)
+        self.retry_at[panel] = now + delay
+        self.delay[panel] = min(delay * 2, MAX_RECOVER_INTERVAL)
+
+    def _check(self):
+        """ Check the faulted panels that are due on the executor, the
+            result comes back in _checked.
+        """
+        now = time.time()
+        with self.panel_lock:
+            if self.check is not None and not self.check.done():
+                return
+            due = sorted(p for p in self.faulted if self.retry_at.get(p, 0) <= now)
+            if not due:
+                return
+            self.check = _checks.submit(playable, [self.panels[p]['url'] for p in due])
+        self.check.add_done_callback(lambda future: self._checked(future, due))
+
+    def _checked(self, future, due):
+        # on an executor thread
+        if future.exception() is not None:
+            logging.warning("video wall %s: checking panels failed: %s" % (
+                self.sid, str(future.exception())))
+            ok = set()
+        else:
+            ok = set(due[i] for i in future.result())
+        now = time.time()
+        with self.panel_lock:
+            failed = [p for p in due if p not in ok]
+            for p in failed:
+                self._backoff(p, now)
+            failed = [p for p in failed if p not in self.reported]
+            self.reported.update(failed)
+            self.reported -= ok
+            self.up |= ok
+            back = ok & self.faulted
+        for p in failed:
+            self._panel_fault(p, "does not play")
+        if back:
+            logging.info("video wall %s: panels %s play again, restarting" % (
+                self.sid, sorted(back)))
+            self.reload()
+
+    def _command(self, outputs):
+        now = time.time()
+        with self.panel_lock:
+            placeholders = set(range(len(self.panels))) - self.up
+            self.faulted = set(placeholders)
+            for i in set(range(len(self.panels))) - placeholders:
+                self.started[i] = now
+        inputs, chains = wall_graph(self.panels, self.rate, placeholders)
+        self.input_panels = dict(enumerate(
+            i for i in range(len(self.panels)) if i not in placeholders))
+        self._check()
+
+        fds = dict((name, p[1]) for name, p in self.out_pipes.items())
+        fds[filterGraph.OUTPUT_RELAY] = self.vout_w
+        graph = filterGraph.compile(outputs, fds, WALL_LABEL, chains)
+        return " ".join([shlex.quote(config.FFMPEG)] +
+            [shlex.quote(a) for a in inputs] +
+            ["-nostats", "-progress", "pipe:1", graph])
+
+    def _panel_fault(self, panel, desc):
+        logging.warning("video wall %s: panel %d %s" % (self.sid, panel, desc))
+        signals.publish(self.sf_topic, {
+            'error': 'BadInput',
+            'desc': 'Panel %d (%s): %s' % (panel, self.panels[panel]['url'], desc),
+            'panel': panel
+        })
+
+    def _panel_for(self, line):
+        """ Panel a log line is about, None if it can not be told. """
+        if self.indexed_log:
+            m = _INPUT_RE.search(line)
+            if m is not None:
+                return self.input_panels.get(
+                    int(next(g for g in m.groups() if g is not None)))
+        # older ffmpeg names the url, or the host:port for tcp errors
+        live = list(self.input_panels.values())
+        for panel in live:
+            if self.panels[panel]['url'] in line:
+                return panel
+        found = [panel for panel in live if
+            supervisor.probe_address(self.panels[panel]['url']) and
+            "%s:%d" % supervisor.probe_address(self.panels[panel]['url']) in line]
+        # several panels of one address, e.g. channels of an nvr, can not
+        # be told apart
+        return found[0] if len(found) == 1 else None
+
+    def _stderr_proc(self, line):
+        InputStream._stderr_proc(self, line)
+        if not _FAULT_RE.search(line):
+            return
+        panel = self._panel_for(line)
+        now = time.time()
+        with self.panel_lock:
+            if panel is None or panel in self.faulted:
+                return
+            # ffmpeg already shows the placeholder, the next start too
+            self.faulted.add(panel)
+            self.up.discard(panel)
+            self.reported.add(panel)
+            if now - self.started.get(panel, now) >= self.recover_interval:
+                # it played a while, not a return that failed again
+                self.delay[panel] = self.recover_interval
+            self._backoff(panel, now)
+        self._panel_fault(panel, line.strip())
+
+    def _line_proc(self, line):
+        InputStream._line_proc(self, line)
+        if not self.faulted:
+            return
+        now = time.time()
+        if now >= self.next_recover:
+            self.next_recover = now + 1
+            self._check()
+
+
+def benchmark(counts=(4, 9), seconds=30, width=1280, height=720):
+    """ cpu (all ffmpeg children) and latency (launch to first wall frame,
+        frame interval) of the wall as one graph and as a pipeline per
+        panel plus a compositor, testsrc panels.
+    """
+    import os
+    import resource
+    import subprocess
+
+    def run(procs, out):
+        start = time.time()
+        frame = width * height * 3 // 2
+        first = None
+        frames = 0
+        got = 0
+        end = start + seconds
+        while time.time() < end:
+            data = out.read1(1 << 20) if hasattr(out, 'read1') else out.read(1 << 20)
+            if not data:
+                break
+            got += len(data)
+            if first is None:
+                first = time.time() - start
+            frames = got // frame
+        elapsed = time.time() - start
+        for p in procs:
+            p.kill()
+            p.wait()
+        return first, frames / elapsed if elapsed else 0, elapsed
+
+    def children_cpu():
+        r = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return r.ru_utime + r.ru_stime
+
+    results = []
+    for count in counts:
+        panels = [dict(e['panel'], url='testsrc')
+            for e in grid(['testsrc'] * count, width, height)]
+        out_args = ["-f", "rawvideo", "-pix_fmt", "yuv420p", "pipe:1"]
+
+        # one graph
+        inputs, chains = wall_graph(panels)
+        cmd = [config.FFMPEG, "-loglevel", "error"] + inputs + [
+            "-filter_complex", ";".join(chains), "-map", WALL_LABEL] + out_args
+        cpu = children_cpu()
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        first, fps, elapsed = run([p], p.stdout)
+        results.append({'panels': count, 'model': 'graph',
+            'cpu%': 100.0 * (children_cpu() - cpu) / elapsed,
+            'first frame s': first, 'fps': fps})
+
+        # a scaling ffmpeg per panel writing raw frames to the compositor
+        procs = []
+        pipes = [os.pipe() for _ in panels]
+        for (r, w), panel in zip(pipes, panels):
+            procs.append(subprocess.Popen([config.FFMPEG, "-loglevel", "error"] +
+                input_args('testsrc') + ["-vf", "fps=%d,scale=%d:%d,format=yuv420p" % (
+                WALL_RATE, panel['width'], panel['height']), "-f", "rawvideo",
+                "pipe:%d" % w], pass_fds=[w]))
+        cmd = [config.FFMPEG, "-loglevel", "error"]
+        for (r, w), panel in zip(pipes, panels):
+            cmd += ["-f", "rawvideo", "-pix_fmt", "yuv420p", "-s", "%dx%d" % (
+                panel['width'], panel['height']), "-r", str(WALL_RATE),
+                "-i", "pipe:%d" % r]
+        layout = "|".join("%d_%d" % (p['x'], p['y']) for p in panels)
+        cmd += ["-filter_complex", "%sxstack=inputs=%d:layout=%s:fill=black[wall]" % (
+            "".join("[%d:v]" % i for i in range(count)), count, layout),
+            "-map", WALL_LABEL] + out_args
+        cpu = children_cpu()
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+            pass_fds=[r for r, w in pipes])
+        for r, w in pipes:
+            os.close(r)
+            os.close(w)
+        first, fps, elapsed = run(procs + [p], p.stdout)
+        results.append({'panels': count, 'model': 'per panel',
+            'cpu%': 100.0 * (children_cpu() - cpu) / elapsed,
+            'first frame s': first, 'fps': fps})
+
+    for r in results:
+        print(r)
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.WARNING,
+        format="%(asctime)s %(message)s")
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    benchmark(seconds=seconds)
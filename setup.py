@@ -34,7 +34,10 @@ setup(
     },
     install_requires=[
         'paho-mqtt'  
-    ]
+    ],
+    extras_require={
+        'analytics': ['numpy']
+    }
 )
 
 if sys.argv[1] == 'install':